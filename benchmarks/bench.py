@@ -0,0 +1,322 @@
+import argparse
+import asyncio
+import datetime
+import functools
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+
+# Benchmark offline cho các đường nóng của bot (play_music, import Spotify, hàng đợi, queue_list).
+# yt-dlp, spotipy, ffmpeg và Discord đều được thay bằng bản giả trong benchmarks/fakes.py.
+#
+#   python benchmarks/bench.py                          # chạy mọi kịch bản
+#   python benchmarks/bench.py -s play_cold -s queue_ops --ytdl-latency 0.2
+#   python benchmarks/bench.py --save baseline.json
+#   python benchmarks/bench.py --compare baseline.json --fail-on-regression
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+def prepare_environment(workdir: str):
+    # main.py đọc cấu hình lúc import: trỏ mọi file trạng thái vào thư mục tạm
+    os.chdir(workdir)
+    os.environ.update({
+        "DISCORD_BOT_TOKEN": "benchmark",
+        "SPOTIFY_CLIENT_ID": "benchmark",
+        "SPOTIFY_CLIENT_SECRET": "benchmark",
+        "STATE_BACKEND": "memory",
+        "SESSION_JOURNAL_FILE": "",
+        "METADATA_CACHE_FILE": os.path.join(workdir, "cache.db"),
+        "PLAYLIST_DB_FILE": os.path.join(workdir, "playlists.db"),
+        "SPOTIFY_MATCH_CACHE_FILE": os.path.join(workdir, "spotify_matches.json"),
+        "AUDIO_CACHE_DIR": os.path.join(workdir, "audio_cache"),
+        "AUDIO_CACHE_MIN_PLAYS": str(10 ** 9),
+        "LOUDNESS_NORMALIZE": "0",
+    })
+
+def percentile(samples: list, fraction: float) -> float:
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, max(0, round(fraction * (len(ordered) - 1))))
+    return ordered[index]
+
+class Bench:
+    def __init__(self, main, fakes, args):
+        self.main = main
+        self.fakes = fakes
+        self.args = args
+        self.next_guild = 1000
+
+    def new_context(self, connected: bool = False, playing: bool = False):
+        self.next_guild += 1
+        ctx = self.fakes.FakeContext(self.next_guild)
+        if connected or playing:
+            ctx.guild.voice_client = self.fakes.FakeVoiceClient(ctx.guild, ctx.author.voice.channel)
+            ctx.guild.voice_client.playing = playing
+        return ctx
+
+    def unique_video(self, tag: str, i: int) -> str:
+        return f"https://www.youtube.com/watch?v={self.fakes.fake_video_id(f'{tag}-{time.time_ns()}-{i}')}"
+
+    async def cleanup(self, ctx):
+        self.main.drop_guild_session(ctx.guild.id)
+
+    # Kịch bản: (số lần lặp mặc định, hàm chuẩn bị trả về hàm đo)
+
+    async def scenario_queue_ops(self):
+        main = self.main
+        size = self.args.playlist_size
+        urls = [self.unique_video("queue", i) for i in range(size)]
+
+        async def op(i):
+            queue = main.GuildQueue(-1, size)
+            for url in urls:
+                queue.add(url, "Title", "Artist")
+            for url in urls[::5]:
+                assert url in queue
+            queue.peek(main.PREFETCH_DEPTH)
+            queue.page(20, 10)
+            queue.remove_at(len(queue) // 2)
+            queue.shuffle()
+            while queue:
+                queue.pop_next()
+        return 2000, op
+
+    async def scenario_queue_list(self):
+        main = self.main
+        ctx = self.new_context(playing=True)
+        queue = main.get_queue(ctx.guild.id)
+        for i in range(self.args.playlist_size):
+            queue.add(self.unique_video("list", i), f"Title {i}", f"Artist {i}", 215)
+
+        async def op(i):
+            await main.queue_list.callback(ctx)
+        return 500, op
+
+    async def scenario_play_cold(self):
+        async def op(i):
+            ctx = self.new_context()
+            await self.main.play_music(ctx, self.unique_video("cold", i))
+            assert ctx.voice_client.is_playing()
+            await self.cleanup(ctx)
+        return 50, op
+
+    async def scenario_play_warm(self):
+        url = self.unique_video("warm", 0)
+        ctx = self.new_context()
+        await self.main.play_music(ctx, url)
+        await self.cleanup(ctx)
+
+        async def op(i):
+            ctx = self.new_context()
+            await self.main.play_music(ctx, url)
+            assert ctx.voice_client.is_playing()
+            await self.cleanup(ctx)
+        return 300, op
+
+    async def scenario_queue_add(self):
+        async def op(i):
+            ctx = self.new_context(playing=True)
+            await self.main.play_music(ctx, self.unique_video("add", i))
+            queue = self.main.peek_queue(ctx.guild.id)
+            assert queue and len(queue) == 1 and queue.peek(1)[0].duration
+            await self.cleanup(ctx)
+        return 100, op
+
+    async def scenario_spotify_track(self):
+        async def op(i):
+            ctx = self.new_context()
+            track_id = self.fakes.fake_video_id(f"track-{time.time_ns()}-{i}")
+            await self.main.play_music(ctx, f"https://open.spotify.com/track/{track_id}")
+            assert ctx.voice_client.is_playing()
+            await self.cleanup(ctx)
+        return 50, op
+
+    async def scenario_spotify_playlist(self):
+        async def op(i):
+            ctx = self.new_context()
+            playlist_id = self.fakes.fake_video_id(f"playlist-{time.time_ns()}-{i}")
+            result = await self.main.handle_spotify(ctx, f"https://open.spotify.com/playlist/{playlist_id}")
+            assert result["count"] > 0
+            await self.cleanup(ctx)
+        return 5, op
+
+    async def scenario_youtube_playlist(self):
+        async def op(i):
+            ctx = self.new_context()
+            list_id = self.fakes.fake_video_id(f"ytlist-{time.time_ns()}-{i}")
+            await self.main.play_music(ctx, f"https://www.youtube.com/playlist?list={list_id}")
+            assert ctx.voice_client.is_playing()
+            await self.cleanup(ctx)
+        return 5, op
+
+    async def scenario_pcm_volume(self):
+        # Một giây âm thanh (50 khung) qua chuỗi xử lý PCM, có đổi âm lượng giữa chừng để đo cả dốc
+        main = self.main
+        frame = bytes(range(256)) * 15
+
+        async def op(i):
+            source = main.PCMProcessor(self.fakes.FakeAudioSource(frame), [main.VolumeStage(0.5, main.VOLUME_RAMP_FRAMES)])
+            for n in range(50):
+                if n == 25:
+                    source.volume = 0.8
+                assert len(source.read()) == len(frame)
+        return 200, op
+
+    @classmethod
+    def scenarios(cls) -> list:
+        return [name[len("scenario_"):] for name in dir(cls) if name.startswith("scenario_")]
+
+    async def measure(self, name: str) -> dict:
+        default_iterations, op = await getattr(self, f"scenario_{name}")()
+        iterations = self.args.iterations or default_iterations
+        concurrency = max(1, self.args.concurrency)
+        for i in range(min(self.args.warmup, iterations)):
+            await op(-1 - i)
+        samples = []
+
+        async def timed(i):
+            started = time.perf_counter()
+            await op(i)
+            samples.append(time.perf_counter() - started)
+
+        started = time.perf_counter()
+        for batch in range(0, iterations, concurrency):
+            await asyncio.gather(*(timed(i) for i in range(batch, min(batch + concurrency, iterations))))
+        elapsed = time.perf_counter() - started
+
+        # Đo bộ nhớ ở lượt riêng vì tracemalloc làm chậm đáng kể mọi phép cấp phát
+        memory_iterations = min(iterations, self.args.memory_iterations)
+        tracemalloc.start()
+        try:
+            for batch in range(0, memory_iterations, concurrency):
+                await asyncio.gather(*(op(i) for i in range(batch, min(batch + concurrency, memory_iterations))))
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        return {
+            "iterations": iterations,
+            "concurrency": concurrency,
+            "throughput": iterations / elapsed if elapsed else 0.0,
+            "mean_ms": statistics.fmean(samples) * 1000,
+            "p50_ms": percentile(samples, 0.50) * 1000,
+            "p99_ms": percentile(samples, 0.99) * 1000,
+            "peak_kb": peak / 1024,
+        }
+
+def print_results(results: dict):
+    print(f"{'scenario':<20} {'iter':>6} {'ops/s':>10} {'p50 ms':>10} {'p99 ms':>10} {'peak KB':>10}")
+    for name, result in results.items():
+        print(
+            f"{name:<20} {result['iterations']:>6} {result['throughput']:>10.1f} "
+            f"{result['p50_ms']:>10.2f} {result['p99_ms']:>10.2f} {result['peak_kb']:>10.1f}"
+        )
+
+def compare_results(baseline: dict, results: dict, threshold: float) -> list:
+    # So sánh với baseline, trả về danh sách kịch bản chậm/tốn bộ nhớ hơn ngưỡng (%)
+    regressions = []
+    print(f"\nSo với baseline ({baseline['meta'].get('timestamp', '?')}), ngưỡng {threshold:.0f}%:")
+    print(f"{'scenario':<20} {'ops/s':>10} {'p50':>10} {'p99':>10} {'peak':>10}")
+    for name, result in results.items():
+        old = baseline["scenarios"].get(name)
+        if not old:
+            print(f"{name:<20} {'(mới)':>10}")
+            continue
+        changes = {
+            key: (result[key] - old[key]) / old[key] * 100 if old[key] else 0.0
+            for key in ("throughput", "p50_ms", "p99_ms", "peak_kb")
+        }
+        worse = (
+            changes["throughput"] < -threshold
+            or changes["p50_ms"] > threshold
+            or changes["p99_ms"] > threshold
+            or changes["peak_kb"] > threshold
+        )
+        if worse:
+            regressions.append(name)
+        print(
+            f"{name:<20} {changes['throughput']:>+9.1f}% {changes['p50_ms']:>+9.1f}% "
+            f"{changes['p99_ms']:>+9.1f}% {changes['peak_kb']:>+9.1f}%{'  ⚠' if worse else ''}"
+        )
+    return regressions
+
+async def run(args) -> dict:
+    import fakes
+    import discord
+    discord.FFmpegPCMAudio = fakes.FakeAudioSource
+    discord.FFmpegOpusAudio = fakes.FakeAudioSource
+    import main
+
+    async def no_reactions(*args, **kwargs):
+        raise asyncio.TimeoutError()
+    main.bot.wait_for = no_reactions
+    main.sp.client = fakes.FakeSpotify(args.spotify_latency, args.playlist_size)
+    # Worker yt-dlp là process riêng: truyền bản giả (picklable) qua factory thay vì vá module yt_dlp
+    main.extraction_pool.factory = functools.partial(
+        fakes.FakeYoutubeDL, latency=args.ytdl_latency, playlist_size=args.playlist_size
+    )
+    main.extraction_pool.start()
+
+    bench = Bench(main, fakes, args)
+    results = {}
+    for name in args.scenario or Bench.scenarios():
+        results[name] = await bench.measure(name)
+        print(f"  {name}: xong", file=sys.stderr)
+    if main.progress_scheduler.task:
+        main.progress_scheduler.task.cancel()
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark offline cho Hinaa")
+    parser.add_argument("-s", "--scenario", action="append", choices=Bench.scenarios())
+    parser.add_argument("-n", "--iterations", type=int, help="ghi đè số lần lặp của mọi kịch bản")
+    parser.add_argument("-c", "--concurrency", type=int, default=1)
+    parser.add_argument("--warmup", type=int, default=3)
+    parser.add_argument("--memory-iterations", type=int, default=20)
+    parser.add_argument("--ytdl-latency", type=float, default=0.05, help="độ trễ giả lập mỗi lần gọi yt-dlp (giây)")
+    parser.add_argument("--spotify-latency", type=float, default=0.02, help="độ trễ giả lập mỗi lần gọi Spotify (giây)")
+    parser.add_argument("--playlist-size", type=int, default=50)
+    parser.add_argument("--save", help="lưu kết quả thành baseline JSON")
+    parser.add_argument("--compare", help="so sánh với baseline JSON")
+    parser.add_argument("--threshold", type=float, default=10.0)
+    parser.add_argument("--fail-on-regression", action="store_true")
+    args = parser.parse_args()
+    save_path = os.path.abspath(args.save) if args.save else None
+    compare_path = os.path.abspath(args.compare) if args.compare else None
+
+    with tempfile.TemporaryDirectory(prefix="hinaa-bench-") as workdir:
+        prepare_environment(workdir)
+        results = asyncio.run(run(args))
+
+    print_results(results)
+    report = {
+        "meta": {
+            "timestamp": datetime.datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "ytdl_latency": args.ytdl_latency,
+            "spotify_latency": args.spotify_latency,
+            "playlist_size": args.playlist_size,
+            "concurrency": args.concurrency,
+        },
+        "scenarios": results,
+    }
+    if save_path:
+        with open(save_path, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"\nĐã lưu baseline vào {save_path}")
+    if compare_path:
+        with open(compare_path, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        regressions = compare_results(baseline, results, args.threshold)
+        if regressions and args.fail_on_regression:
+            print(f"\nChậm hơn baseline: {', '.join(regressions)}")
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
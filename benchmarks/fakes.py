@@ -0,0 +1,213 @@
+import hashlib
+import time
+import types
+import urllib.parse
+
+import discord
+
+# Bản giả của yt-dlp, spotipy và các đối tượng Discord dùng cho benchmark.
+# Độ trễ mạng được mô phỏng bằng time.sleep để chặn luồng giống thư viện thật.
+
+def fake_video_id(seed: str) -> str:
+    return hashlib.md5(seed.encode("utf-8")).hexdigest()[:11]
+
+def fake_video(video_id: str) -> dict:
+    return {
+        "id": video_id,
+        "title": f"Fake Song {video_id}",
+        "uploader": f"Fake Artist {video_id[:4]}",
+        "duration": 215,
+        "thumbnail": f"https://i.ytimg.com/vi/{video_id}/hqdefault.jpg",
+        "webpage_url": f"https://www.youtube.com/watch?v={video_id}",
+        "url": f"https://rr1.googlevideo.com/videoplayback?id={video_id}&expire={int(time.time()) + 21600}",
+        "acodec": "opus",
+        "ext": "webm",
+        "abr": 160,
+    }
+
+class FakeYoutubeDL:
+    latency = 0.0
+    playlist_size = 50
+    search_results = 5
+
+    def __init__(self, params: dict = None, latency: float = None, playlist_size: int = None):
+        self.params = params or {}
+        if latency is not None:
+            self.latency = latency
+        if playlist_size is not None:
+            self.playlist_size = playlist_size
+
+    def extract_info(self, url: str, download: bool = False) -> dict:
+        time.sleep(self.latency)
+        parsed = urllib.parse.urlparse(url)
+        if "list" in urllib.parse.parse_qs(parsed.query) and parsed.path == "/playlist":
+            return {
+                "id": fake_video_id(url),
+                "title": "Fake Playlist",
+                "entries": [
+                    {
+                        "id": video_id,
+                        "title": f"Fake Song {video_id}",
+                        "channel": f"Fake Artist {video_id[:4]}",
+                        "duration": 215,
+                        "url": f"https://www.youtube.com/watch?v={video_id}",
+                    }
+                    for video_id in (
+                        fake_video_id(f"{url}#{i}")
+                        for i in range(min(self.playlist_size, self.params.get("playlistend") or self.playlist_size))
+                    )
+                ],
+            }
+        if not parsed.scheme and self.params.get("default_search"):
+            video_ids = [fake_video_id(f"{url}#{i}") for i in range(self.search_results)]
+            if self.params.get("extract_flat"):
+                return {"entries": [
+                    {key: video[key] for key in ("id", "title", "uploader", "duration")}
+                    for video in map(fake_video, video_ids)
+                ]}
+            # Tìm kiếm đầy đủ phải phân giải định dạng của từng kết quả
+            time.sleep(self.latency * (len(video_ids) - 1))
+            return {"entries": [fake_video(video_id) for video_id in video_ids]}
+        video_id = urllib.parse.parse_qs(parsed.query).get("v", [None])[0] or fake_video_id(url)
+        return fake_video(video_id)
+
+    def sanitize_info(self, info: dict) -> dict:
+        return info
+
+class FakeSpotify:
+    def __init__(self, latency: float, playlist_size: int):
+        self.latency = latency
+        self.playlist_size = playlist_size
+
+    @staticmethod
+    def _track(track_id: str) -> dict:
+        return {
+            "id": track_id,
+            "name": f"Fake Track {track_id}",
+            "artists": [{"name": f"Fake Artist {track_id[:4]}"}],
+            "external_urls": {"spotify": f"https://open.spotify.com/track/{track_id}"},
+        }
+
+    def track(self, url: str, market: str = None) -> dict:
+        time.sleep(self.latency)
+        return self._track(url.rstrip("/").split("/")[-1].split("?")[0])
+
+    def playlist_items(self, url: str, market: str = None, additional_types=None, limit: int = 100, offset: int = 0) -> dict:
+        time.sleep(self.latency)
+        end = min(offset + limit, self.playlist_size)
+        return {
+            "total": self.playlist_size,
+            "items": [{"track": self._track(fake_video_id(f"{url}#{i}"))} for i in range(offset, end)],
+        }
+
+class FakeAudioSource(discord.AudioSource):
+    # Thay cho FFmpegPCMAudio/FFmpegOpusAudio: không tạo process ffmpeg
+    def __init__(self, *args, **kwargs):
+        self.args = args
+        self.kwargs = kwargs
+        self.frame = args[0] if args and isinstance(args[0], bytes) else b"\x00" * 3840
+
+    def read(self) -> bytes:
+        return self.frame
+
+    def is_opus(self) -> bool:
+        return False
+
+class FakeMessage:
+    def __init__(self, message_id: int, embed=None, view=None):
+        self.id = message_id
+        self.embed = embed
+        self.view = view
+
+    async def edit(self, **kwargs):
+        self.embed = kwargs.get("embed", self.embed)
+
+    async def add_reaction(self, emoji):
+        pass
+
+    async def remove_reaction(self, emoji, user):
+        pass
+
+    async def clear_reactions(self):
+        pass
+
+class FakeVoiceClient:
+    def __init__(self, guild, channel):
+        self.guild = guild
+        self.channel = channel
+        self.source = None
+        self.playing = False
+        self.paused = False
+
+    def play(self, source, after=None):
+        if self.source:
+            self.source.cleanup()
+        self.source = source
+        self.playing = True
+        self.paused = False
+
+    def is_playing(self) -> bool:
+        return self.playing
+
+    def is_paused(self) -> bool:
+        return self.paused
+
+    def pause(self):
+        self.paused = True
+
+    def resume(self):
+        self.paused = False
+
+    def stop(self):
+        # Giống AudioPlayer thật: dừng phát thì dọn nguồn (và thread đọc trước của nó)
+        if self.source:
+            self.source.cleanup()
+            self.source = None
+        self.playing = False
+        self.paused = False
+
+    async def disconnect(self, force: bool = False):
+        self.stop()
+        self.guild.voice_client = None
+
+class FakeVoiceChannel:
+    def __init__(self, guild, channel_id: int, members: int):
+        self.guild = guild
+        self.id = channel_id
+        self.members = [types.SimpleNamespace(id=i) for i in range(members)]
+
+    def permissions_for(self, member):
+        return types.SimpleNamespace(connect=True, speak=True)
+
+    async def connect(self):
+        self.guild.voice_client = FakeVoiceClient(self.guild, self)
+        return self.guild.voice_client
+
+class FakeGuild:
+    def __init__(self, guild_id: int):
+        self.id = guild_id
+        self.me = types.SimpleNamespace(id=0, name="Hinaa")
+        self.voice_client = None
+
+class FakeContext:
+    def __init__(self, guild_id: int, members: int = 5):
+        self.guild = FakeGuild(guild_id)
+        self.channel = types.SimpleNamespace(id=guild_id * 10 + 1)
+        voice_channel = FakeVoiceChannel(self.guild, guild_id * 10 + 2, members)
+        self.author = types.SimpleNamespace(
+            id=guild_id * 10 + 3,
+            voice=types.SimpleNamespace(channel=voice_channel),
+            guild_permissions=types.SimpleNamespace(administrator=True),
+        )
+        self.messages = 0
+
+    @property
+    def voice_client(self):
+        return self.guild.voice_client
+
+    async def connect(self):
+        return await self.author.voice.channel.connect()
+
+    async def send(self, *args, **kwargs):
+        self.messages += 1
+        return FakeMessage(self.messages, kwargs.get("embed"), kwargs.get("view"))
@@ -0,0 +1,200 @@
+import asyncio
+import json
+import logging
+import logging.handlers
+import os
+import signal
+import sys
+import time
+
+import aiohttp
+from dotenv import load_dotenv
+
+# Launcher chạy Hinaa ở chế độ cluster: chia shard cho nhiều process main.py,
+# giám sát và khởi động lại process lỗi, gộp trạng thái của các cluster.
+
+# Cấu hình logging
+logger = logging.getLogger("hinaa.cluster")
+logger.setLevel(logging.INFO)
+file_handler = logging.handlers.RotatingFileHandler(
+    filename="hinaa_cluster.log",
+    encoding="utf-8",
+    maxBytes=5 * 1024 * 1024,  # 5MB
+    backupCount=5,
+)
+file_handler.setFormatter(logging.Formatter("%(asctime)s:%(levelname)s:%(name)s: %(message)s"))
+logger.addHandler(file_handler)
+logger.addHandler(logging.StreamHandler())
+
+# Tải biến môi trường
+load_dotenv()
+
+DISCORD_BOT_TOKEN = os.getenv("DISCORD_BOT_TOKEN")
+SHARD_COUNT = os.getenv("SHARD_COUNT")
+CLUSTER_COUNT = int(os.getenv("CLUSTER_COUNT", str(os.cpu_count() or 1)))
+CLUSTER_STATUS_DIR = os.getenv("CLUSTER_STATUS_DIR", "cluster_status")
+CLUSTER_STATUS_FILE = os.getenv("CLUSTER_STATUS_FILE", "cluster_status.json")
+SPOTIFY_MATCH_CACHE_FILE = os.getenv("SPOTIFY_MATCH_CACHE_FILE", "spotify_matches.json")
+AUDIO_CACHE_DIR = os.getenv("AUDIO_CACHE_DIR", "audio_cache")
+AUDIO_CACHE_MAX_MB = int(os.getenv("AUDIO_CACHE_MAX_MB", "2048"))
+CLUSTER_STATUS_INTERVAL = 15
+CLUSTER_STATUS_STALE = 60
+RESTART_MIN_BACKOFF = 5
+RESTART_MAX_BACKOFF = 300
+# Process chạy lâu hơn ngưỡng này được xem là ổn định, reset backoff
+STABLE_RUNTIME = 600
+BOT_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "main.py")
+
+async def fetch_recommended_shards() -> int:
+    headers = {"Authorization": f"Bot {DISCORD_BOT_TOKEN}"}
+    async with aiohttp.ClientSession() as session:
+        async with session.get("https://discord.com/api/v10/gateway/bot", headers=headers) as response:
+            response.raise_for_status()
+            data = await response.json()
+    return int(data["shards"])
+
+def cluster_path(path: str, cluster_id: int) -> str:
+    # spotify_matches.json -> spotify_matches.0.json, audio_cache -> audio_cache.0
+    root, ext = os.path.splitext(path)
+    return f"{root}.{cluster_id}{ext}"
+
+def split_shards(shard_count: int, cluster_count: int) -> list:
+    # Chia đều shard cho các cluster, không tạo cluster rỗng
+    cluster_count = max(1, min(cluster_count, shard_count))
+    return [list(range(shard_count))[i::cluster_count] for i in range(cluster_count)]
+
+class ClusterWorker:
+    def __init__(self, cluster_id: int, shard_ids: list, shard_count: int, cluster_count: int):
+        self.cluster_id = cluster_id
+        self.shard_ids = shard_ids
+        self.shard_count = shard_count
+        self.cluster_count = cluster_count
+        self.process = None
+        self.started_at = 0.0
+        self.restarts = 0
+        self.backoff = RESTART_MIN_BACKOFF
+
+    async def spawn(self):
+        env = dict(os.environ)
+        env.update({
+            "CLUSTER_ID": str(self.cluster_id),
+            "SHARD_COUNT": str(self.shard_count),
+            "SHARD_IDS": ",".join(str(shard_id) for shard_id in self.shard_ids),
+            "CLUSTER_STATUS_DIR": CLUSTER_STATUS_DIR,
+            # Mỗi process tự ghi đè toàn bộ file cache match và tự đếm dung lượng cache âm thanh,
+            # nên mỗi cluster có file/thư mục riêng và chia đều giới hạn dung lượng
+            "SPOTIFY_MATCH_CACHE_FILE": cluster_path(SPOTIFY_MATCH_CACHE_FILE, self.cluster_id),
+            "AUDIO_CACHE_DIR": cluster_path(AUDIO_CACHE_DIR, self.cluster_id),
+            "AUDIO_CACHE_MAX_MB": str(max(1, AUDIO_CACHE_MAX_MB // self.cluster_count)),
+        })
+        self.process = await asyncio.create_subprocess_exec(sys.executable, BOT_SCRIPT, env=env)
+        self.started_at = time.time()
+        logger.info(
+            f"Cluster {self.cluster_id} (pid {self.process.pid}) khởi động với shard {self.shard_ids}/{self.shard_count}"
+        )
+
+    async def supervise(self, stopping: asyncio.Event):
+        while not stopping.is_set():
+            await self.spawn()
+            code = await self.process.wait()
+            if stopping.is_set():
+                break
+            runtime = time.time() - self.started_at
+            if runtime > STABLE_RUNTIME:
+                self.backoff = RESTART_MIN_BACKOFF
+            self.restarts += 1
+            logger.warning(
+                f"Cluster {self.cluster_id} thoát với mã {code} sau {runtime:.0f}s, "
+                f"khởi động lại sau {self.backoff}s"
+            )
+            try:
+                await asyncio.wait_for(stopping.wait(), timeout=self.backoff)
+            except asyncio.TimeoutError:
+                pass
+            self.backoff = min(self.backoff * 2, RESTART_MAX_BACKOFF)
+
+    async def terminate(self, timeout: float = 30):
+        if not self.process or self.process.returncode is not None:
+            return
+        self.process.terminate()
+        try:
+            await asyncio.wait_for(self.process.wait(), timeout=timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"Cluster {self.cluster_id} không dừng sau {timeout}s, buộc kết thúc")
+            self.process.kill()
+            await self.process.wait()
+
+    def status(self) -> dict:
+        status = {
+            "cluster_id": self.cluster_id,
+            "shard_ids": self.shard_ids,
+            "pid": self.process.pid if self.process else None,
+            "alive": bool(self.process and self.process.returncode is None),
+            "restarts": self.restarts,
+        }
+        path = os.path.join(CLUSTER_STATUS_DIR, f"{self.cluster_id}.json")
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                reported = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return status
+        # Bỏ qua trạng thái của process cũ hoặc đã lâu không cập nhật
+        if reported.get("pid") == status["pid"] and time.time() - reported.get("updated_at", 0) < CLUSTER_STATUS_STALE:
+            status.update({key: value for key, value in reported.items() if key not in status})
+        return status
+
+def write_status(workers: list, shard_count: int):
+    clusters = [worker.status() for worker in workers]
+    summary = {
+        "shard_count": shard_count,
+        "clusters": clusters,
+        "alive": sum(1 for cluster in clusters if cluster["alive"]),
+        "guilds": sum(cluster.get("guilds", 0) for cluster in clusters),
+        "voice_clients": sum(cluster.get("voice_clients", 0) for cluster in clusters),
+        "playing": sum(cluster.get("playing", 0) for cluster in clusters),
+        "updated_at": time.time(),
+    }
+    tmp_path = f"{CLUSTER_STATUS_FILE}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(summary, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, CLUSTER_STATUS_FILE)
+
+async def report_status(workers: list, shard_count: int, stopping: asyncio.Event):
+    while not stopping.is_set():
+        try:
+            await asyncio.to_thread(write_status, workers, shard_count)
+        except Exception as e:
+            logger.warning(f"Không ghi được trạng thái cluster: {e}")
+        try:
+            await asyncio.wait_for(stopping.wait(), timeout=CLUSTER_STATUS_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+
+async def main():
+    if not DISCORD_BOT_TOKEN:
+        logger.error("DISCORD_BOT_TOKEN không được cấu hình!")
+        sys.exit(1)
+    shard_count = int(SHARD_COUNT) if SHARD_COUNT else await fetch_recommended_shards()
+    os.makedirs(CLUSTER_STATUS_DIR, exist_ok=True)
+    clusters = split_shards(shard_count, CLUSTER_COUNT)
+    workers = [
+        ClusterWorker(cluster_id, shard_ids, shard_count, len(clusters))
+        for cluster_id, shard_ids in enumerate(clusters)
+    ]
+    logger.info(f"Chạy {shard_count} shard trên {len(workers)} cluster")
+
+    stopping = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stopping.set)
+
+    tasks = [asyncio.create_task(worker.supervise(stopping)) for worker in workers]
+    tasks.append(asyncio.create_task(report_status(workers, shard_count, stopping)))
+    await stopping.wait()
+    logger.info("Đang dừng các cluster...")
+    await asyncio.gather(*(worker.terminate() for worker in workers))
+    await asyncio.gather(*tasks, return_exceptions=True)
+    write_status(workers, shard_count)
+
+if __name__ == "__main__":
+    asyncio.run(main())
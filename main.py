@@ -1,6 +1,5 @@
 import discord
 from discord.ext import commands
-import yt_dlp
 import random
 import asyncio
 import os
@@ -15,12 +14,45 @@ from typing import Optional
 import logging.handlers
 import re
 import urllib.parse
+import sqlite3
+import concurrent.futures
+import multiprocessing
+import functools
+import itertools
+import math
+import contextlib
+import contextvars
+import importlib.machinery
+import heapq
+import io
+import signal
+import traceback
+import collections.abc
+import sys
+import array
+import threading
+import weakref
+import requests
+from requests.adapters import HTTPAdapter
+import psutil
+from aiohttp import web
+from ytdl_worker import extraction_worker
+try:
+    import numpy
+except ImportError:
+    numpy = None
+from collections import OrderedDict, deque
+try:
+    import redis.asyncio as aioredis
+except ImportError:
+    aioredis = None
 
-# Cấu hình logging
+# Cấu hình logging (mỗi process trong cluster ghi file log riêng)
+CLUSTER_ID = os.getenv("CLUSTER_ID")
 logger = logging.getLogger("discord")
 logger.setLevel(logging.INFO)
 file_handler = logging.handlers.RotatingFileHandler(
-    filename="hinaa_bot.log",
+    filename=f"hinaa_bot.{CLUSTER_ID}.log" if CLUSTER_ID else "hinaa_bot.log",
     encoding="utf-8",
     maxBytes=5 * 1024 * 1024,  # 5MB
     backupCount=5,
@@ -36,32 +68,925 @@ load_dotenv()
 intents = discord.Intents.default()
 intents.message_content = True
 intents.voice_states = True
-bot = commands.Bot(command_prefix="!", intents=intents, help_command=None)
+SHARD_COUNT = os.getenv("SHARD_COUNT")
+SHARD_IDS = os.getenv("SHARD_IDS")
+if SHARD_COUNT or os.getenv("AUTO_SHARD") == "1":
+    bot = commands.AutoShardedBot(
+        command_prefix="!",
+        intents=intents,
+        help_command=None,
+        shard_count=int(SHARD_COUNT) if SHARD_COUNT else None,
+        shard_ids=[int(shard_id) for shard_id in SHARD_IDS.split(",")] if SHARD_IDS else None,
+    )
+else:
+    bot = commands.Bot(command_prefix="!", intents=intents, help_command=None)
 
 # Cấu hình biến môi trường
 DISCORD_BOT_TOKEN = os.getenv("DISCORD_BOT_TOKEN")
 FFMPEG_PATH = os.getenv("FFMPEG_PATH", "ffmpeg")
 SPOTIFY_CLIENT_ID = os.getenv("SPOTIFY_CLIENT_ID")
 SPOTIFY_CLIENT_SECRET = os.getenv("SPOTIFY_CLIENT_SECRET")
+SPOTIFY_MATCH_CACHE_FILE = os.getenv("SPOTIFY_MATCH_CACHE_FILE", "spotify_matches.json")
+SPOTIFY_MATCH_CACHE_SIZE = int(os.getenv("SPOTIFY_MATCH_CACHE_SIZE", "5000"))
+METADATA_CACHE_FILE = os.getenv("METADATA_CACHE_FILE", "hinaa_cache.db")
+METADATA_CACHE_MEMORY_SIZE = int(os.getenv("METADATA_CACHE_MEMORY_SIZE", "1000"))
+METADATA_CACHE_DISK_SIZE = int(os.getenv("METADATA_CACHE_DISK_SIZE", "50000"))
+METADATA_CACHE_TTL = int(os.getenv("METADATA_CACHE_TTL", str(7 * 24 * 3600)))
+STREAM_URL_DEFAULT_TTL = 3600
+STREAM_URL_EXPIRY_MARGIN = 300
+PREFETCH_DEPTH = int(os.getenv("PREFETCH_DEPTH", "2"))
+PREFETCH_INTERVAL = 30
+IDLE_TIMEOUT = int(os.getenv("IDLE_TIMEOUT", "300"))
+IDLE_CHECK_INTERVAL = 30
+GUILD_MEMORY_TOP_N = 5
+YTDL_WORKERS = int(os.getenv("YTDL_WORKERS", str(min(4, os.cpu_count() or 1))))
+YTDL_START_METHOD = os.getenv("YTDL_START_METHOD", "forkserver")
+SPOTIFY_WORKERS = int(os.getenv("SPOTIFY_WORKERS", "4"))
+SPOTIFY_PAGE_SIZE = 100
+PROGRESS_UPDATE_INTERVAL = float(os.getenv("PROGRESS_UPDATE_INTERVAL", "5"))
+PROGRESS_EDITS_PER_SECOND = int(os.getenv("PROGRESS_EDITS_PER_SECOND", "4"))
+PROGRESS_MAX_BACKOFF = 60.0
+QUEUE_MAX_SIZE = int(os.getenv("QUEUE_MAX_SIZE", "1000"))
+PLAYLIST_IMPORT_LIMIT = int(os.getenv("PLAYLIST_IMPORT_LIMIT", "1000"))
+SPOTIFY_IMPORT_LIMIT = int(os.getenv("SPOTIFY_IMPORT_LIMIT", "50"))
+SESSION_JOURNAL_FILE = os.getenv(
+    "SESSION_JOURNAL_FILE", f"session_journal.{CLUSTER_ID}.jsonl" if CLUSTER_ID else "session_journal.jsonl"
+)
+SESSION_JOURNAL_COMPACT_LINES = int(os.getenv("SESSION_JOURNAL_COMPACT_LINES", "5000"))
+SESSION_JOURNAL_FLUSH_INTERVAL = 1.0
+SESSION_POSITION_INTERVAL = 15
+PLAYLIST_DB_FILE = os.getenv("PLAYLIST_DB_FILE", "playlists.db")
+PLAYLIST_JSON_FILE = "playlists.json"
+PLAYLIST_METADATA_TTL = int(os.getenv("PLAYLIST_METADATA_TTL", str(7 * 24 * 3600)))
+AUTOPLAY_PLAYLIST_ID = os.getenv("AUTOPLAY_PLAYLIST_ID", "37i9dQZF1DXcBWIGoYBM5M")
+AUTOPLAY_REFRESH_INTERVAL = int(os.getenv("AUTOPLAY_REFRESH_INTERVAL", "1800"))
+AUTOPLAY_HISTORY_SIZE = int(os.getenv("AUTOPLAY_HISTORY_SIZE", "50"))
+OPUS_PASSTHROUGH = os.getenv("OPUS_PASSTHROUGH", "1") == "1"
+AUDIO_BUFFER_FRAMES = int(os.getenv("AUDIO_BUFFER_MS", "2000")) // 20
+AUDIO_PREBUFFER_FRAMES = int(os.getenv("AUDIO_PREBUFFER_MS", "200")) // 20
+OPUS_SILENCE = b"\xf8\xff\xfe"
+VOLUME_RAMP_FRAMES = max(1, int(os.getenv("VOLUME_RAMP_MS", "100")) // 20)
+AUDIO_CACHE_DIR = os.getenv("AUDIO_CACHE_DIR", "audio_cache")
+AUDIO_CACHE_MAX_BYTES = int(os.getenv("AUDIO_CACHE_MAX_MB", "2048")) * 1024 * 1024
+AUDIO_CACHE_MIN_PLAYS = int(os.getenv("AUDIO_CACHE_MIN_PLAYS", "3"))
+AUDIO_CACHE_MAX_DURATION = 900
+AUDIO_CACHE_FILL_TIMEOUT = int(os.getenv("AUDIO_CACHE_FILL_TIMEOUT", "300"))
+LOUDNESS_NORMALIZE = os.getenv("LOUDNESS_NORMALIZE", "1") == "1"
+LOUDNESS_TARGET_LUFS = float(os.getenv("LOUDNESS_TARGET_LUFS", "-16"))
+LOUDNESS_TRUE_PEAK = -1.5
+LOUDNESS_MAX_BOOST_DB = 10.0
+LOUDNESS_MAX_CUT_DB = 20.0
+LOUDNESS_MIN_GAIN_DB = float(os.getenv("LOUDNESS_MIN_GAIN_DB", "1.0"))
+LOUDNESS_MAX_DURATION = 1800
+LOUDNESS_WORKERS = int(os.getenv("LOUDNESS_WORKERS", "1"))
+LOUDNESS_QUEUE_SIZE = 200
+LOUDNESS_TIMEOUT = int(os.getenv("LOUDNESS_TIMEOUT", "300"))
+LOUDNESS_RETRY_AFTER = 24 * 3600
+STATE_BACKEND = os.getenv("STATE_BACKEND", "memory").lower()
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+REDIS_KEY_PREFIX = os.getenv("REDIS_KEY_PREFIX", "hinaa")
+REDIS_LOAD_BATCH = 100
+CLUSTER_STATUS_DIR = os.getenv("CLUSTER_STATUS_DIR", "cluster_status")
+CLUSTER_STATUS_INTERVAL = 15
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+SEARCH_CANDIDATES = int(os.getenv("SEARCH_CANDIDATES", "8"))
+SEARCH_MAX_DURATION = 1800
+TRACE_BUFFER_SIZE = int(os.getenv("TRACE_BUFFER_SIZE", "50"))
+LOOP_LAG_INTERVAL = 0.1
+LOOP_LAG_SAMPLES = 3000
+LOOP_STALL_THRESHOLD = int(os.getenv("LOOP_STALL_THRESHOLD_MS", "100")) / 1000
+LOOP_STALL_HISTORY = 20
+LOOP_MONITOR_DEBUG = os.getenv("LOOP_MONITOR_DEBUG", "0") == "1"
+METRICS_LATENCY_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 15.0, 30.0)
 
 if not DISCORD_BOT_TOKEN:
     logger.error("DISCORD_BOT_TOKEN không được cấu hình!")
     exit(1)
 
+def format_labels(names: tuple, values: tuple) -> str:
+    if not names:
+        return ""
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+        pairs.append(f'{name}="{value}"')
+    return "{" + ",".join(pairs) + "}"
+
+class Counter:
+    def __init__(self, name: str, help_text: str, labels: tuple = ()):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.values = {}
+
+    def inc(self, amount: float = 1.0, **labels):
+        key = tuple(labels.get(label, "") for label in self.labels)
+        self.values[key] = self.values.get(key, 0.0) + amount
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        for key, value in self.values.items():
+            lines.append(f"{self.name}{format_labels(self.labels, key)} {value}")
+        return lines
+
+class Gauge:
+    # Giá trị được tính lúc Prometheus scrape: collect() trả về số, hoặc dict {nhãn: số} nếu có labels
+    metric_type = "gauge"
+
+    def __init__(self, name: str, help_text: str, collect, labels: tuple = ()):
+        self.name = name
+        self.help_text = help_text
+        self.collect = collect
+        self.labels = labels
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.metric_type}"]
+        values = self.collect()
+        if not self.labels:
+            values = {(): values}
+        for key, value in values.items():
+            lines.append(f"{self.name}{format_labels(self.labels, key)} {value}")
+        return lines
+
+class CollectedCounter(Gauge):
+    # Bộ đếm tăng dần do nơi khác giữ (vd. thời gian CPU của OS), đọc lúc scrape như Gauge
+    metric_type = "counter"
+
+class Histogram:
+    def __init__(self, name: str, help_text: str, labels: tuple = (), buckets: tuple = METRICS_LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.buckets = buckets
+        self.values = {}
+
+    def observe(self, value: float, **labels):
+        key = tuple(labels.get(label, "") for label in self.labels)
+        entry = self.values.get(key)
+        if entry is None:
+            entry = self.values[key] = {"buckets": [0] * len(self.buckets), "sum": 0.0, "count": 0}
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                entry["buckets"][i] += 1
+                break
+        entry["sum"] += value
+        entry["count"] += 1
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        for key, entry in self.values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, entry["buckets"]):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{format_labels(self.labels + ('le',), key + (bound,))} {cumulative}")
+            lines.append(f"{self.name}_bucket{format_labels(self.labels + ('le',), key + ('+Inf',))} {entry['count']}")
+            lines.append(f"{self.name}_sum{format_labels(self.labels, key)} {entry['sum']}")
+            lines.append(f"{self.name}_count{format_labels(self.labels, key)} {entry['count']}")
+        return lines
+
+class MetricsRegistry:
+    # Xuất số liệu dạng text của Prometheus qua HTTP (chỉ bật khi đặt METRICS_PORT)
+    def __init__(self):
+        self.metrics = []
+        self.runner = None
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            try:
+                lines.extend(metric.render())
+            except Exception as e:
+                logger.warning(f"Không thu thập được số liệu {metric.name}: {e}")
+        return "\n".join(lines) + "\n"
+
+    async def handle(self, request):
+        return web.Response(
+            body=self.render().encode("utf-8"),
+            headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"},
+        )
+
+    async def start(self, host: str, port: int):
+        if self.runner:
+            return
+        app = web.Application()
+        app.router.add_get("/metrics", self.handle)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, host, port).start()
+        logger.info(f"Metrics Prometheus tại http://{host}:{port}/metrics")
+
+class MetricsLogHandler(logging.Handler):
+    # Đếm mọi bản ghi log mức ERROR trở lên, kể cả lỗi đã được lệnh tự bắt và báo cho người dùng
+    def emit(self, record):
+        metric_errors.inc(level=record.levelname.lower())
+
+metrics = MetricsRegistry()
+metrics_process = psutil.Process()
+
+def process_cpu_seconds() -> float:
+    cpu_times = metrics_process.cpu_times()
+    return cpu_times.user + cpu_times.system
+
+def count_ffmpeg_processes() -> int:
+    count = 0
+    for child in metrics_process.children(recursive=True):
+        try:
+            if "ffmpeg" in child.name():
+                count += 1
+        except psutil.Error:
+            continue
+    return count
+
+metric_fetch_seconds = metrics.register(Histogram(
+    "hinaa_fetch_song_info_seconds", "Thời gian fetch_song_info_async", labels=("cache", "search")
+))
+metric_fetch_timeouts = metrics.register(Counter(
+    "hinaa_fetch_song_info_timeouts_total", "Số lần fetch_song_info_async quá hạn"
+))
+metric_spotify_seconds = metrics.register(Histogram(
+    "hinaa_spotify_call_seconds", "Thời gian mỗi lần gọi Spotify API", labels=("method",)
+))
+metric_spotify_errors = metrics.register(Counter(
+    "hinaa_spotify_call_errors_total", "Số lần gọi Spotify API bị lỗi", labels=("method",)
+))
+metric_commands = metrics.register(Counter("hinaa_commands_total", "Số lần gọi lệnh", labels=("command",)))
+metric_command_errors = metrics.register(Counter(
+    "hinaa_command_errors_total", "Lệnh lỗi không được bắt trong lệnh", labels=("command",)
+))
+metric_errors = metrics.register(Counter("hinaa_errors_total", "Số bản ghi log lỗi", labels=("level",)))
+metrics.register(Gauge(
+    "hinaa_queue_depth", "Số bài trong hàng đợi của từng server",
+    lambda: {(server_id,): len(queue) for server_id, queue in guild_state.queues.items() if queue},
+    labels=("guild",),
+))
+metrics.register(Gauge("hinaa_voice_clients", "Số kết nối voice đang mở", lambda: len(bot.voice_clients)))
+metrics.register(Gauge("hinaa_guilds", "Số server", lambda: len(bot.guilds)))
+metrics.register(Gauge("hinaa_ffmpeg_processes", "Số process ffmpeg đang chạy", count_ffmpeg_processes))
+metrics.register(Gauge("hinaa_process_resident_memory_bytes", "RSS của process", lambda: metrics_process.memory_info().rss))
+metrics.register(Gauge("hinaa_process_cpu_percent", "CPU của process (%)", lambda: metrics_process.cpu_percent()))
+metrics.register(CollectedCounter("hinaa_process_cpu_seconds_total", "Tổng thời gian CPU của process", process_cpu_seconds))
+if METRICS_PORT:
+    logger.addHandler(MetricsLogHandler(level=logging.ERROR))
+
+metric_play_stage_seconds = metrics.register(Histogram(
+    "hinaa_play_stage_seconds", "Thời gian từng giai đoạn từ lệnh phát tới gói âm thanh đầu tiên", labels=("stage",)
+))
+
+class Trace:
+    # Một yêu cầu phát nhạc: các span (tên, bắt đầu, thời lượng) tính từ lúc nhận lệnh tới gói âm thanh đầu tiên
+    def __init__(self, name: str, guild_id, query: str):
+        self.name = name
+        self.guild_id = guild_id
+        self.query = query
+        self.started_at = time.time()
+        self.started = time.perf_counter()
+        self.spans = []
+        self.total = None
+        self.outcome = None
+        self.awaiting_audio = False
+
+    def add(self, name: str, start: float, end: float):
+        if self.total is None:
+            self.spans.append((name, start - self.started, end - start))
+
+    @contextlib.contextmanager
+    def span(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, start, time.perf_counter())
+
+    def finish(self, outcome: str = "ok"):
+        if self.total is not None:
+            return
+        self.total = time.perf_counter() - self.started
+        self.outcome = self.outcome or outcome
+        for name, _, duration in self.spans:
+            metric_play_stage_seconds.observe(duration, stage=name)
+        metric_play_stage_seconds.observe(self.total, stage="total")
+        trace_buffer.add(self)
+
+    def breakdown(self) -> dict:
+        stages = {}
+        for name, _, duration in self.spans:
+            stages[name] = stages.get(name, 0.0) + duration
+        return stages
+
+    def to_dict(self) -> dict:
+        return {
+            "name": self.name,
+            "guild": self.guild_id,
+            "query": self.query,
+            "started_at": self.started_at,
+            "total": round(self.total or 0.0, 4),
+            "outcome": self.outcome,
+            "spans": [
+                {"name": name, "offset": round(offset, 4), "duration": round(duration, 4)}
+                for name, offset, duration in sorted(self.spans, key=lambda span: span[1])
+            ],
+        }
+
+class TraceBuffer:
+    # Giữ N trace gần nhất (ring buffer) và N trace chậm nhất (min-heap theo tổng thời gian)
+    def __init__(self, size: int):
+        self.size = size
+        self.recent = deque(maxlen=size)
+        self.slowest = []
+        self.sequence = itertools.count()
+        self.count = 0
+
+    def add(self, trace: Trace):
+        self.count += 1
+        self.recent.append(trace)
+        item = (trace.total, next(self.sequence), trace)
+        if len(self.slowest) < self.size:
+            heapq.heappush(self.slowest, item)
+        else:
+            heapq.heappushpop(self.slowest, item)
+
+    def slowest_traces(self, limit: int) -> list:
+        return [trace for _, _, trace in heapq.nlargest(limit, self.slowest)]
+
+    def export(self) -> str:
+        return json.dumps({
+            "count": self.count,
+            "slowest": [trace.to_dict() for trace in self.slowest_traces(self.size)],
+            "recent": [trace.to_dict() for trace in self.recent],
+        }, ensure_ascii=False, indent=2)
+
+trace_buffer = TraceBuffer(TRACE_BUFFER_SIZE)
+current_trace = contextvars.ContextVar("current_trace", default=None)
+
+def trace_span(name: str):
+    trace = current_trace.get()
+    return trace.span(name) if trace else contextlib.nullcontext()
+
+def traced(name: str):
+    # Bắt đầu trace cho coroutine (ctx, url, ...) nếu chưa nằm trong trace nào
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(ctx, *args, **kwargs):
+            active = current_trace.get()
+            if active and active.total is None:
+                return await func(ctx, *args, **kwargs)
+            trace = Trace(name, ctx.guild.id, str(args[0]) if args else "")
+            token = current_trace.set(trace)
+            try:
+                return await func(ctx, *args, **kwargs)
+            finally:
+                current_trace.reset(token)
+                if not trace.awaiting_audio:
+                    trace.finish("no_audio")
+        return wrapper
+    return decorator
+
+class TracedAudioSource(discord.AudioSource):
+    # Kết thúc trace khi voice client đọc gói âm thanh đầu tiên (chạy trên thread phát của discord.py)
+    def __init__(self, original: discord.AudioSource, trace: Trace):
+        self.original = original
+        self.trace = trace
+        self.loop = asyncio.get_running_loop()
+        self.play_started = time.perf_counter()
+        self.first_read = True
+
+    def read(self) -> bytes:
+        data = self.original.read()
+        if self.first_read:
+            self.first_read = False
+            self.loop.call_soon_threadsafe(self._first_packet, time.perf_counter())
+        return data
+
+    def _first_packet(self, at: float):
+        self.trace.add("first_packet", self.play_started, at)
+        self.trace.finish("ok")
+
+    def is_opus(self) -> bool:
+        return self.original.is_opus()
+
+    def cleanup(self):
+        self.original.cleanup()
+
+def trace_audio_source(source: discord.AudioSource) -> discord.AudioSource:
+    trace = current_trace.get()
+    if not trace or trace.total is not None:
+        return source
+    trace.awaiting_audio = True
+    return TracedAudioSource(source, trace)
+
+metric_loop_lag_seconds = metrics.register(Histogram(
+    "hinaa_event_loop_lag_seconds", "Độ trễ lập lịch của event loop",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0),
+))
+metric_loop_stalls = metrics.register(Counter(
+    "hinaa_event_loop_stalls_total", "Số lần event loop bị chặn lâu hơn ngưỡng"
+))
+metric_slow_steps = metrics.register(Counter(
+    "hinaa_slow_coroutine_steps_total", "Số bước coroutine chạy quá ngưỡng (chế độ debug)", labels=("command",)
+))
+current_command = contextvars.ContextVar("current_command", default=None)
+
+ASYNCIO_DIR = os.path.dirname(asyncio.__file__)
+
+def coroutine_frame(coro):
+    return getattr(coro, "cr_frame", None) or getattr(coro, "gi_frame", None) or getattr(coro, "ag_frame", None)
+
+def innermost_coroutine(coro):
+    # Lần theo chuỗi await (cr_await/gi_yieldfrom/ag_await) tới coroutine sâu nhất ngoài asyncio
+    # (asyncio.sleep, wait_for... chỉ là chỗ nhường loop, không phải đoạn code gây chặn)
+    found = coro
+    while True:
+        frame = coroutine_frame(coro)
+        if frame is None:
+            return found
+        if not frame.f_code.co_filename.startswith(ASYNCIO_DIR):
+            found = coro
+        coro = getattr(coro, "cr_await", None) or getattr(coro, "gi_yieldfrom", None) or getattr(coro, "ag_await", None)
+
+def coroutine_location(coro) -> str:
+    name = getattr(coro, "__qualname__", type(coro).__name__)
+    frame = coroutine_frame(coro)
+    return f"{name}:{frame.f_lineno}" if frame else name
+
+class TimedCoroutine(collections.abc.Coroutine):
+    # Bọc coroutine của task để đo thời gian mỗi bước send/throw (đoạn chạy liền không nhường event loop)
+    __slots__ = ("coro", "monitor")
+
+    def __init__(self, coro, monitor):
+        self.coro = coro
+        self.monitor = monitor
+
+    def send(self, value):
+        started = time.perf_counter()
+        try:
+            return self.coro.send(value)
+        finally:
+            self.monitor.observe_step(self.coro, time.perf_counter() - started)
+
+    def throw(self, *args):
+        started = time.perf_counter()
+        try:
+            return self.coro.throw(*args)
+        finally:
+            self.monitor.observe_step(self.coro, time.perf_counter() - started)
+
+    def close(self):
+        return self.coro.close()
+
+    def __await__(self):
+        return self.coro.__await__()
+
+class LoopMonitor:
+    # Lấy mẫu độ trễ lập lịch liên tục; một thread watchdog chụp stack của thread event loop khi
+    # loop không quay lại đúng hạn. Chế độ debug đo từng bước của mọi task và gán cho lệnh đã tạo ra nó.
+    def __init__(self, interval: float, threshold: float, sample_size: int):
+        self.interval = interval
+        self.threshold = threshold
+        self.samples = deque(maxlen=sample_size)
+        self.stalls = deque(maxlen=LOOP_STALL_HISTORY)
+        self.slow_steps = {}
+        self.stall_count = 0
+        self.heartbeat = time.monotonic()
+        self.loop_thread = None
+        self.task = None
+        self.watchdog = None
+        self.debug = False
+
+    def start(self, debug: bool = False):
+        if self.task and not self.task.done():
+            return
+        self.loop_thread = threading.get_ident()
+        self.heartbeat = time.monotonic()
+        self.task = asyncio.create_task(self.run())
+        if not self.watchdog:
+            self.watchdog = threading.Thread(target=self.watch, name="hinaa-loop-watchdog", daemon=True)
+            self.watchdog.start()
+        self.set_debug(debug)
+
+    async def run(self):
+        while True:
+            expected = time.monotonic() + self.interval
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            gap = now - self.heartbeat
+            self.heartbeat = now
+            lag = max(0.0, now - expected)
+            self.samples.append(lag)
+            metric_loop_lag_seconds.observe(lag)
+            if self.stalls and self.stalls[-1]["duration"] is None:
+                # Watchdog đã ghi lần chặn này; thời lượng tính từ nhịp trước, kể cả khi mẫu lag vừa đo nhỏ
+                self.stalls[-1]["duration"] = max(lag, gap - self.interval)
+
+    def watch(self):
+        reported = None
+        while True:
+            time.sleep(self.threshold / 4)
+            heartbeat = self.heartbeat
+            if time.monotonic() - heartbeat < self.interval + self.threshold or reported == heartbeat:
+                continue
+            reported = heartbeat
+            frame = sys._current_frames().get(self.loop_thread)
+            stack = "".join(traceback.format_stack(frame)) if frame else ""
+            self.stall_count += 1
+            metric_loop_stalls.inc()
+            self.stalls.append({"at": time.time(), "duration": None, "stack": stack})
+            logger.warning(f"Event loop bị chặn hơn {self.threshold * 1000:.0f}ms, stack hiện tại:\n{stack}")
+
+    def set_debug(self, enabled: bool):
+        self.debug = enabled
+        loop = asyncio.get_running_loop()
+        loop.set_task_factory(self.task_factory if enabled else None)
+
+    def task_factory(self, loop, coro, **kwargs):
+        # Chỉ các task tạo sau khi bật debug mới được đo
+        return asyncio.Task(TimedCoroutine(coro, self), loop=loop, **kwargs)
+
+    def observe_step(self, coro, elapsed: float):
+        if elapsed < self.threshold:
+            return
+        command = current_command.get() or "-"
+        # Coroutine ngoài cùng của task chỉ là _run_event/Command.invoke; gán cho chỗ await sâu nhất.
+        # Coroutine đã chạy xong thì chuỗi await không còn, đành dùng tên ngoài cùng
+        name = coroutine_location(innermost_coroutine(coro))
+        key = (command, name)
+        entry = self.slow_steps.get(key)
+        if entry is None:
+            entry = self.slow_steps[key] = {"count": 0, "total": 0.0, "max": 0.0}
+        entry["count"] += 1
+        entry["total"] += elapsed
+        entry["max"] = max(entry["max"], elapsed)
+        metric_slow_steps.inc(command=command)
+        logger.warning(f"Coroutine {name} (lệnh {command}) chặn event loop {elapsed * 1000:.0f}ms")
+
+    def percentiles(self) -> dict:
+        ordered = sorted(self.samples)
+        if not ordered:
+            return {"p50": 0.0, "p95": 0.0, "p99": 0.0, "max": 0.0}
+        last = len(ordered) - 1
+        return {
+            "p50": ordered[round(last * 0.50)],
+            "p95": ordered[round(last * 0.95)],
+            "p99": ordered[round(last * 0.99)],
+            "max": ordered[-1],
+        }
+
+    def slowest_steps(self, limit: int) -> list:
+        return sorted(self.slow_steps.items(), key=lambda item: item[1]["total"], reverse=True)[:limit]
+
+    def stats(self) -> dict:
+        stats = self.percentiles()
+        stats["stalls"] = self.stall_count
+        stats["debug"] = self.debug
+        return stats
+
+loop_monitor = LoopMonitor(LOOP_LAG_INTERVAL, LOOP_STALL_THRESHOLD, LOOP_LAG_SAMPLES)
+metrics.register(Gauge(
+    "hinaa_event_loop_lag_p99_seconds", "p99 độ trễ event loop trên cửa sổ mẫu gần nhất",
+    lambda: loop_monitor.percentiles()["p99"],
+))
+
+class AsyncSpotify:
+    # Gọi spotipy trên thread pool riêng để không chặn event loop,
+    # dùng chung một requests.Session để giữ kết nối (keep-alive)
+    def __init__(self, client_id: str, client_secret: str, workers: int):
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=workers, pool_maxsize=workers, max_retries=3)
+        session.mount("https://", adapter)
+        self.auth_manager = SpotifyClientCredentials(
+            client_id=client_id, client_secret=client_secret, requests_session=session
+        )
+        self.client = spotipy.Spotify(auth_manager=self.auth_manager, requests_session=session, requests_timeout=10)
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix="spotify")
+
+    async def _call(self, func, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        started = time.perf_counter()
+        try:
+            return await loop.run_in_executor(self.executor, functools.partial(func, *args, **kwargs))
+        except Exception:
+            metric_spotify_errors.inc(method=func.__name__)
+            raise
+        finally:
+            metric_spotify_seconds.observe(time.perf_counter() - started, method=func.__name__)
+
+    async def refresh_token(self):
+        await self._call(self.auth_manager.get_access_token, as_dict=False)
+
+    async def track(self, url: str, market: str = "VN") -> dict:
+        return await self._call(self.client.track, url, market=market)
+
+    async def playlist_tracks(self, url: str, market: str = "VN", limit: Optional[int] = None) -> list:
+        page_size = min(SPOTIFY_PAGE_SIZE, limit) if limit else SPOTIFY_PAGE_SIZE
+        first_page = await self._call(
+            self.client.playlist_items, url, market=market, additional_types=("track",), limit=page_size
+        )
+        total = first_page.get("total") or 0
+        if limit:
+            total = min(total, limit)
+        pages = await asyncio.gather(*(
+            self._call(
+                self.client.playlist_items, url, market=market, additional_types=("track",),
+                limit=min(page_size, total - offset), offset=offset
+            )
+            for offset in range(len(first_page["items"]), total, page_size)
+        ))
+        tracks = []
+        for page in (first_page, *pages):
+            for item in page["items"]:
+                track = item.get("track")
+                if track and track.get("id"):
+                    tracks.append(track)
+        return tracks[:limit] if limit else tracks
+
 # Kết nối Spotify
 try:
-    sp = spotipy.Spotify(auth_manager=SpotifyClientCredentials(client_id=SPOTIFY_CLIENT_ID, client_secret=SPOTIFY_CLIENT_SECRET))
+    sp = AsyncSpotify(SPOTIFY_CLIENT_ID, SPOTIFY_CLIENT_SECRET, SPOTIFY_WORKERS)
     logger.info("Kết nối thành công với Spotify API")
 except Exception as e:
     logger.error(f"Lỗi khi kết nối Spotify: {e}")
     sp = None
 
-# Biến toàn cục
-queues = {}
-current_song = {}
-autoplay_enabled = {}
-votes_to_skip = {}
-playlists = {}
+class QueueEntry:
+    # Mục hàng đợi chỉ giữ metadata; stream URL được phân giải gần lúc phát (prefetch)
+    __slots__ = ("url", "title", "artist", "duration", "key")
+
+    def __init__(self, url: str, title: str, artist: str, duration: int = 0):
+        self.url = url
+        self.title = title
+        self.artist = artist
+        self.duration = duration
+        self.key = canonical_url(url)
+
+    def record(self) -> list:
+        return [self.url, self.title, self.artist, self.duration]
+
+class GuildQueue:
+    # Hàng đợi của một server: deque + chỉ mục URL chuẩn hóa để kiểm tra trùng O(1)
+    def __init__(self, server_id, max_size: int):
+        self.server_id = server_id
+        self.max_size = max_size
+        self.entries = deque()
+        self.keys = set()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __iter__(self):
+        return iter(self.entries)
+
+    def __contains__(self, url: str) -> bool:
+        return canonical_url(url) in self.keys
+
+    def is_full(self) -> bool:
+        return len(self.entries) >= self.max_size
+
+    def add(self, url: str, title: str, artist: str, duration: int = 0) -> bool:
+        entry = QueueEntry(url, title, artist, duration)
+        if self.is_full() or entry.key in self.keys:
+            return False
+        self.entries.append(entry)
+        self.keys.add(entry.key)
+        guild_state.record(self.server_id, "add", entry=entry.record())
+        return True
+
+    def extend(self, items) -> int:
+        # Thêm nhiều bài (url, title, artist, duration) cùng lúc, ghi nhật ký một lần
+        added = []
+        for url, title, artist, duration in items:
+            if self.is_full():
+                break
+            entry = QueueEntry(url, title, artist, duration)
+            if entry.key in self.keys:
+                continue
+            self.entries.append(entry)
+            self.keys.add(entry.key)
+            added.append(entry.record())
+        if added:
+            guild_state.record(self.server_id, "extend", entries=added)
+        return len(added)
+
+    def pop_next(self) -> Optional[QueueEntry]:
+        if not self.entries:
+            return None
+        entry = self.entries.popleft()
+        self.keys.discard(entry.key)
+        guild_state.record(self.server_id, "pop")
+        return entry
+
+    def remove_at(self, index: int) -> Optional[QueueEntry]:
+        if not 0 <= index < len(self.entries):
+            return None
+        entry = self.entries[index]
+        del self.entries[index]
+        self.keys.discard(entry.key)
+        guild_state.record(self.server_id, "remove", index=index)
+        return entry
+
+    def clear(self):
+        self.entries.clear()
+        self.keys.clear()
+        guild_state.record(self.server_id, "clear")
+
+    def shuffle(self):
+        items = list(self.entries)
+        random.shuffle(items)
+        self.entries = deque(items)
+        guild_state.record(self.server_id, "reset", queue=self.snapshot())
+
+    def snapshot(self) -> list:
+        return [entry.record() for entry in self.entries]
+
+    def page(self, start: int, size: int) -> list:
+        return list(itertools.islice(self.entries, start, start + size))
+
+    def peek(self, count: int) -> list:
+        return self.page(0, count)
+
+def approximate_size(obj, seen: set = None) -> int:
+    # Ước lượng bộ nhớ của dữ liệu Python thuần (dict/list/set/deque/đối tượng __slots__ hoặc __dict__)
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, (str, bytes, int, float, bool, type(None))):
+        return size
+    if isinstance(obj, dict):
+        return size + sum(approximate_size(key, seen) + approximate_size(value, seen) for key, value in obj.items())
+    if isinstance(obj, (list, tuple, set, frozenset, deque)):
+        return size + sum(approximate_size(item, seen) for item in obj)
+    for name in getattr(type(obj), "__slots__", ()):
+        size += approximate_size(getattr(obj, name, None), seen)
+    if hasattr(obj, "__dict__") and type(obj).__module__ == __name__:
+        size += approximate_size(vars(obj), seen)
+    return size
+
+class GuildSession:
+    # Tài nguyên chỉ sống khi bot đang phục vụ một server: token phát, task chuẩn bị trước,
+    # view điều khiển. Hàng đợi/bài đang phát vẫn nằm trong guild_state để được lưu và khôi phục.
+    __slots__ = (
+        "server_id", "playback_token", "prefetched", "prefetch_task", "prefetch_wakeup",
+        "controls", "text_channel", "last_active",
+    )
+
+    def __init__(self, server_id):
+        self.server_id = server_id
+        self.playback_token = None
+        self.prefetched = {}
+        self.prefetch_task = None
+        self.prefetch_wakeup = None
+        self.controls = None
+        self.text_channel = None
+        self.last_active = time.monotonic()
+
+    def touch(self):
+        self.last_active = time.monotonic()
+
+    def set_controls(self, view):
+        # View cũ (timeout=None) được discord.py giữ mãi tới khi stop()
+        if self.controls:
+            self.controls.stop()
+        self.controls = view
+
+    def close(self):
+        self.playback_token = None
+        if self.prefetch_task and not self.prefetch_task.done():
+            self.prefetch_task.cancel()
+        self.prefetch_task = None
+        self.prefetch_wakeup = None
+        self.prefetched.clear()
+        self.set_controls(None)
+
+    def memory(self) -> int:
+        seen = {id(self.prefetch_task), id(self.prefetch_wakeup), id(self.controls)}
+        size = approximate_size(self, seen)
+        size += approximate_size(guild_state.peek_queue(self.server_id), seen)
+        size += approximate_size(guild_state.now_playing(self.server_id), seen)
+        return size
+
+class GuildSessions:
+    # Quản lý GuildSession; định kỳ ngắt kết nối server không phát gì (hoặc chỉ còn bot trong kênh)
+    # quá IDLE_TIMEOUT giây và giải phóng toàn bộ trạng thái của server đó
+    def __init__(self, idle_timeout: int, check_interval: int):
+        self.idle_timeout = idle_timeout
+        self.check_interval = check_interval
+        self.sessions = {}
+        self.task = None
+        self.idle_disconnects = 0
+        self.summary = None
+        self.summary_at = 0.0
+
+    def get(self, server_id) -> GuildSession:
+        session = self.sessions.get(server_id)
+        if session is None:
+            session = self.sessions[server_id] = GuildSession(server_id)
+        return session
+
+    def peek(self, server_id) -> Optional[GuildSession]:
+        return self.sessions.get(server_id)
+
+    def touch(self, server_id):
+        session = self.sessions.get(server_id)
+        if session:
+            session.touch()
+
+    def close(self, server_id):
+        session = self.sessions.pop(server_id, None)
+        if session:
+            session.close()
+        progress_scheduler.unregister(server_id)
+        guild_state.drop(server_id)
+        autoplay_engine.forget(server_id)
+
+    def start(self):
+        if self.idle_timeout and (not self.task or self.task.done()):
+            self.task = asyncio.create_task(self.run())
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.check_interval)
+            try:
+                await self.reap()
+            except Exception as e:
+                logger.exception(f"Lỗi khi dọn phiên server không hoạt động: {e}")
+
+    async def reap(self):
+        now = time.monotonic()
+        connected = set()
+        for voice_client in list(bot.voice_clients):
+            server_id = voice_client.guild.id
+            connected.add(server_id)
+            session = self.get(server_id)
+            listeners = any(not member.bot for member in voice_client.channel.members)
+            if listeners and (voice_client.is_playing() or voice_client.is_paused()):
+                session.touch()
+                continue
+            if now - session.last_active < self.idle_timeout:
+                continue
+            logger.info(f"Rời kênh voice ở server {server_id} sau {self.idle_timeout}s không hoạt động")
+            self.idle_disconnects += 1
+            channel = bot.get_channel(session.text_channel) if session.text_channel else None
+            self.close(server_id)
+            await voice_client.disconnect(force=True)
+            if channel:
+                embed = discord.Embed(description="💤 Hinaa rời kênh vì không ai nghe nhạc nữa! Gọi lại khi cần nha 😊", color=discord.Color.blue())
+                embed.set_footer(text="✨ Hinaa luôn sẵn sàng nè! ✨")
+                try:
+                    await channel.send(embed=embed)
+                except discord.errors.HTTPException:
+                    pass
+        for server_id, session in list(self.sessions.items()):
+            if server_id not in connected and now - session.last_active >= self.idle_timeout:
+                self.close(server_id)
+
+    def memory(self) -> dict:
+        return {server_id: session.memory() for server_id, session in self.sessions.items()}
+
+    def memory_summary(self) -> dict:
+        # Cho Prometheus: chỉ tổng và top N (nhãn rank cố định), tính lại tối đa mỗi check_interval giây
+        # thay vì duyệt mọi hàng đợi ở mỗi lần scrape; chi tiết từng server xem ở !stats
+        now = time.monotonic()
+        if self.summary is None or now - self.summary_at >= self.check_interval:
+            sizes = sorted(self.memory().values(), reverse=True)
+            self.summary = {"total": sum(sizes), "top": sizes[:GUILD_MEMORY_TOP_N]}
+            self.summary_at = now
+        return self.summary
+
+    def stats(self) -> dict:
+        return {
+            "sessions": len(self.sessions),
+            "idle_disconnects": self.idle_disconnects,
+        }
+
+guild_sessions = GuildSessions(IDLE_TIMEOUT, IDLE_CHECK_INTERVAL)
+metrics.register(Gauge(
+    "hinaa_guild_session_bytes_total", "Tổng bộ nhớ ước lượng của các phiên server (hàng đợi, bài đang phát, chuẩn bị trước)",
+    lambda: guild_sessions.memory_summary()["total"],
+))
+metrics.register(Gauge(
+    "hinaa_guild_session_bytes_top", f"Bộ nhớ ước lượng của {GUILD_MEMORY_TOP_N} phiên server lớn nhất, theo thứ hạng",
+    lambda: {(str(rank),): size for rank, size in enumerate(guild_sessions.memory_summary()["top"], start=1)},
+    labels=("rank",),
+))
+
+def get_queue(server_id) -> GuildQueue:
+    # Dùng khi thêm bài; chỉ kiểm tra thì dùng peek_queue để khỏi tạo hàng đợi rỗng
+    return guild_state.queue(server_id)
+
+def peek_queue(server_id) -> Optional[GuildQueue]:
+    return guild_state.peek_queue(server_id)
+
+def clear_current_song(server_id):
+    guild_state.clear_now_playing(server_id)
+
+def drop_guild_session(server_id):
+    guild_sessions.close(server_id)
 
 class MusicControls(discord.ui.View):
     def __init__(self, ctx):
@@ -123,7 +1048,7 @@ class MusicControls(discord.ui.View):
         server_id = self.ctx.guild.id
         if self.ctx.voice_client and (self.ctx.voice_client.is_playing() or self.ctx.voice_client.is_paused()):
             self.ctx.voice_client.stop()
-            current_song.pop(server_id, None)
+            clear_current_song(server_id)
             await interaction.followup.send("🎶 Nhạc đã dừng! 😊", ephemeral=True)
         else:
             await interaction.followup.send("🚫 Không có nhạc đang phát! 😅", ephemeral=True)
@@ -140,163 +1065,1944 @@ class MusicControls(discord.ui.View):
         if select.values[0] == "leave":
             if self.ctx.voice_client:
                 await self.ctx.voice_client.disconnect(force=True)
-                queues.pop(server_id, None)
-                current_song.pop(server_id, None)
+                drop_guild_session(server_id)
                 await interaction.followup.send("👋 Hinaa rời kênh rồi! 😊", ephemeral=True)
             else:
                 await interaction.followup.send("🚫 Bot chưa ở trong voice chat! 😅", ephemeral=True)
         elif select.values[0] == "clear_queue":
-            if server_id in queues and queues[server_id]:
-                queues[server_id].clear()
+            queue = peek_queue(server_id)
+            if queue:
+                queue.clear()
                 await interaction.followup.send("🗑️ Hàng đợi đã được xóa! 🎵", ephemeral=True)
             else:
                 await interaction.followup.send("🚫 Hàng đợi đã trống rồi! 😊", ephemeral=True)
         elif select.values[0] == "shuffle":
-            if server_id in queues and queues[server_id]:
-                random.shuffle(queues[server_id])
+            queue = peek_queue(server_id)
+            if queue:
+                queue.shuffle()
                 await interaction.followup.send("🎶 Đã xáo trộn hàng đợi! 🎵", ephemeral=True)
             else:
                 await interaction.followup.send("🚫 Hàng đợi trống, không có gì để xáo! 😊", ephemeral=True)
         elif select.values[0] == "autoplay":
-            autoplay_enabled[server_id] = not autoplay_enabled.get(server_id, False)
-            state = "bật" if autoplay_enabled[server_id] else "tắt"
-            await interaction.followup.send(f"🎶 Tự phát đã {state}! 😊", ephemeral=True)
+            enabled = not guild_state.autoplay_enabled(server_id)
+            guild_state.set_autoplay(server_id, enabled)
+            wake_prefetch(server_id)
+            status = "bật" if enabled else "tắt"
+            await interaction.followup.send(f"🎶 Tự phát đã {status}! 😊", ephemeral=True)
+
+def create_progress_bar(current, total):
+    if total == 0:
+        return "🔘────────── 0%"
+    progress = min(int((current / total) * 10), 10)
+    bar = "🔘" + "─" * progress + "─" * (10 - progress)
+    percentage = min(int((current / total) * 100), 100)
+    return f"{bar} {percentage}%"
+
+class ProgressScheduler:
+    # Một vòng lặp duy nhất cập nhật thanh tiến trình cho mọi server:
+    # giới hạn số lần edit mỗi giây, bỏ qua khi nội dung không đổi và lùi lại khi bị 429
+    def __init__(self, interval: float, edits_per_second: int):
+        self.interval = interval
+        self.edits_per_second = max(1, edits_per_second)
+        self.entries = {}
+        self.task = None
+        self.backoff = 0.0
+        self.backoff_until = 0.0
+        self.edit_times = deque()
+        self.edits = 0
+        self.skipped = 0
+        self.rate_limited = 0
+
+    def register(self, ctx, message, duration, start_time):
+        self.entries[ctx.guild.id] = {
+            "ctx": ctx,
+            "message": message,
+            "duration": duration,
+            "start_time": start_time,
+            "last_text": create_progress_bar(0, duration),
+            "next_at": time.monotonic() + self.interval * random.uniform(0.5, 1.0),
+        }
+        if not self.task or self.task.done():
+            self.task = asyncio.create_task(self.run())
+
+    def unregister(self, server_id):
+        self.entries.pop(server_id, None)
+
+    def edit_rate(self) -> float:
+        cutoff = time.monotonic() - 60
+        while self.edit_times and self.edit_times[0] < cutoff:
+            self.edit_times.popleft()
+        return len(self.edit_times) / 60
+
+    async def _edit(self, server_id, entry, text) -> bool:
+        embed = entry["message"].embeds[0]
+        embed.set_field_at(1, name="📊 𝗧𝗶ế𝗻 𝗧𝗿ì𝗻𝗵", value=text, inline=False)
+        try:
+            await entry["message"].edit(embed=embed)
+        except discord.errors.HTTPException as e:
+            if e.status != 429:
+                self.unregister(server_id)
+                return True
+            self.rate_limited += 1
+            self.backoff = min(max(self.backoff * 2, getattr(e, "retry_after", 0) or 1.0), PROGRESS_MAX_BACKOFF)
+            self.backoff_until = time.monotonic() + self.backoff
+            logger.warning(f"Bị giới hạn tốc độ khi cập nhật tiến trình, tạm dừng {self.backoff:.0f}s")
+            return False
+        self.backoff = 0.0
+        entry["last_text"] = text
+        self.edits += 1
+        self.edit_times.append(time.monotonic())
+        return True
+
+    async def run(self):
+        while self.entries:
+            await asyncio.sleep(max(1.0, self.backoff_until - time.monotonic()))
+            now = time.monotonic()
+            budget = self.edits_per_second
+            due = sorted(
+                (item for item in self.entries.items() if item[1]["next_at"] <= now),
+                key=lambda item: item[1]["next_at"]
+            )
+            for server_id, entry in due:
+                if self.entries.get(server_id) is not entry:
+                    continue
+                voice_client = entry["ctx"].voice_client
+                elapsed = (datetime.datetime.now() - entry["start_time"]).total_seconds()
+                if not voice_client or not (voice_client.is_playing() or voice_client.is_paused()) or elapsed >= entry["duration"]:
+                    self.unregister(server_id)
+                    continue
+                text = create_progress_bar(elapsed, entry["duration"])
+                if text == entry["last_text"]:
+                    self.skipped += 1
+                    entry["next_at"] = now + self.interval
+                    continue
+                if budget <= 0:
+                    break
+                budget -= 1
+                if not await self._edit(server_id, entry, text):
+                    break
+                entry["next_at"] = now + self.interval
+
+    def stats(self) -> dict:
+        return {
+            "active": len(self.entries),
+            "edits": self.edits,
+            "skipped": self.skipped,
+            "rate_limited": self.rate_limited,
+            "edit_rate": self.edit_rate(),
+        }
+
+progress_scheduler = ProgressScheduler(PROGRESS_UPDATE_INTERVAL, PROGRESS_EDITS_PER_SECOND)
+
+def update_progress(ctx, message, duration, start_time):
+    progress_scheduler.register(ctx, message, duration, start_time)
+
+def write_file_atomic(path: str, data: str):
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+def youtube_watch_url(video_id: str) -> str:
+    return f"https://www.youtube.com/watch?v={video_id}"
+
+class SpotifyMatchCache:
+    # Lưu ánh xạ Spotify track ID -> YouTube video ID, loại bỏ theo LRU
+    def __init__(self, path: str, max_entries: int):
+        self.path = path
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.loaded = False
+        self.dirty = False
+
+    def load(self):
+        if self.loaded:
+            return
+        self.loaded = True
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            for track_id, entry in data.get("entries", []):
+                if isinstance(entry, dict) and entry.get("video_id"):
+                    self.entries[track_id] = entry
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+            logger.info(f"Đã tải {len(self.entries)} bản ghi từ {self.path}")
+        except FileNotFoundError:
+            logger.info(f"Không tìm thấy {self.path}, khởi tạo cache Spotify rỗng")
+        except Exception as e:
+            logger.warning(f"File {self.path} bị hỏng, khởi tạo cache Spotify rỗng: {e}")
+            self.entries.clear()
+
+    def get(self, track_id: Optional[str]) -> Optional[dict]:
+        entry = self.entries.get(track_id) if track_id else None
+        if not entry:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(track_id)
+        entry["hits"] = entry.get("hits", 0) + 1
+        entry["last_used"] = time.time()
+        self.hits += 1
+        self.dirty = True
+        return entry
+
+    def put(self, track_id: Optional[str], song_info: dict):
+        if not track_id or not song_info.get("id"):
+            return
+        self.entries[track_id] = {
+            "video_id": song_info["id"],
+            "title": song_info["title"],
+            "artist": song_info["artist"],
+            "duration": song_info["duration"],
+            "thumbnail": song_info["thumbnail"],
+            "hits": 0,
+            "last_used": time.time(),
+        }
+        self.entries.move_to_end(track_id)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+        self.dirty = True
+
+    def discard(self, track_id: str):
+        if self.entries.pop(track_id, None):
+            self.dirty = True
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "size": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+
+    async def save(self):
+        if not self.dirty:
+            return
+        self.dirty = False
+        data = json.dumps({"entries": list(self.entries.items())}, ensure_ascii=False)
+        try:
+            await asyncio.to_thread(write_file_atomic, self.path, data)
+        except Exception as e:
+            self.dirty = True
+            logger.exception(f"Lỗi khi lưu cache Spotify: {e}")
+
+spotify_matches = SpotifyMatchCache(SPOTIFY_MATCH_CACHE_FILE, SPOTIFY_MATCH_CACHE_SIZE)
+
+class SessionJournal:
+    # Nhật ký append-only trạng thái phát của từng server, dùng để khôi phục sau khi khởi động lại.
+    # Bản ghi được gom lại và ghi xuống đĩa trên thread riêng, định kỳ nén thành snapshot.
+    def __init__(self, path: str, compact_lines: int):
+        self.path = path
+        self.compact_lines = compact_lines
+        self.pending = []
+        self.lines = 0
+
+    def record(self, server_id, op: str, **data):
+        if not self.path:
+            return
+        self.pending.append(json.dumps({"g": server_id, "op": op, **data}, ensure_ascii=False, separators=(",", ":")))
+
+    def _append(self, lines: list):
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.write("\n".join(lines) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    def _read(self) -> dict:
+        states = {}
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                lines = f.readlines()
+        except FileNotFoundError:
+            return states
+        self.lines = len(lines)
+        for line in lines:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            server_id = record.get("g")
+            op = record.get("op")
+            state = states.setdefault(server_id, {"queue": [], "now": None, "autoplay": False, "volume": 1.0})
+            if op == "snapshot":
+                states[server_id] = {
+                    "queue": record["queue"],
+                    "now": record["now"],
+                    "autoplay": record["autoplay"],
+                    "volume": record.get("volume", 1.0),
+                }
+            elif op == "add":
+                state["queue"].append(record["entry"])
+            elif op == "extend":
+                state["queue"].extend(record["entries"])
+            elif op == "pop" and state["queue"]:
+                state["queue"].pop(0)
+            elif op == "remove" and 0 <= record["index"] < len(state["queue"]):
+                state["queue"].pop(record["index"])
+            elif op == "clear":
+                state["queue"] = []
+            elif op == "reset":
+                state["queue"] = record["queue"]
+            elif op == "now":
+                state["now"] = record["song"]
+            elif op == "pos" and state["now"]:
+                state["now"]["offset"] = record["offset"]
+            elif op == "stop":
+                state["now"] = None
+            elif op == "autoplay":
+                state["autoplay"] = record["enabled"]
+            elif op == "volume":
+                state["volume"] = record["volume"]
+            elif op == "drop":
+                # Bot rời kênh: cài đặt của server vẫn được giữ như trong RAM
+                state["queue"] = []
+                state["now"] = None
+            elif op == "forget":
+                states.pop(server_id, None)
+        return {
+            server_id: state for server_id, state in states.items()
+            if state["queue"] or state["now"] or state["autoplay"] or state["volume"] != 1.0
+        }
+
+    async def replay(self) -> dict:
+        if not self.path:
+            return {}
+        try:
+            return await asyncio.to_thread(self._read)
+        except Exception as e:
+            logger.exception(f"Lỗi khi đọc nhật ký phiên: {e}")
+            return {}
+
+    def _snapshot_lines(self, sessions: dict) -> list:
+        return [
+            json.dumps({
+                "g": server_id,
+                "op": "snapshot",
+                "queue": session["queue"],
+                "now": session["now"],
+                "autoplay": session["autoplay"],
+                "volume": session["volume"],
+            }, ensure_ascii=False, separators=(",", ":"))
+            for server_id, session in sessions.items()
+            if session["queue"] or session["now"] or session["autoplay"] or session["volume"] != 1.0
+        ]
+
+    async def flush(self, snapshot, compact: bool = False):
+        # snapshot: hàm trả về trạng thái hiện tại của mọi server, chỉ gọi khi cần nén nhật ký
+        if not self.path:
+            return
+        if compact or self.lines + len(self.pending) >= self.compact_lines:
+            self.pending.clear()
+            lines = self._snapshot_lines(snapshot())
+            await asyncio.to_thread(write_file_atomic, self.path, "".join(line + "\n" for line in lines))
+            self.lines = len(lines)
+            return
+        if not self.pending:
+            return
+        lines, self.pending = self.pending, []
+        await asyncio.to_thread(self._append, lines)
+        self.lines += len(lines)
+
+session_journal = SessionJournal(SESSION_JOURNAL_FILE, SESSION_JOURNAL_COMPACT_LINES)
+
+def session_song_record(song: dict) -> dict:
+    return {
+        "url": song["url"],
+        "title": song["title"],
+        "artist": song["artist"],
+        "duration": song["duration"],
+        "thumbnail": song["thumbnail"],
+        "offset": round((datetime.datetime.now() - song["start_time"]).total_seconds(), 1),
+        "text_channel": song.get("text_channel"),
+        "voice_channel": song.get("voice_channel"),
+    }
+
+class MemoryStateBackend:
+    # Trạng thái phát của từng server (hàng đợi, bài đang phát, tự phát, vote skip, âm lượng) giữ trong RAM.
+    # Mọi thay đổi đi qua record()/touch(); bản này ghi vào nhật ký phiên để khôi phục sau khi khởi động lại.
+    name = "memory"
+
+    def __init__(self, journal: Optional[SessionJournal] = None):
+        self.journal = journal
+        self.queues = {}
+        self.current = {}
+        self.autoplay = {}
+        self.votes = {}
+        self.volumes = {}
+        self.task = None
+        self.last_positions = 0.0
+
+    def record(self, server_id, op: str, **data):
+        if self.journal:
+            self.journal.record(server_id, op, **data)
+        self.touch(server_id)
+
+    def touch(self, server_id):
+        # Thay đổi không cần ghi nhật ký (vote); backend dùng chung ghi lại cả server
+        pass
+
+    def queue(self, server_id) -> GuildQueue:
+        if server_id not in self.queues:
+            self.queues[server_id] = GuildQueue(server_id, QUEUE_MAX_SIZE)
+        return self.queues[server_id]
+
+    def peek_queue(self, server_id) -> Optional[GuildQueue]:
+        # Chỉ đọc: không tạo hàng đợi rỗng cho server chưa thêm bài nào
+        return self.queues.get(server_id)
+
+    def now_playing(self, server_id) -> Optional[dict]:
+        return self.current.get(server_id)
+
+    def now_playing_all(self) -> dict:
+        return self.current
+
+    def set_now_playing(self, server_id, song: dict):
+        self.current[server_id] = song
+        self.votes[server_id] = set()
+        self.record(server_id, "now", song=session_song_record(song))
+
+    def clear_now_playing(self, server_id):
+        if self.current.pop(server_id, None):
+            self.record(server_id, "stop")
+
+    def autoplay_enabled(self, server_id) -> bool:
+        return self.autoplay.get(server_id, False)
+
+    def set_autoplay(self, server_id, enabled: bool):
+        # Chỉ giữ giá trị khác mặc định để trạng thái không lớn dần theo mọi server từng dùng bot
+        if enabled:
+            self.autoplay[server_id] = True
+        else:
+            self.autoplay.pop(server_id, None)
+        self.record(server_id, "autoplay", enabled=enabled)
+
+    def add_vote(self, server_id, user_id) -> int:
+        votes = self.votes.setdefault(server_id, set())
+        votes.add(user_id)
+        self.touch(server_id)
+        return len(votes)
+
+    def clear_votes(self, server_id):
+        self.votes.pop(server_id, None)
+        self.touch(server_id)
+
+    def volume(self, server_id) -> float:
+        return self.volumes.get(server_id, 1.0)
+
+    def set_volume(self, server_id, volume: float):
+        if volume != 1.0:
+            self.volumes[server_id] = volume
+        else:
+            self.volumes.pop(server_id, None)
+        self.record(server_id, "volume", volume=volume)
+
+    def drop(self, server_id):
+        # Bot rời kênh: bỏ hàng đợi và bài đang phát, giữ cài đặt của server
+        self.queues.pop(server_id, None)
+        self.current.pop(server_id, None)
+        self.votes.pop(server_id, None)
+        self.record(server_id, "drop")
+
+    def forget(self, server_id):
+        # Bot bị xóa khỏi server: bỏ toàn bộ trạng thái
+        self.drop(server_id)
+        self.autoplay.pop(server_id, None)
+        self.volumes.pop(server_id, None)
+        self.record(server_id, "forget")
+
+    def session(self, server_id) -> Optional[dict]:
+        queue = self.queues.get(server_id)
+        song = self.current.get(server_id)
+        session = {
+            "queue": queue.snapshot() if queue else [],
+            "now": session_song_record(song) if song else None,
+            "autoplay": self.autoplay.get(server_id, False),
+            "volume": self.volumes.get(server_id, 1.0),
+            "votes": list(self.votes.get(server_id, ())),
+        }
+        if session["queue"] or session["now"] or session["autoplay"] or session["volume"] != 1.0:
+            return session
+        return None
+
+    def sessions(self) -> dict:
+        sessions = {}
+        for server_id in set(self.queues) | set(self.current) | set(self.autoplay) | set(self.volumes):
+            session = self.session(server_id)
+            if session:
+                sessions[server_id] = session
+        return sessions
+
+    def restore(self, server_id, session: dict):
+        queue = self.queue(server_id)
+        queue.extend(
+            (item[0], item[1], item[2], item[3] if len(item) > 3 else 0) for item in session["queue"]
+        )
+        if session.get("autoplay"):
+            self.set_autoplay(server_id, True)
+        if session.get("volume", 1.0) != 1.0:
+            self.set_volume(server_id, session["volume"])
+
+    async def load_sessions(self, server_ids: list) -> dict:
+        if not self.journal:
+            return {}
+        return await self.journal.replay()
+
+    async def flush(self, compact: bool = False):
+        if self.journal:
+            await self.journal.flush(self.sessions, compact=compact)
+
+    def _record_positions(self):
+        for server_id, song in self.current.items():
+            elapsed = (datetime.datetime.now() - song["start_time"]).total_seconds()
+            self.record(server_id, "pos", offset=round(elapsed, 1))
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(SESSION_JOURNAL_FLUSH_INTERVAL)
+            if time.monotonic() - self.last_positions >= SESSION_POSITION_INTERVAL:
+                self.last_positions = time.monotonic()
+                self._record_positions()
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.exception(f"Lỗi khi lưu trạng thái phiên ({self.name}): {e}")
+
+    def start(self):
+        if not self.task or self.task.done():
+            self.task = asyncio.create_task(self.run())
+
+    def stats(self) -> dict:
+        return {
+            "backend": self.name,
+            "queues": sum(1 for queue in self.queues.values() if queue),
+            "playing": len(self.current),
+        }
+
+class RedisStateBackend(MemoryStateBackend):
+    # Process đang giữ shard của server là nơi duy nhất ghi trạng thái server đó, nên đọc trực tiếp từ RAM.
+    # Thay đổi được gom lại và ghi dồn lên Redis mỗi giây bằng một pipeline; khi khởi động (hoặc tiếp quản
+    # shard của process khác) trạng thái được đọc theo lô bằng pipeline thay vì từng key một.
+    name = "redis"
+
+    def __init__(self, url: str, prefix: str, batch_size: int):
+        super().__init__()
+        self.redis = aioredis.from_url(url, decode_responses=True)
+        self.prefix = prefix
+        self.batch_size = batch_size
+        self.dirty = set()
+
+    def key(self, server_id) -> str:
+        return f"{self.prefix}:guild:{server_id}"
+
+    def touch(self, server_id):
+        self.dirty.add(server_id)
+
+    async def load_sessions(self, server_ids: list) -> dict:
+        sessions = {}
+        for start in range(0, len(server_ids), self.batch_size):
+            batch = server_ids[start:start + self.batch_size]
+            pipe = self.redis.pipeline(transaction=False)
+            for server_id in batch:
+                pipe.hgetall(self.key(server_id))
+            for server_id, data in zip(batch, await pipe.execute()):
+                if not data:
+                    continue
+                sessions[server_id] = {
+                    "queue": json.loads(data.get("queue") or "[]"),
+                    "now": json.loads(data.get("now") or "null"),
+                    "autoplay": data.get("autoplay") == "1",
+                    "volume": float(data.get("volume") or 1.0),
+                }
+        return sessions
+
+    async def flush(self, compact: bool = False):
+        if compact:
+            self.dirty |= set(self.queues) | set(self.current) | set(self.autoplay) | set(self.volumes)
+        if not self.dirty:
+            return
+        dirty, self.dirty = self.dirty, set()
+        pipe = self.redis.pipeline(transaction=False)
+        for server_id in dirty:
+            session = self.session(server_id)
+            if session is None:
+                pipe.delete(self.key(server_id))
+                pipe.srem(f"{self.prefix}:guilds", server_id)
+                continue
+            pipe.hset(self.key(server_id), mapping={
+                "queue": json.dumps(session["queue"], ensure_ascii=False),
+                "now": json.dumps(session["now"], ensure_ascii=False),
+                "autoplay": int(session["autoplay"]),
+                "volume": session["volume"],
+                "votes": json.dumps(session["votes"]),
+                "cluster": CLUSTER_ID or "",
+                "updated_at": time.time(),
+            })
+            pipe.sadd(f"{self.prefix}:guilds", server_id)
+        try:
+            await pipe.execute()
+        except Exception:
+            self.dirty |= dirty
+            raise
+
+    def stats(self) -> dict:
+        stats = super().stats()
+        stats["dirty"] = len(self.dirty)
+        return stats
+
+def create_state_backend() -> MemoryStateBackend:
+    if STATE_BACKEND == "redis":
+        if aioredis is None:
+            logger.error("STATE_BACKEND=redis nhưng chưa cài gói redis, dùng trạng thái trong RAM")
+        else:
+            return RedisStateBackend(REDIS_URL, REDIS_KEY_PREFIX, REDIS_LOAD_BATCH)
+    return MemoryStateBackend(session_journal)
+
+guild_state = create_state_backend()
+
+class ResumeContext:
+    # Ngữ cảnh tối thiểu thay cho commands.Context khi khôi phục phiên sau khởi động lại
+    def __init__(self, guild, channel):
+        self.guild = guild
+        self.channel = channel
+        self.author = guild.me
+
+    @property
+    def voice_client(self):
+        return self.guild.voice_client
+
+    async def send(self, *args, **kwargs):
+        return await self.channel.send(*args, **kwargs)
+
+def canonical_url(url: str) -> str:
+    parsed = urllib.parse.urlparse(url.strip())
+    if "youtu.be" in parsed.netloc:
+        video_id = parsed.path.lstrip("/").split("/")[0]
+        if video_id:
+            return youtube_watch_url(video_id)
+    if "youtube.com" in parsed.netloc and parsed.path == "/watch":
+        video_id = urllib.parse.parse_qs(parsed.query).get("v", [None])[0]
+        if video_id:
+            return youtube_watch_url(video_id)
+    if "spotify.com" in parsed.netloc:
+        return f"https://open.spotify.com{parsed.path.rstrip('/')}"
+    return url.strip()
+
+def stream_url_expiry(stream_url: str) -> float:
+    match = re.search(r"[?&/]expire[=/](\d+)", stream_url or "")
+    if match:
+        return float(match.group(1))
+    return time.time() + STREAM_URL_DEFAULT_TTL
+
+class MetadataCache:
+    # Cache 2 tầng: LRU trong RAM + SQLite trên đĩa.
+    # Metadata sống lâu (TTL), stream URL chỉ dùng tới khi sắp hết hạn.
+    def __init__(self, path: str, memory_size: int, disk_size: int, ttl: int):
+        self.path = path
+        self.memory_size = memory_size
+        self.disk_size = disk_size
+        self.ttl = ttl
+        self.memory = OrderedDict()
+        self.db = None
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="metadata-cache")
+        self.puts_since_trim = 0
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.stream_expired = 0
+
+    def _connect(self):
+        if self.db is None:
+            self.db = sqlite3.connect(self.path, check_same_thread=False)
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("PRAGMA synchronous=NORMAL")
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS metadata ("
+                "key TEXT PRIMARY KEY, data TEXT NOT NULL, meta_expires REAL NOT NULL, last_used REAL NOT NULL)"
+            )
+            self.db.execute("CREATE INDEX IF NOT EXISTS metadata_last_used ON metadata(last_used)")
+        return self.db
+
+    def _disk_get(self, key: str) -> Optional[dict]:
+        db = self._connect()
+        row = db.execute("SELECT data, meta_expires FROM metadata WHERE key = ?", (key,)).fetchone()
+        if not row:
+            return None
+        if row[1] < time.time():
+            db.execute("DELETE FROM metadata WHERE key = ?", (key,))
+            db.commit()
+            return None
+        db.execute("UPDATE metadata SET last_used = ? WHERE key = ?", (time.time(), key))
+        db.commit()
+        return json.loads(row[0])
+
+    def _disk_put(self, key: str, entry: dict, trim: bool):
+        db = self._connect()
+        now = time.time()
+        db.execute(
+            "INSERT OR REPLACE INTO metadata (key, data, meta_expires, last_used) VALUES (?, ?, ?, ?)",
+            (key, json.dumps(entry, ensure_ascii=False), entry["meta_expires"], now),
+        )
+        if trim:
+            db.execute("DELETE FROM metadata WHERE meta_expires < ?", (now,))
+            db.execute(
+                "DELETE FROM metadata WHERE key IN ("
+                "SELECT key FROM metadata ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+                (self.disk_size,),
+            )
+        db.commit()
+
+    def _disk_size(self) -> int:
+        return self._connect().execute("SELECT COUNT(*) FROM metadata").fetchone()[0]
+
+    def _remember(self, key: str, entry: dict):
+        self.memory[key] = entry
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.memory_size:
+            self.memory.popitem(last=False)
+
+    def _to_song_info(self, entry: dict, need_stream: bool) -> Optional[dict]:
+        stream_valid = entry.get("expires_at", 0) - STREAM_URL_EXPIRY_MARGIN > time.time()
+        if need_stream and not stream_valid:
+            self.stream_expired += 1
+            return None
+        song_info = dict(entry["meta"])
+        song_info["url"] = entry["url"] if stream_valid else None
+        song_info["acodec"] = entry.get("acodec") if stream_valid else None
+        song_info["expires_at"] = entry.get("expires_at", 0)
+        return song_info
+
+    async def get(self, key: str, need_stream: bool = True) -> Optional[dict]:
+        entry = self.memory.get(key)
+        if entry and entry["meta_expires"] < time.time():
+            self.memory.pop(key, None)
+            entry = None
+        if entry:
+            self.memory.move_to_end(key)
+            song_info = self._to_song_info(entry, need_stream)
+            if song_info:
+                self.memory_hits += 1
+                return song_info
+            return None
+        loop = asyncio.get_running_loop()
+        try:
+            entry = await loop.run_in_executor(self.executor, self._disk_get, key)
+        except Exception as e:
+            logger.warning(f"Lỗi khi đọc cache metadata: {e}")
+            entry = None
+        if not entry:
+            self.misses += 1
+            return None
+        self._remember(key, entry)
+        song_info = self._to_song_info(entry, need_stream)
+        if song_info:
+            self.disk_hits += 1
+        return song_info
+
+    async def put(self, key: str, song_info: dict):
+        entry = {
+            "meta": {k: song_info.get(k) for k in ("id", "title", "artist", "duration", "thumbnail")},
+            "url": song_info.get("url"),
+            "acodec": song_info.get("acodec"),
+            "expires_at": song_info.get("expires_at") or (stream_url_expiry(song_info["url"]) if song_info.get("url") else 0),
+            "meta_expires": time.time() + self.ttl,
+        }
+        self._remember(key, entry)
+        self.puts_since_trim += 1
+        trim = self.puts_since_trim >= 100
+        if trim:
+            self.puts_since_trim = 0
+        loop = asyncio.get_running_loop()
+        try:
+            await loop.run_in_executor(self.executor, self._disk_put, key, entry, trim)
+        except Exception as e:
+            logger.warning(f"Lỗi khi ghi cache metadata: {e}")
+
+    async def stats(self) -> dict:
+        loop = asyncio.get_running_loop()
+        try:
+            disk_size = await loop.run_in_executor(self.executor, self._disk_size)
+        except Exception:
+            disk_size = 0
+        hits = self.memory_hits + self.disk_hits
+        total = hits + self.misses + self.stream_expired
+        return {
+            "memory_size": len(self.memory),
+            "disk_size": disk_size,
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "stream_expired": self.stream_expired,
+            "hit_rate": hits / total if total else 0.0,
+        }
+
+metadata_cache = MetadataCache(
+    METADATA_CACHE_FILE, METADATA_CACHE_MEMORY_SIZE, METADATA_CACHE_DISK_SIZE, METADATA_CACHE_TTL
+)
+
+class ExtractionPool:
+    # Pool process riêng cho yt-dlp: worker bị treo quá hạn sẽ bị kill và thay mới.
+    # Không fork process bot (đang chạy nhiều thread, con có thể thừa hưởng lock đang bị giữ):
+    # mặc định dùng forkserver, và kill/tạo worker chạy trên thread riêng để không chặn event loop.
+    # Worker chạy ytdl_worker.extraction_worker, module chỉ import yt_dlp nên khởi động nhanh.
+    def __init__(self, size: int, start_method: str, factory=None):
+        self.size = max(1, size)
+        self.factory = factory
+        methods = multiprocessing.get_all_start_methods()
+        self.context = multiprocessing.get_context(start_method if start_method in methods else "spawn")
+        if self.context.get_start_method() == "forkserver":
+            self.context.set_forkserver_preload(["ytdl_worker"])
+        self.waiter = concurrent.futures.ThreadPoolExecutor(max_workers=self.size, thread_name_prefix="ytdl-waiter")
+        self.spawner = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="ytdl-spawn")
+        self.idle = None
+        self.busy = 0
+        self.timeouts = 0
+        self.restarts = 0
+
+    def _spawn(self) -> dict:
+        parent_conn, child_conn = self.context.Pipe()
+        process = self.context.Process(target=extraction_worker, args=(child_conn, self.factory), daemon=True)
+        process.start()
+        child_conn.close()
+        return {"process": process, "conn": parent_conn}
+
+    def _kill(self, worker: dict):
+        try:
+            worker["conn"].close()
+        except OSError:
+            pass
+        worker["process"].kill()
+        worker["process"].join(timeout=1)
+
+    def _respawn(self, worker: Optional[dict]) -> dict:
+        if worker:
+            self._kill(worker)
+        return self._spawn()
+
+    async def _replace(self, worker: Optional[dict]):
+        # Đưa worker mới vào hàng chờ khi tạo xong; người gọi không phải đợi
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                worker = await loop.run_in_executor(self.spawner, self._respawn, worker)
+                break
+            except Exception as e:
+                logger.exception(f"Không tạo được worker yt-dlp, thử lại sau 5s: {e}")
+                worker = None
+                await asyncio.sleep(5)
+        self.idle.put_nowait(worker)
+
+    def start(self):
+        if self.idle is not None:
+            return
+        # Process con (forkserver/spawn) mặc định import lại script chính thành __mp_main__, tức chạy lại
+        # toàn bộ phần khởi tạo của main.py (log, discord, cache...). Worker chỉ cần ytdl_worker:
+        # gắn spec "__main__" để multiprocessing bỏ qua bước đó, như khi chạy một package __main__.py
+        main_module = sys.modules["__main__"]
+        if getattr(main_module, "__spec__", None) is None:
+            main_module.__spec__ = importlib.machinery.ModuleSpec("__main__", None)
+        self.idle = asyncio.Queue()
+        for _ in range(self.size):
+            asyncio.create_task(self._replace(None))
+        logger.info(f"Đang khởi động {self.size} worker yt-dlp ({self.context.get_start_method()})")
+
+    @staticmethod
+    def _roundtrip(worker: dict, request: tuple, timeout: float):
+        worker["conn"].send(request)
+        if not worker["conn"].poll(timeout):
+            return None
+        return worker["conn"].recv()
+
+    async def extract(self, url: str, ydl_opts: dict, timeout: float) -> Optional[dict]:
+        # timeout tính cho cả thời gian chờ worker rảnh lẫn thời gian trích xuất
+        self.start()
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while True:
+            try:
+                worker = await asyncio.wait_for(self.idle.get(), max(0.0, deadline - loop.time()))
+            except asyncio.TimeoutError:
+                self.timeouts += 1
+                logger.warning(f"Không có worker yt-dlp rảnh sau {timeout}s cho {url}")
+                raise
+            if worker["process"].is_alive():
+                break
+            self.restarts += 1
+            asyncio.create_task(self._replace(worker))
+        healthy = False
+        self.busy += 1
+        try:
+            request = (json.dumps(ydl_opts, sort_keys=True), ydl_opts, url)
+            remaining = max(0.0, deadline - loop.time())
+            result = await loop.run_in_executor(self.waiter, self._roundtrip, worker, request, remaining)
+            if result is None:
+                self.timeouts += 1
+                logger.warning(f"Worker yt-dlp quá hạn {timeout}s với {url}, khởi động lại worker")
+                raise asyncio.TimeoutError()
+            healthy = True
+            status, payload = result
+            if status == "error":
+                raise RuntimeError(payload)
+            return payload
+        finally:
+            self.busy -= 1
+            if healthy:
+                self.idle.put_nowait(worker)
+            else:
+                self.restarts += 1
+                asyncio.create_task(self._replace(worker))
+
+    def stats(self) -> dict:
+        return {"size": self.size, "busy": self.busy, "timeouts": self.timeouts, "restarts": self.restarts}
+
+extraction_pool = ExtractionPool(YTDL_WORKERS, YTDL_START_METHOD)
+
+def song_info_from_entry(entry: dict) -> dict:
+    return {
+        "url": entry["url"],
+        "id": entry.get("id"),
+        "title": entry.get("title", "Unknown Title"),
+        "artist": entry.get("uploader", "Unknown Artist"),
+        "duration": entry.get("duration", 0),
+        "thumbnail": entry.get("thumbnail", "https://i.imgur.com/5z1oX0Z.png"),
+        "acodec": entry.get("acodec"),
+        "expires_at": stream_url_expiry(entry["url"]),
+    }
+
+SEARCH_PENALTY_WORDS = ("cover", "remix", "live", "karaoke", "nightcore", "sped", "slowed", "reverb", "8d", "1 hour")
+
+def rank_search_results(query: str, entries: list) -> Optional[dict]:
+    # Chấm điểm kết quả tìm kiếm dạng flat (không cần phân giải định dạng):
+    # ưu tiên tiêu đề khớp từ khóa và thứ hạng của YouTube, tránh livestream, video quá dài và bản biến tấu
+    query_lower = query.lower()
+    query_words = set(re.findall(r"\w+", query_lower))
+    best, best_score = None, None
+    for position, entry in enumerate(entries):
+        title = (entry.get("title") or "").lower()
+        score = len(query_words & set(re.findall(r"\w+", title))) / len(query_words) if query_words else 0.0
+        score -= position * 0.1
+        if entry.get("live_status") in ("is_live", "is_upcoming"):
+            score -= 5
+        duration = entry.get("duration") or 0
+        if not duration or duration > SEARCH_MAX_DURATION:
+            score -= 1
+        if any(word in title and word not in query_lower for word in SEARCH_PENALTY_WORDS):
+            score -= 0.5
+        if best_score is None or score > best_score:
+            best, best_score = entry, score
+    return best
+
+async def search_track(query: str) -> Optional[dict]:
+    # Tìm dạng flat: chỉ liệt kê ứng viên, không phân giải stream của từng video.
+    # Kết quả (video ID + metadata, không có stream URL) được cache theo query.
+    cache_key = f"search:{query.strip().lower()}"
+    with trace_span("metadata_cache"):
+        cached = await metadata_cache.get(cache_key, need_stream=False)
+    if cached and cached.get("id"):
+        return cached
+    ydl_opts = {
+        "extract_flat": True,
+        "quiet": True,
+        "no_warnings": True,
+        "ignoreerrors": True,
+        "default_search": f"ytsearch{SEARCH_CANDIDATES}",
+    }
+    try:
+        with trace_span("ytdl_search"):
+            info = await extraction_pool.extract(query, ydl_opts, timeout=10.0)
+    except asyncio.TimeoutError:
+        metric_fetch_timeouts.inc()
+        logger.warning(f"Timeout khi tìm kiếm: {query}")
+        return None
+    except Exception as e:
+        logger.exception(f"Lỗi khi tìm kiếm: {e}")
+        return None
+    entries = [entry for entry in (info or {}).get("entries") or [] if entry and entry.get("id")]
+    best = rank_search_results(query, entries)
+    if not best:
+        logger.warning(f"Không tìm thấy kết quả cho: {query}")
+        return None
+    match = {
+        "url": None,
+        "id": best["id"],
+        "title": best.get("title") or "Unknown Title",
+        "artist": best.get("uploader") or best.get("channel") or "Unknown Artist",
+        "duration": best.get("duration") or 0,
+        "thumbnail": f"https://i.ytimg.com/vi/{best['id']}/hqdefault.jpg",
+        "acodec": None,
+        "expires_at": 0,
+    }
+    await metadata_cache.put(cache_key, match)
+    return match
+
+async def fetch_song_info_async(url: str, is_search: bool = False, need_stream: bool = True) -> Optional[dict]:
+    started = time.perf_counter()
+    cache = "hit"
+    try:
+        if is_search:
+            match = await search_track(url)
+            if not match or not need_stream:
+                return match
+            url = youtube_watch_url(match["id"])
+        cache_key = canonical_url(url)
+        with trace_span("metadata_cache"):
+            cached = await metadata_cache.get(cache_key, need_stream)
+        if cached:
+            return cached
+        cache = "miss"
+        return await extract_song_info(url, cache_key)
+    finally:
+        metric_fetch_seconds.observe(time.perf_counter() - started, cache=cache, search=str(is_search).lower())
+
+async def extract_song_info(url: str, cache_key: str) -> Optional[dict]:
+    ydl_opts = {
+        "format": "bestaudio/best",
+        "noplaylist": True,
+        "quiet": True,
+        "no_warnings": True,
+        "simulate": True,
+        "skip_download": True,
+        "ignoreerrors": True,
+    }
+    try:
+        with trace_span("ytdl_extract"):
+            info = await extraction_pool.extract(url, ydl_opts, timeout=10.0)
+        if not info or not info.get("url"):
+            logger.warning(f"Không lấy được thông tin từ URL: {url}")
+            return None
+        song_info = song_info_from_entry(info)
+        await metadata_cache.put(cache_key, song_info)
+        return song_info
+    except asyncio.TimeoutError:
+        metric_fetch_timeouts.inc()
+        logger.warning(f"Timeout khi tải thông tin bài hát: {url}")
+        return None
+    except Exception as e:
+        logger.exception(f"Lỗi khi tải thông tin bài hát: {e}")
+        return None
+
+async def is_valid_url(url: str) -> bool:
+    with trace_span("is_valid_url"):
+        try:
+            parsed = urllib.parse.urlparse(url)
+            if not parsed.scheme in ["http", "https"]:
+                return False
+            if "youtube.com" in parsed.netloc or "youtu.be" in parsed.netloc:
+                return bool(re.match(r"^(https?://)?(www\.)?(youtube\.com|youtu\.be)/", url))
+            if "spotify.com" in parsed.netloc:
+                return bool(re.match(r"^(https?://)?open\.spotify\.com/(track|playlist)/", url))
+            return False
+        except Exception:
+            return False
+
+async def handle_spotify(ctx, url: str) -> dict:
+    if not sp:
+        raise ValueError("Spotify API chưa kết nối!")
+    try:
+        if "track" in url:
+            with trace_span("spotify_api"):
+                track = await sp.track(url, market="VN")
+            return {
+                "track_id": track["id"],
+                "title": track["name"],
+                "artist": track["artists"][0]["name"],
+                "search_query": f"{track['name']} {track['artists'][0]['name']} audio",
+            }
+        elif "playlist" in url:
+            server_id = ctx.guild.id
+            queue = get_queue(server_id)
+            remaining = min(queue.max_size - len(queue), SPOTIFY_IMPORT_LIMIT)
+            with trace_span("spotify_api"):
+                tracks = await sp.playlist_tracks(url, market="VN", limit=remaining) if remaining > 0 else []
+            valid_tracks = 0
+            for track in tracks:
+                track_url = track["external_urls"]["spotify"]
+                if track_url in queue:
+                    continue
+                if await is_valid_url(track_url):
+                    song_info = spotify_matches.get(track["id"])
+                    if not song_info:
+                        song_info = await fetch_song_info_async(
+                            f"{track['name']} {track['artists'][0]['name']} audio",
+                            is_search=True,
+                            need_stream=False
+                        )
+                        if song_info:
+                            spotify_matches.put(track["id"], song_info)
+                    if song_info and queue.add(track_url, song_info["title"], song_info["artist"], song_info.get("duration") or 0):
+                        valid_tracks += 1
+            await spotify_matches.save()
+            return {"is_playlist": True, "count": valid_tracks}
+        else:
+            raise ValueError("Chỉ hỗ trợ track/playlist Spotify!")
+    except Exception as e:
+        logger.exception(f"Lỗi khi xử lý Spotify: {e}")
+        raise ValueError("Lỗi khi xử lý Spotify, thử lại nhé!")
+
+async def match_spotify_track(spotify_data: dict) -> Optional[dict]:
+    track_id = spotify_data.get("track_id")
+    match = spotify_matches.get(track_id)
+    if match:
+        song_info = await fetch_song_info_async(youtube_watch_url(match["video_id"]))
+        if song_info:
+            await spotify_matches.save()
+            return song_info
+        logger.warning(f"Video {match['video_id']} đã lưu cho track {track_id} không còn khả dụng, tìm lại")
+        spotify_matches.discard(track_id)
+    song_info = await fetch_song_info_async(spotify_data["search_query"], is_search=True)
+    if song_info:
+        spotify_matches.put(track_id, song_info)
+    await spotify_matches.save()
+    return song_info
+
+class AutoplayEngine:
+    # Kho bài ứng viên cho tự phát: lấy từ playlist Spotify và làm mới định kỳ,
+    # ghép sẵn với video YouTube ở nền, chọn bài tránh lặp theo lịch sử phát của từng server
+    def __init__(self, playlist_id: str, refresh_interval: int, history_size: int):
+        self.playlist_id = playlist_id
+        self.refresh_interval = refresh_interval
+        self.history_size = history_size
+        self.candidates = []
+        self.refreshed_at = 0.0
+        self.history = {}
+        self.ready = {}
+        self.lock = asyncio.Lock()
+        self.match_task = None
+
+    async def refresh(self):
+        async with self.lock:
+            if self.candidates and time.time() - self.refreshed_at < self.refresh_interval:
+                return
+            tracks = await sp.playlist_tracks(self.playlist_id, market="VN")
+            self.candidates = [
+                {
+                    "url": track["external_urls"]["spotify"],
+                    "track_id": track["id"],
+                    "search_query": f"{track['name']} {track['artists'][0]['name']} audio",
+                }
+                for track in tracks if track.get("artists")
+            ]
+            self.refreshed_at = time.time()
+            logger.info(f"Đã làm mới {len(self.candidates)} bài ứng viên cho tự phát")
+        if not self.match_task or self.match_task.done():
+            self.match_task = asyncio.create_task(self._prematch())
+
+    async def _prematch(self):
+        for candidate in list(self.candidates):
+            if candidate["track_id"] in spotify_matches.entries:
+                continue
+            song_info = await fetch_song_info_async(candidate["search_query"], is_search=True, need_stream=False)
+            if song_info:
+                spotify_matches.put(candidate["track_id"], song_info)
+            await asyncio.sleep(1)
+        await spotify_matches.save()
+
+    def record_play(self, server_id, url: str):
+        history = self.history.setdefault(server_id, deque(maxlen=self.history_size))
+        history.append(canonical_url(url))
+
+    def forget(self, server_id):
+        self.history.pop(server_id, None)
+        self.ready.pop(server_id, None)
+
+    def _pick(self, server_id) -> Optional[dict]:
+        played = set(self.history.get(server_id, ()))
+        fresh = [candidate for candidate in self.candidates if canonical_url(candidate["url"]) not in played]
+        pool = fresh or self.candidates
+        matched = [candidate for candidate in pool if candidate["track_id"] in spotify_matches.entries]
+        pool = matched or pool
+        return random.choice(pool) if pool else None
+
+    async def prepare(self, server_id) -> Optional[tuple]:
+        ready = self.ready.get(server_id)
+        if ready and is_stream_fresh(ready[1]):
+            return ready
+        await self.refresh()
+        candidate = self._pick(server_id)
+        if not candidate:
+            return None
+        song_info = await match_spotify_track(candidate)
+        if not song_info or not song_info.get("url"):
+            return None
+        self.ready[server_id] = (candidate["url"], song_info)
+        logger.info(f"Đã chuẩn bị trước bài tự phát: {song_info['title']}")
+        return self.ready[server_id]
+
+    async def next_track(self, server_id) -> Optional[tuple]:
+        ready = await self.prepare(server_id)
+        self.ready.pop(server_id, None)
+        return ready
+
+    def stats(self) -> dict:
+        matched = sum(1 for candidate in self.candidates if candidate["track_id"] in spotify_matches.entries)
+        return {"candidates": len(self.candidates), "matched": matched, "ready": len(self.ready)}
+
+autoplay_engine = AutoplayEngine(AUTOPLAY_PLAYLIST_ID, AUTOPLAY_REFRESH_INTERVAL, AUTOPLAY_HISTORY_SIZE)
+
+class AudioCache:
+    # Cache file Ogg/Opus của các bài được phát nhiều, giới hạn theo tổng dung lượng và loại bỏ theo LRU.
+    # Số lần phát được lưu trong SQLite; bài đạt ngưỡng sẽ được tải về ở nền.
+    def __init__(self, directory: str, db_path: str, max_bytes: int, min_plays: int):
+        self.directory = directory
+        self.db_path = db_path
+        self.max_bytes = max_bytes
+        self.min_plays = min_plays
+        self.db = None
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="audio-cache")
+        self.loaded = False
+        self.files = OrderedDict()
+        self.total_bytes = 0
+        self.filling = set()
+        self.fill_lock = asyncio.Semaphore(1)
+        self.hits = 0
+        self.misses = 0
+        self.fills = 0
+        self.evictions = 0
+
+    def path_for(self, video_id: str) -> str:
+        return os.path.join(self.directory, f"{video_id}.ogg")
+
+    def _connect(self):
+        if self.db is None:
+            self.db = sqlite3.connect(self.db_path, check_same_thread=False)
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS audio_plays ("
+                "video_id TEXT PRIMARY KEY, plays INTEGER NOT NULL, last_used REAL NOT NULL)"
+            )
+        return self.db
+
+    def _load(self) -> list:
+        os.makedirs(self.directory, exist_ok=True)
+        db = self._connect()
+        last_used = dict(db.execute("SELECT video_id, last_used FROM audio_plays"))
+        files = []
+        for filename in os.listdir(self.directory):
+            path = os.path.join(self.directory, filename)
+            if filename.endswith(".part"):
+                # File tạm có thể đang được process khác trong cluster ghi, chỉ xóa file cũ
+                if time.time() - os.path.getmtime(path) > 3600:
+                    os.remove(path)
+                continue
+            if filename.endswith(".ogg"):
+                video_id = filename[:-4]
+                files.append((last_used.get(video_id, 0), video_id, os.path.getsize(path)))
+        return sorted(files)
+
+    async def load(self):
+        if self.loaded:
+            return
+        self.loaded = True
+        loop = asyncio.get_running_loop()
+        for _, video_id, size in await loop.run_in_executor(self.executor, self._load):
+            self.files[video_id] = size
+            self.total_bytes += size
+        logger.info(f"Cache âm thanh: {len(self.files)} bài, {self.total_bytes / 1024 / 1024:.0f}MB")
+        # Giới hạn có thể đã giảm (vd. chia cho nhiều cluster): thu nhỏ thư mục có sẵn ngay khi khởi động
+        self.evict()
+
+    def lookup(self, video_id: Optional[str]) -> Optional[str]:
+        if video_id and video_id in self.files:
+            self.files.move_to_end(video_id)
+            self.hits += 1
+            return self.path_for(video_id)
+        self.misses += 1
+        return None
+
+    def _record_play(self, video_id: str) -> int:
+        db = self._connect()
+        with db:
+            db.execute(
+                "INSERT INTO audio_plays (video_id, plays, last_used) VALUES (?, 1, ?) "
+                "ON CONFLICT(video_id) DO UPDATE SET plays = plays + 1, last_used = excluded.last_used",
+                (video_id, time.time()),
+            )
+        return db.execute("SELECT plays FROM audio_plays WHERE video_id = ?", (video_id,)).fetchone()[0]
+
+    async def record_play(self, song_info: dict):
+        # Chạy thành task tách khỏi lệnh phát: không ghi span (kể cả của fill) vào trace của lệnh đó
+        current_trace.set(None)
+        video_id = song_info.get("id")
+        if not video_id:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+            plays = await loop.run_in_executor(self.executor, self._record_play, video_id)
+        except Exception as e:
+            logger.warning(f"Lỗi khi ghi lượt phát: {e}")
+            return
+        if (
+            plays >= self.min_plays
+            and video_id not in self.files
+            and video_id not in self.filling
+            and 0 < (song_info.get("duration") or 0) <= AUDIO_CACHE_MAX_DURATION
+        ):
+            self.filling.add(video_id)
+            asyncio.create_task(self.fill(video_id))
+
+    @staticmethod
+    def _commit(part_path: str, path: str) -> int:
+        os.replace(part_path, path)
+        return os.path.getsize(path)
+
+    @staticmethod
+    def _remove_files(paths: list):
+        for path in paths:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                logger.warning(f"Không xóa được file cache {path}: {e}")
+
+    async def fill(self, video_id: str):
+        path = self.path_for(video_id)
+        part_path = f"{path}.{os.getpid()}.part"
+        loop = asyncio.get_running_loop()
+        committed = False
+        try:
+            async with self.fill_lock:
+                song_info = await fetch_song_info_async(youtube_watch_url(video_id))
+                if not song_info or not song_info.get("url"):
+                    return
+                codec = "copy" if song_info.get("acodec") == "opus" else "libopus"
+                process = await asyncio.create_subprocess_exec(
+                    FFMPEG_PATH, "-nostdin", "-loglevel", "error",
+                    "-reconnect", "1", "-reconnect_streamed", "1", "-reconnect_delay_max", "5",
+                    "-i", song_info["url"], "-vn", "-map_metadata", "-1",
+                    "-c:a", codec, "-b:a", "128k", "-ar", "48000", "-ac", "2", "-f", "ogg", part_path,
+                    stdout=asyncio.subprocess.DEVNULL,
+                    stderr=asyncio.subprocess.PIPE,
+                )
+                # Stream treo (ffmpeg reconnect mãi) sẽ giữ fill_lock và chặn mọi lần tải sau: đặt hạn chót
+                try:
+                    _, stderr = await asyncio.wait_for(process.communicate(), AUDIO_CACHE_FILL_TIMEOUT)
+                except asyncio.TimeoutError:
+                    process.kill()
+                    await process.wait()
+                    logger.warning(f"Tải {video_id} vào cache âm thanh quá {AUDIO_CACHE_FILL_TIMEOUT}s, bỏ qua")
+                    return
+                except asyncio.CancelledError:
+                    with contextlib.suppress(ProcessLookupError):
+                        process.kill()
+                    raise
+                if process.returncode != 0:
+                    logger.warning(f"Không tải được {video_id} vào cache âm thanh: {stderr.decode(errors='ignore')[-200:]}")
+                    return
+                size = await loop.run_in_executor(self.executor, self._commit, part_path, path)
+                committed = True
+                self.files[video_id] = size
+                self.total_bytes += size
+                self.fills += 1
+                logger.info(f"Đã lưu {video_id} vào cache âm thanh ({size / 1024 / 1024:.1f}MB)")
+                self.evict()
+        except Exception as e:
+            logger.exception(f"Lỗi khi lưu cache âm thanh {video_id}: {e}")
+        finally:
+            self.filling.discard(video_id)
+            if not committed:
+                # ffmpeg lỗi hoặc bị kill có thể để lại file dở
+                self.executor.submit(self._remove_files, [part_path])
+
+    def evict(self):
+        playing = {song.get("source_info", {}).get("id") for song in guild_state.now_playing_all().values()}
+        removed = []
+        for video_id in list(self.files):
+            if self.total_bytes <= self.max_bytes:
+                break
+            if video_id in playing:
+                continue
+            size = self.files.pop(video_id)
+            self.total_bytes -= size
+            self.evictions += 1
+            removed.append(self.path_for(video_id))
+        if removed:
+            # Xóa file trên thread của cache, không chặn event loop
+            self.executor.submit(self._remove_files, removed)
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "files": len(self.files),
+            "bytes": self.total_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "fills": self.fills,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+
+audio_cache = AudioCache(AUDIO_CACHE_DIR, METADATA_CACHE_FILE, AUDIO_CACHE_MAX_BYTES, AUDIO_CACHE_MIN_PLAYS)
+
+def lower_process_priority(pid: int):
+    # ffmpeg phân tích chạy ở mức ưu tiên thấp nhất để nhường CPU cho các luồng đang phát.
+    # Hạ sau khi spawn (không dùng preexec_fn, không an toàn khi process có nhiều thread)
+    try:
+        psutil.Process(pid).nice(psutil.BELOW_NORMAL_PRIORITY_CLASS if os.name == "nt" else 19)
+    except psutil.Error as e:
+        logger.debug(f"Không hạ được độ ưu tiên của process {pid}: {e}")
+
+class LoudnessCache:
+    # Đo độ ồn EBU R128 (loudnorm của ffmpeg) một lần cho mỗi video ID, lưu vào SQLite.
+    # Lúc phát chỉ nhân một hệ số cố định thay vì chạy loudnorm trực tiếp cho mọi luồng.
+    # Hàng chờ có giới hạn, số worker cố định và ffmpeg chạy nice 19 nên không tranh CPU với luồng phát.
+    # Bài đo lỗi được ghi lại (kết quả âm) và chỉ thử lại sau LOUDNESS_RETRY_AFTER giây.
+    def __init__(self, db_path: str, target: float, true_peak: float, workers: int, queue_size: int):
+        self.db_path = db_path
+        self.target = target
+        self.true_peak = true_peak
+        self.workers = workers
+        self.db = None
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="loudness")
+        self.queue = None
+        self.queue_size = queue_size
+        self.tasks = []
+        self.gains = {}
+        self.failed = {}
+        self.pending = set()
+        self.analyzed = 0
+        self.failures = 0
+        self.dropped = 0
+
+    def _connect(self):
+        if self.db is None:
+            self.db = sqlite3.connect(self.db_path, check_same_thread=False)
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS loudness ("
+                "video_id TEXT PRIMARY KEY, integrated REAL, true_peak REAL, gain REAL NOT NULL, analyzed_at REAL NOT NULL)"
+            )
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS loudness_failures ("
+                "video_id TEXT PRIMARY KEY, error TEXT, failed_at REAL NOT NULL)"
+            )
+        return self.db
+
+    def _load(self) -> tuple:
+        db = self._connect()
+        with db:
+            db.execute("DELETE FROM loudness_failures WHERE failed_at < ?", (time.time() - LOUDNESS_RETRY_AFTER,))
+        gains = dict(db.execute("SELECT video_id, gain FROM loudness"))
+        failed = dict(db.execute("SELECT video_id, failed_at FROM loudness_failures"))
+        return gains, failed
+
+    def _lookup(self, video_id: str) -> tuple:
+        db = self._connect()
+        row = db.execute("SELECT gain FROM loudness WHERE video_id = ?", (video_id,)).fetchone()
+        failure = db.execute("SELECT failed_at FROM loudness_failures WHERE video_id = ?", (video_id,)).fetchone()
+        return (row[0] if row else None), (failure[0] if failure else None)
+
+    def _store(self, video_id: str, integrated: Optional[float], true_peak: Optional[float], gain: float):
+        db = self._connect()
+        with db:
+            db.execute(
+                "INSERT OR REPLACE INTO loudness (video_id, integrated, true_peak, gain, analyzed_at) VALUES (?, ?, ?, ?, ?)",
+                (video_id, integrated, true_peak, gain, time.time()),
+            )
+            db.execute("DELETE FROM loudness_failures WHERE video_id = ?", (video_id,))
+
+    def _store_failure(self, video_id: str, error: str, failed_at: float):
+        db = self._connect()
+        with db:
+            db.execute(
+                "INSERT OR REPLACE INTO loudness_failures (video_id, error, failed_at) VALUES (?, ?, ?)",
+                (video_id, error[-200:], failed_at),
+            )
+
+    async def load(self):
+        loop = asyncio.get_running_loop()
+        gains, failed = await loop.run_in_executor(self.executor, self._load)
+        self.gains.update(gains)
+        self.failed.update(failed)
+        logger.info(f"Cache độ ồn: {len(self.gains)} bài, {len(self.failed)} bài lỗi chờ thử lại")
+
+    def start(self):
+        if self.queue is None:
+            self.queue = asyncio.Queue(maxsize=self.queue_size)
+        self.tasks = [task for task in self.tasks if not task.done()]
+        while len(self.tasks) < self.workers:
+            self.tasks.append(asyncio.create_task(self.run()))
+
+    def gain_for(self, video_id: Optional[str]) -> float:
+        # Hệ số nhân biên độ; lệch dưới LOUDNESS_MIN_GAIN_DB thì bỏ qua để giữ được Opus passthrough
+        gain = self.gains.get(video_id) if video_id else None
+        if gain is None or abs(gain) < LOUDNESS_MIN_GAIN_DB:
+            return 1.0
+        return 10 ** (gain / 20)
+
+    def recently_failed(self, video_id: str) -> bool:
+        failed_at = self.failed.get(video_id)
+        if failed_at is None:
+            return False
+        if time.time() - failed_at < LOUDNESS_RETRY_AFTER:
+            return True
+        del self.failed[video_id]
+        return False
+
+    def request(self, song_info: dict):
+        video_id = song_info.get("id")
+        if (
+            not LOUDNESS_NORMALIZE
+            or not video_id
+            or video_id in self.gains
+            or video_id in self.pending
+            or self.recently_failed(video_id)
+            or not 0 < (song_info.get("duration") or 0) <= LOUDNESS_MAX_DURATION
+        ):
+            return
+        self.start()
+        try:
+            self.queue.put_nowait(song_info)
+        except asyncio.QueueFull:
+            self.dropped += 1
+            return
+        self.pending.add(video_id)
+
+    def gain_from(self, integrated: float, true_peak: float) -> float:
+        if not math.isfinite(integrated):
+            return 0.0
+        gain = self.target - integrated
+        # Không tăng quá mức làm đỉnh thực vượt ngưỡng true peak
+        if math.isfinite(true_peak):
+            gain = min(gain, self.true_peak - true_peak)
+        return max(-LOUDNESS_MAX_CUT_DB, min(LOUDNESS_MAX_BOOST_DB, gain))
+
+    async def measure(self, source: str) -> tuple:
+        process = await asyncio.create_subprocess_exec(
+            FFMPEG_PATH, "-nostdin", "-hide_banner", "-nostats", "-threads", "1",
+            *(("-reconnect", "1", "-reconnect_streamed", "1", "-reconnect_delay_max", "5") if "://" in source else ()),
+            "-i", source, "-vn",
+            "-af", f"loudnorm=I={self.target}:TP={self.true_peak}:print_format=json",
+            "-f", "null", "-",
+            stdout=asyncio.subprocess.DEVNULL,
+            stderr=asyncio.subprocess.PIPE,
+        )
+        lower_process_priority(process.pid)
+        try:
+            _, stderr = await asyncio.wait_for(process.communicate(), LOUDNESS_TIMEOUT)
+        except asyncio.TimeoutError:
+            process.kill()
+            await process.wait()
+            raise RuntimeError(f"ffmpeg chạy quá {LOUDNESS_TIMEOUT}s")
+        except asyncio.CancelledError:
+            with contextlib.suppress(ProcessLookupError):
+                process.kill()
+            raise
+        output = stderr.decode(errors="ignore")
+        if process.returncode != 0 or "{" not in output:
+            raise RuntimeError(output[-200:])
+        report = json.loads(output[output.rindex("{"):output.rindex("}") + 1])
+        return float(report["input_i"]), float(report["input_tp"])
+
+    async def analyze(self, song_info: dict) -> str:
+        video_id = song_info["id"]
+        loop = asyncio.get_running_loop()
+        # Process khác trong cluster có thể đã đo xong bài này
+        known, failed_at = await loop.run_in_executor(self.executor, self._lookup, video_id)
+        if known is not None:
+            self.gains[video_id] = known
+            return "shared"
+        if failed_at is not None:
+            self.failed[video_id] = failed_at
+            if self.recently_failed(video_id):
+                return "skipped"
+        if video_id in audio_cache.files:
+            source = audio_cache.path_for(video_id)
+        elif song_info.get("url") and is_stream_fresh(song_info):
+            source = song_info["url"]
+        else:
+            # Stream URL đã hết hạn; bài sẽ được yêu cầu lại ở lần phát/chuẩn bị trước tiếp theo
+            return "skipped"
+        integrated, true_peak = await self.measure(source)
+        gain = self.gain_from(integrated, true_peak)
+        await loop.run_in_executor(
+            self.executor, self._store, video_id,
+            integrated if math.isfinite(integrated) else None,
+            true_peak if math.isfinite(true_peak) else None,
+            gain,
+        )
+        self.gains[video_id] = gain
+        self.analyzed += 1
+        logger.info(f"Độ ồn {video_id}: {integrated:.1f} LUFS, bù {gain:+.1f} dB")
+        return "ok"
+
+    async def run(self):
+        while True:
+            song_info = await self.queue.get()
+            try:
+                result = await self.analyze(song_info)
+            except Exception as e:
+                result = "failed"
+                self.failures += 1
+                logger.warning(f"Không đo được độ ồn {song_info.get('id')}: {e}")
+                await self.mark_failed(song_info["id"], str(e) or type(e).__name__)
+            finally:
+                self.pending.discard(song_info.get("id"))
+            metric_loudness_analyses.inc(result=result)
+
+    async def mark_failed(self, video_id: str, error: str):
+        # Ghi kết quả âm để bài hỏng không bị đo lại ở mỗi lần phát
+        failed_at = time.time()
+        self.failed[video_id] = failed_at
+        loop = asyncio.get_running_loop()
+        try:
+            await loop.run_in_executor(self.executor, self._store_failure, video_id, error, failed_at)
+        except sqlite3.Error as e:
+            logger.warning(f"Không lưu được lỗi đo độ ồn {video_id}: {e}")
+
+    def stats(self) -> dict:
+        return {
+            "tracks": len(self.gains),
+            "failed": len(self.failed),
+            "pending": len(self.pending),
+            "analyzed": self.analyzed,
+            "failures": self.failures,
+            "dropped": self.dropped,
+        }
+
+loudness_cache = LoudnessCache(
+    METADATA_CACHE_FILE, LOUDNESS_TARGET_LUFS, LOUDNESS_TRUE_PEAK, LOUDNESS_WORKERS, LOUDNESS_QUEUE_SIZE
+)
+metric_loudness_analyses = metrics.register(Counter(
+    "hinaa_loudness_analyses_total", "Số lần đo độ ồn EBU R128 ở nền", labels=("result",)
+))
+
+class BufferedAudioSource(discord.AudioSource):
+    # Đọc trước ffmpeg trên thread riêng vào ring buffer có giới hạn, để thread phát của discord.py
+    # không phải chờ mạng/ffmpeg mỗi 20ms. Hết dữ liệu giữa chừng thì phát khung im lặng (underrun)
+    # và chờ nạp lại đủ mức prebuffer rồi mới phát tiếp, giữ đúng nhịp gửi gói.
+    active = weakref.WeakSet()
+    total_underruns = 0
+    # Nhiều thread phát cùng cộng dồn số liệu chung
+    stats_lock = threading.Lock()
+
+    def __init__(self, original: discord.AudioSource, capacity: int, prebuffer: int):
+        self.original = original
+        self.capacity = max(1, capacity)
+        self.prebuffer = max(1, min(prebuffer, self.capacity))
+        self.frames = deque()
+        self.condition = threading.Condition()
+        self.buffering = True
+        self.started = False
+        self.eof = False
+        self.closed = False
+        self.underruns = 0
+        self.silence = OPUS_SILENCE if original.is_opus() else b"\x00" * discord.opus.Encoder.FRAME_SIZE
+        self.reader = threading.Thread(target=self._fill, name="hinaa-audio-reader", daemon=True)
+        self.reader.start()
+        BufferedAudioSource.active.add(self)
+
+    def _fill(self):
+        while True:
+            with self.condition:
+                while len(self.frames) >= self.capacity and not self.closed:
+                    self.condition.wait()
+                if self.closed:
+                    return
+            try:
+                frame = self.original.read()
+            except Exception as e:
+                logger.warning(f"Lỗi khi đọc trước âm thanh: {e}")
+                frame = b""
+            with self.condition:
+                if not frame:
+                    self.eof = True
+                    self.condition.notify_all()
+                    return
+                self.frames.append(frame)
+                self.condition.notify_all()
+
+    def read(self) -> bytes:
+        with self.condition:
+            if not self.started:
+                # Lần đọc đầu chặn như FFmpegPCMAudio cho tới khi đủ prebuffer
+                while len(self.frames) < self.prebuffer and not self.eof and not self.closed:
+                    self.condition.wait()
+                self.started = True
+                self.buffering = False
+            elif self.buffering:
+                if len(self.frames) < self.prebuffer and not self.eof:
+                    return self.silence
+                self.buffering = False
+            if self.frames:
+                frame = self.frames.popleft()
+                self.condition.notify_all()
+                return frame
+            if self.eof or self.closed:
+                return b""
+            self.underruns += 1
+            with BufferedAudioSource.stats_lock:
+                BufferedAudioSource.total_underruns += 1
+                metric_audio_underruns.inc()
+            self.buffering = True
+            return self.silence
+
+    def fill_level(self) -> float:
+        return len(self.frames) / self.capacity
+
+    def is_opus(self) -> bool:
+        return self.original.is_opus()
+
+    def cleanup(self):
+        with self.condition:
+            self.closed = True
+            self.frames.clear()
+            self.condition.notify_all()
+        BufferedAudioSource.active.discard(self)
+        self.original.cleanup()
+
+def audio_buffer_stats() -> dict:
+    levels = [source.fill_level() for source in list(BufferedAudioSource.active)]
+    return {
+        "active": len(levels),
+        "fill": sum(levels) / len(levels) if levels else 0.0,
+        "min_fill": min(levels) if levels else 0.0,
+        "underruns": BufferedAudioSource.total_underruns,
+    }
+
+metric_audio_underruns = metrics.register(Counter(
+    "hinaa_audio_buffer_underruns_total", "Số lần bộ đệm đọc trước bị cạn khi đang phát"
+))
+metrics.register(Gauge(
+    "hinaa_audio_buffer_fill_ratio", "Độ đầy thấp nhất của bộ đệm đọc trước trong các luồng đang phát",
+    lambda: audio_buffer_stats()["min_fill"],
+))
+metrics.register(Gauge(
+    "hinaa_audio_buffer_streams", "Số luồng đang phát qua bộ đệm đọc trước",
+    lambda: len(BufferedAudioSource.active),
+))
+
+def pcm_decode(frame: bytes):
+    # Khung s16le stereo -> mảng mẫu float32 (numpy) hoặc array('h') nếu không có numpy
+    if numpy is not None:
+        return numpy.frombuffer(frame, dtype="<i2").astype(numpy.float32)
+    samples = array.array("h", frame)
+    if sys.byteorder == "big":
+        samples.byteswap()
+    return samples
+
+def pcm_encode(samples) -> bytes:
+    if numpy is not None:
+        return numpy.clip(samples, -32768, 32767).astype("<i2").tobytes()
+    samples = array.array("h", [max(-32768, min(32767, int(sample))) for sample in samples])
+    if sys.byteorder == "big":
+        samples.byteswap()
+    return samples.tobytes()
+
+class PCMStage:
+    # Một bước trong chuỗi PCMProcessor: nhận và trả về mảng mẫu xen kẽ trái/phải của một khung 20ms.
+    # idle() = True nghĩa là bước này không đổi gì, cả chuỗi idle thì khung được trả về nguyên vẹn.
+    name = "stage"
+
+    def idle(self) -> bool:
+        return False
+
+    def process(self, samples):
+        return samples
+
+class VolumeStage(PCMStage):
+    # Đổi âm lượng theo dốc tuyến tính qua vài khung thay vì nhảy bậc (gây tiếng "tách")
+    name = "volume"
+
+    def __init__(self, volume: float, ramp_frames: int):
+        self.gain = volume
+        self.target = volume
+        self.step = 0.0
+        self.ramp_frames = max(1, ramp_frames)
+
+    def set(self, volume: float):
+        self.target = volume
+        self.step = (volume - self.gain) / self.ramp_frames
+
+    def idle(self) -> bool:
+        return self.gain == self.target == 1.0
+
+    def process(self, samples):
+        start, target = self.gain, self.target
+        if start == target:
+            if numpy is not None:
+                return samples * numpy.float32(start)
+            return [sample * start for sample in samples]
+        end = target if abs(target - start) <= abs(self.step) else start + self.step
+        self.gain = end
+        pairs = len(samples) // 2
+        if numpy is not None:
+            ramp = numpy.linspace(start, end, pairs, endpoint=False, dtype=numpy.float32)
+            return samples * numpy.repeat(ramp, 2)
+        delta = (end - start) / pairs
+        return [sample * (start + delta * (i // 2)) for i, sample in enumerate(samples)]
+
+class GainStage(PCMStage):
+    # Hệ số cố định cho cả bài (bù độ ồn đã đo trước)
+    name = "gain"
+
+    def __init__(self, gain: float):
+        self.gain = gain
+
+    def idle(self) -> bool:
+        return self.gain == 1.0
+
+    def process(self, samples):
+        if numpy is not None:
+            return samples * numpy.float32(self.gain)
+        return [sample * self.gain for sample in samples]
 
-def create_progress_bar(current, total):
-    if total == 0:
-        return "🔘────────── 0%"
-    progress = min(int((current / total) * 10), 10)
-    bar = "🔘" + "─" * progress + "─" * (10 - progress)
-    percentage = min(int((current / total) * 100), 100)
-    return f"{bar} {percentage}%"
+class PCMProcessor(discord.AudioSource):
+    # Thay PCMVolumeTransformer: giải mã khung một lần, chạy qua chuỗi các bước rồi mã hóa lại.
+    # Có thuộc tính volume như PCMVolumeTransformer để !volume chỉnh trực tiếp trong lúc phát.
+    frames = 0
+    seconds = 0.0
+    stats_lock = threading.Lock()
 
-async def update_progress(ctx, message, duration, start_time):
-    while ctx.voice_client and (ctx.voice_client.is_playing() or ctx.voice_client.is_paused()):
-        elapsed = (datetime.datetime.now() - start_time).total_seconds()
-        if elapsed >= duration:
-            break
-        embed = message.embeds[0]
-        embed.set_field_at(1, name="📊 𝗧𝗶ế𝗻 𝗧𝗿ì𝗻𝗵", value=create_progress_bar(elapsed, duration), inline=False)
-        try:
-            await message.edit(embed=embed)
-        except discord.errors.HTTPException:
-            break
-        await asyncio.sleep(5)
+    def __init__(self, original: discord.AudioSource, stages: list):
+        if original.is_opus():
+            raise discord.ClientException("PCMProcessor chỉ nhận nguồn PCM")
+        self.original = original
+        self.stages = stages
 
-async def fetch_song_info_async(url: str, is_search: bool = False) -> Optional[dict]:
-    ydl_opts = {
-        "format": "bestaudio/best",
-        "noplaylist": True,
-        "quiet": True,
-        "no_warnings": True,
-        "simulate": True,
-        "skip_download": True,
-        "ignoreerrors": True,
-    }
-    if is_search:
-        ydl_opts["default_search"] = "ytsearch5"
-    try:
-        loop = asyncio.get_event_loop()
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            info = await asyncio.wait_for(
-                loop.run_in_executor(None, lambda: ydl.extract_info(url, download=False)),
-                timeout=10.0
-            )
-            if not info:
-                logger.warning(f"Không lấy được thông tin từ URL: {url}")
-                return None
-            if is_search and "entries" in info:
-                for entry in info["entries"]:
-                    if entry and entry.get("url"):
-                        return {
-                            "url": entry["url"],
-                            "title": entry.get("title", "Unknown Title"),
-                            "artist": entry.get("uploader", "Unknown Artist"),
-                            "duration": entry.get("duration", 0),
-                            "thumbnail": entry.get("thumbnail", "https://i.imgur.com/5z1oX0Z.png"),
-                        }
-                return None
-            return {
-                "url": info["url"],
-                "title": info.get("title", "Unknown Title"),
-                "artist": info.get("uploader", "Unknown Artist"),
-                "duration": info.get("duration", 0),
-                "thumbnail": info.get("thumbnail", "https://i.imgur.com/5z1oX0Z.png"),
-            }
-    except asyncio.TimeoutError:
-        logger.warning(f"Timeout khi tải thông tin bài hát: {url}")
-        return None
-    except Exception as e:
-        logger.exception(f"Lỗi khi tải thông tin bài hát: {e}")
+    def stage(self, name: str) -> Optional[PCMStage]:
+        for stage in self.stages:
+            if stage.name == name:
+                return stage
         return None
 
-async def is_valid_url(url: str) -> bool:
-    try:
-        parsed = urllib.parse.urlparse(url)
-        if not parsed.scheme in ["http", "https"]:
-            return False
-        if "youtube.com" in parsed.netloc or "youtu.be" in parsed.netloc:
-            return bool(re.match(r"^(https?://)?(www\.)?(youtube\.com|youtu\.be)/", url))
-        if "spotify.com" in parsed.netloc:
-            return bool(re.match(r"^(https?://)?open\.spotify\.com/(track|playlist)/", url))
-        return False
-    except Exception:
+    @property
+    def volume(self) -> float:
+        stage = self.stage("volume")
+        return stage.target if stage else 1.0
+
+    @volume.setter
+    def volume(self, value: float):
+        stage = self.stage("volume")
+        if stage is None:
+            stage = VolumeStage(1.0, VOLUME_RAMP_FRAMES)
+            self.stages.insert(0, stage)
+        stage.set(max(0.0, value))
+
+    def read(self) -> bytes:
+        frame = self.original.read()
+        if not frame or all(stage.idle() for stage in self.stages):
+            return frame
+        started = time.perf_counter()
+        samples = pcm_decode(frame)
+        for stage in self.stages:
+            samples = stage.process(samples)
+        data = pcm_encode(samples)
+        elapsed = time.perf_counter() - started
+        with PCMProcessor.stats_lock:
+            PCMProcessor.frames += 1
+            PCMProcessor.seconds += elapsed
+            metric_pcm_frame_seconds.observe(elapsed)
+        return data
+
+    def is_opus(self) -> bool:
         return False
 
-async def handle_spotify(ctx, url: str) -> dict:
-    if not sp:
-        raise ValueError("Spotify API chưa kết nối!")
+    def cleanup(self):
+        self.original.cleanup()
+
+def pcm_stats() -> dict:
+    return {
+        "backend": "numpy" if numpy is not None else "array",
+        "frames": PCMProcessor.frames,
+        "avg_us": PCMProcessor.seconds / PCMProcessor.frames * 1e6 if PCMProcessor.frames else 0.0,
+    }
+
+metric_pcm_frame_seconds = metrics.register(Histogram(
+    "hinaa_pcm_frame_seconds", "Thời gian CPU xử lý PCM cho mỗi khung 20ms",
+    buckets=(0.00002, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.02),
+))
+
+def create_audio_source(song_info: dict, offset: float, volume: float) -> discord.AudioSource:
+    cached_path = audio_cache.lookup(song_info.get("id"))
+    if cached_path:
+        stream_url = cached_path
+        acodec = "opus"
+        before_options = ""
+    else:
+        stream_url = song_info["url"]
+        acodec = song_info.get("acodec")
+        before_options = "-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5"
+    if offset:
+        before_options += f" -ss {offset:.1f}"
+    # Luồng Opus không cần xử lý âm lượng thì remux thẳng, bỏ qua giải mã PCM và mã hóa lại trong bot
+    gain = loudness_cache.gain_for(song_info.get("id"))
+    passthrough = OPUS_PASSTHROUGH and acodec == "opus" and volume == 1.0 and gain == 1.0
+    if passthrough:
+        source = discord.FFmpegOpusAudio(
+            stream_url,
+            executable=FFMPEG_PATH,
+            before_options=before_options.strip(),
+            codec="copy",
+        )
+    else:
+        source = discord.FFmpegPCMAudio(
+            stream_url,
+            executable=FFMPEG_PATH,
+            before_options=before_options.strip(),
+        )
+    # Thứ tự: ffmpeg -> trace (đo gói đầu từ ffmpeg) -> bộ đệm đọc trước -> xử lý PCM (bù độ ồn, âm lượng)
     try:
-        if "track" in url:
-            track = sp.track(url, market="VN")
-            return {
-                "title": track["name"],
-                "artist": track["artists"][0]["name"],
-                "search_query": f"{track['name']} {track['artists'][0]['name']} audio",
-            }
-        elif "playlist" in url:
-            playlist = sp.playlist(url, market="VN")
-            tracks = playlist["tracks"]["items"]
-            server_id = ctx.guild.id
-            if server_id not in queues:
-                queues[server_id] = []
-            valid_tracks = 0
-            for track_item in tracks[:50]:
-                track = track_item["track"]
-                track_url = track["external_urls"]["spotify"]
-                if await is_valid_url(track_url):
-                    song_info = await fetch_song_info_async(
-                        f"{track['name']} {track['artists'][0]['name']} audio",
-                        is_search=True
-                    )
-                    if song_info:
-                        queues[server_id].append((track_url, song_info["title"], song_info["artist"]))
-                        valid_tracks += 1
-            return {"is_playlist": True, "count": valid_tracks}
-        else:
-            raise ValueError("Chỉ hỗ trợ track/playlist Spotify!")
-    except Exception as e:
-        logger.exception(f"Lỗi khi xử lý Spotify: {e}")
-        raise ValueError("Lỗi khi xử lý Spotify, thử lại nhé!")
+        source = trace_audio_source(source)
+        if AUDIO_BUFFER_FRAMES:
+            source = BufferedAudioSource(source, AUDIO_BUFFER_FRAMES, AUDIO_PREBUFFER_FRAMES)
+        if not passthrough:
+            # Luôn bọc để !volume đổi được âm lượng mà không phải phát lại; ở 100% khung đi thẳng qua
+            source = PCMProcessor(source, [GainStage(gain), VolumeStage(volume, VOLUME_RAMP_FRAMES)])
+    except Exception:
+        source.cleanup()
+        raise
+    return source
+
+async def track_finished(ctx, token):
+    session = guild_sessions.peek(ctx.guild.id)
+    if session and session.playback_token is token:
+        await play_next(ctx)
+
+async def restart_current_song(ctx) -> bool:
+    server_id = ctx.guild.id
+    song = guild_state.now_playing(server_id)
+    if not song or not ctx.voice_client or not ctx.voice_client.is_playing():
+        return False
+    offset = (datetime.datetime.now() - song["start_time"]).total_seconds()
+    song_info = song["source_info"]
+    if not is_stream_fresh(song_info):
+        song_info = await resolve_track(song["url"])
+        if not song_info:
+            return False
+    guild_sessions.get(server_id).playback_token = None
+    ctx.voice_client.stop()
+    await play_source(ctx, song_info, song["url"], offset=offset, announce=False)
+    return True
 
-async def play_source(ctx, song_info: dict, url: str):
+async def play_source(ctx, song_info: dict, url: str, offset: float = 0, announce: bool = True):
     server_id = ctx.guild.id
-    start_time = datetime.datetime.now()
-    current_song[server_id] = {
+    start_time = datetime.datetime.now() - datetime.timedelta(seconds=offset)
+    guild_state.set_now_playing(server_id, {
         "title": song_info["title"],
         "artist": song_info["artist"],
         "url": url,
         "duration": song_info["duration"],
         "start_time": start_time,
         "thumbnail": song_info["thumbnail"],
-    }
-    votes_to_skip[server_id] = set()
+        "text_channel": ctx.channel.id,
+        "voice_channel": ctx.voice_client.channel.id if ctx.voice_client else None,
+        "source_info": song_info,
+    })
+    autoplay_engine.record_play(server_id, url)
+    loudness_cache.request(song_info)
+    source = None
+    playing = False
     try:
-        source = discord.FFmpegPCMAudio(
-            song_info["url"],
-            executable=FFMPEG_PATH,
-            before_options="-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5",
-        )
+        with trace_span("ffmpeg_spawn"):
+            source = create_audio_source(song_info, offset, guild_state.volume(server_id))
         duration_str = f"{int(song_info['duration'] // 60)}:{int(song_info['duration'] % 60):02d}" if song_info['duration'] else "N/A"
         embed = discord.Embed(
             title="🎵 𝗛𝗶𝗻𝗮𝗮'𝘀 𝗠𝘂𝘀𝗶𝗰 𝗣𝗹𝗮𝘆𝗲𝗿",
@@ -309,19 +3015,116 @@ async def play_source(ctx, song_info: dict, url: str):
         embed.add_field(name="⏱️ 𝗧𝗵ờ𝗶 𝗟ượ𝗻𝗴", value=f"**{duration_str}**", inline=False)
         embed.set_image(url=song_info["thumbnail"])
         embed.set_footer(text="✨ Hinaa luôn sẵn sàng nè! ✨")
-        view = MusicControls(ctx)
-        message = await ctx.send(embed=embed, view=view)
         logger.info(f"Phát bài: {song_info['title']} - {song_info['artist']}")
-        ctx.voice_client.play(source, after=lambda e: bot.loop.create_task(play_next(ctx)))
-        asyncio.create_task(update_progress(ctx, message, song_info["duration"], start_time))
+        session = guild_sessions.get(server_id)
+        session.text_channel = ctx.channel.id
+        session.touch()
+        token = session.playback_token = object()
+        ctx.voice_client.play(source, after=lambda e: bot.loop.create_task(track_finished(ctx, token)))
+        playing = True
+        start_prefetch(ctx)
+        if announce:
+            asyncio.create_task(audio_cache.record_play(song_info))
     except Exception as e:
         logger.exception(f"Lỗi khi phát âm thanh: {e}")
-        current_song.pop(server_id, None)
+        if source is not None and not playing:
+            # Nguồn chưa được giao cho voice client: tự dừng ffmpeg và thread đọc trước
+            source.cleanup()
+        trace = current_trace.get()
+        if trace:
+            trace.awaiting_audio = False
+        clear_current_song(server_id)
         embed = discord.Embed(description="🚫 Không thể phát bài hát này, thử bài khác nhé! 😅", color=discord.Color.red())
         embed.set_footer(text="✨ Hinaa luôn sẵn sàng nè! ✨")
         await ctx.send(embed=embed)
         await play_next(ctx)
+        return
+    if not announce:
+        return
+    try:
+        view = MusicControls(ctx)
+        with trace_span("announce"):
+            message = await ctx.send(embed=embed, view=view)
+        guild_sessions.get(server_id).set_controls(view)
+        update_progress(ctx, message, song_info["duration"], start_time)
+    except discord.errors.HTTPException as e:
+        logger.warning(f"Không gửi được thông báo bài đang phát: {e}")
+
+async def resolve_track(url: str) -> Optional[dict]:
+    if "spotify.com" in url:
+        spotify_data = await handle_spotify(None, url)
+        return await match_spotify_track(spotify_data)
+    return await fetch_song_info_async(url)
+
+def is_stream_fresh(song_info: dict) -> bool:
+    return song_info.get("expires_at", 0) - STREAM_URL_EXPIRY_MARGIN > time.time()
+
+def wake_prefetch(server_id):
+    session = guild_sessions.peek(server_id)
+    if session and session.prefetch_wakeup:
+        session.prefetch_wakeup.set()
+
+def take_prefetched(server_id, url: str) -> Optional[dict]:
+    session = guild_sessions.peek(server_id)
+    song_info = session.prefetched.pop(url, None) if session else None
+    if song_info and song_info.get("url") and is_stream_fresh(song_info):
+        return song_info
+    return None
+
+def start_prefetch(ctx):
+    server_id = ctx.guild.id
+    session = guild_sessions.get(server_id)
+    if session.prefetch_task and not session.prefetch_task.done():
+        wake_prefetch(server_id)
+        return
+    session.prefetch_wakeup = asyncio.Event()
+    session.prefetch_task = asyncio.create_task(prefetch_loop(ctx, session))
+
+async def prefetch_loop(ctx, session: GuildSession):
+    # Phân giải trước stream URL cho N bài tiếp theo trong lúc bài hiện tại đang phát
+    server_id = ctx.guild.id
+    wakeup = session.prefetch_wakeup
+    # Task kế thừa context của lệnh phát; không ghi span chuẩn bị trước vào trace đó
+    current_trace.set(None)
+    try:
+        while ctx.voice_client and guild_state.now_playing(server_id):
+            wakeup.clear()
+            queue = peek_queue(server_id)
+            upcoming = [entry.url for entry in queue.peek(PREFETCH_DEPTH)] if queue else []
+            ready = session.prefetched
+            for url in list(ready):
+                if url not in upcoming:
+                    ready.pop(url, None)
+            for url in upcoming:
+                song_info = ready.get(url)
+                if song_info and is_stream_fresh(song_info):
+                    continue
+                try:
+                    song_info = await resolve_track(url)
+                except ValueError:
+                    song_info = None
+                if song_info and song_info.get("url"):
+                    ready[url] = song_info
+                    loudness_cache.request(song_info)
+                    logger.info(f"Đã chuẩn bị trước: {song_info['title']}")
+            if not upcoming and guild_state.autoplay_enabled(server_id) and sp:
+                try:
+                    await autoplay_engine.prepare(server_id)
+                except Exception as e:
+                    logger.warning(f"Không chuẩn bị trước được bài tự phát: {e}")
+            try:
+                await asyncio.wait_for(wakeup.wait(), timeout=PREFETCH_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+    except Exception as e:
+        logger.exception(f"Lỗi khi chuẩn bị trước bài hát: {e}")
+    finally:
+        if session.prefetch_task is asyncio.current_task():
+            session.prefetch_task = None
+            session.prefetch_wakeup = None
+            session.prefetched.clear()
 
+@traced("play")
 async def play_music(ctx, url: str):
     try:
         server_id = ctx.guild.id
@@ -342,32 +3145,33 @@ async def play_music(ctx, url: str):
                 embed.set_footer(text="✨ Hinaa luôn sẵn sàng nè! ✨")
                 await ctx.send(embed=embed)
                 return
-            await ctx.author.voice.channel.connect()
+            with trace_span("connect"):
+                await ctx.author.voice.channel.connect()
         if ctx.voice_client.is_playing() or ctx.voice_client.is_paused():
             if not await is_valid_url(url):
                 embed = discord.Embed(description="🚫 URL không hợp lệ, cần link YouTube hoặc Spotify hợp lệ! 😅", color=discord.Color.red())
                 embed.set_footer(text="✨ Hinaa luôn sẵn sàng nè! ✨")
                 await ctx.send(embed=embed)
                 return
-            song_info = await fetch_song_info_async(url)
+            song_info = await fetch_song_info_async(url, need_stream=False)
             if not song_info:
                 embed = discord.Embed(description="🚫 Bài hát này không khả dụng, thử bài khác nhé! 😅", color=discord.Color.red())
                 embed.set_footer(text="✨ Hinaa luôn sẵn sàng nè! ✨")
                 await ctx.send(embed=embed)
                 return
-            if server_id not in queues:
-                queues[server_id] = []
-            if len(queues[server_id]) >= 50:
-                embed = discord.Embed(description="🚫 Hàng đợi đã đầy (tối đa 50 bài)! 😅", color=discord.Color.red())
+            queue = get_queue(server_id)
+            if queue.is_full():
+                embed = discord.Embed(description=f"🚫 Hàng đợi đã đầy (tối đa {queue.max_size} bài)! 😅", color=discord.Color.red())
                 embed.set_footer(text="✨ Hinaa luôn sẵn sàng nè! ✨")
                 await ctx.send(embed=embed)
                 return
-            if any(url == q[0] for q in queues[server_id]):
+            if url in queue:
                 embed = discord.Embed(description="🚫 Bài hát này đã có trong hàng đợi! 😅", color=discord.Color.red())
                 embed.set_footer(text="✨ Hinaa luôn sẵn sàng nè! ✨")
                 await ctx.send(embed=embed)
                 return
-            queues[server_id].append((url, song_info["title"], song_info["artist"]))
+            queue.add(url, song_info["title"], song_info["artist"], song_info.get("duration") or 0)
+            wake_prefetch(server_id)
             embed = discord.Embed(description=f"🎶 Thêm **{song_info['title']}** vào hàng đợi! 😊", color=discord.Color.blue())
             embed.set_footer(text="✨ Hinaa luôn sẵn sàng nè! ✨")
             await ctx.send(embed=embed)
@@ -381,27 +3185,29 @@ async def play_music(ctx, url: str):
                 )
                 embed.set_footer(text="✨ Hinaa luôn sẵn sàng nè! ✨")
                 await ctx.send(embed=embed)
-                if not ctx.voice_client.is_playing() and server_id in queues and queues[server_id]:
-                    next_url, _, _ = queues[server_id].pop(0)
-                    await play_music(ctx, next_url)
+                if not ctx.voice_client.is_playing() and peek_queue(server_id):
+                    await play_music(ctx, peek_queue(server_id).pop_next().url)
                 return
-            song_info = await fetch_song_info_async(spotify_data["search_query"], is_search=True)
+            song_info = await match_spotify_track(spotify_data)
         elif "youtube.com/playlist" in url:
-            ydl_opts = {"extract_flat": True, "quiet": True, "ignoreerrors": True}
-            with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                info = await asyncio.wait_for(
-                    asyncio.get_event_loop().run_in_executor(None, lambda: ydl.extract_info(url, download=False)),
-                    timeout=15.0
+            queue = get_queue(server_id)
+            remaining = min(queue.max_size - len(queue), PLAYLIST_IMPORT_LIMIT)
+            info = {}
+            if remaining > 0:
+                ydl_opts = {"extract_flat": True, "quiet": True, "ignoreerrors": True, "playlistend": remaining}
+                with trace_span("ytdl_playlist"):
+                    info = await extraction_pool.extract(url, ydl_opts, timeout=30.0) or {}
+            # Danh sách flat đã có ID, tiêu đề, thời lượng: xếp hàng ngay, không phân giải từng bài
+            valid_entries = queue.extend(
+                (
+                    youtube_watch_url(entry["id"]),
+                    entry.get("title") or "Unknown Title",
+                    entry.get("uploader") or entry.get("channel") or "Unknown Artist",
+                    entry.get("duration") or 0,
                 )
-            if server_id not in queues:
-                queues[server_id] = []
-            valid_entries = 0
-            for entry in info.get("entries", [])[:50]:
-                if entry and entry.get("url") and await is_valid_url(entry["url"]):
-                    song_info = await fetch_song_info_async(entry["url"])
-                    if song_info and not any(entry["url"] == q[0] for q in queues[server_id]):
-                        queues[server_id].append((entry["url"], song_info["title"], song_info["artist"]))
-                        valid_entries += 1
+                for entry in info.get("entries") or []
+                if entry and entry.get("id") and entry.get("title") not in ("[Private video]", "[Deleted video]")
+            )
             if valid_entries == 0:
                 embed = discord.Embed(description="🚫 Không tìm thấy bài hát khả dụng trong playlist! 😅", color=discord.Color.red())
                 embed.set_footer(text="✨ Hinaa luôn sẵn sàng nè! ✨")
@@ -410,9 +3216,8 @@ async def play_music(ctx, url: str):
             embed = discord.Embed(description=f"🎶 Thêm **{valid_entries} bài** từ playlist YouTube! 😊", color=discord.Color.blue())
             embed.set_footer(text="✨ Hinaa luôn sẵn sàng nè! ✨")
             await ctx.send(embed=embed)
-            if not ctx.voice_client.is_playing() and server_id in queues and queues[server_id]:
-                next_url, _, _ = queues[server_id].pop(0)
-                await play_music(ctx, next_url)
+            if not ctx.voice_client.is_playing() and peek_queue(server_id):
+                await play_music(ctx, peek_queue(server_id).pop_next().url)
             return
         else:
             song_info = await fetch_song_info_async(url)
@@ -442,19 +3247,24 @@ async def play_music(ctx, url: str):
         embed.set_footer(text="✨ Hinaa luôn sẵn sàng nè! ✨")
         await ctx.send(embed=embed)
 
+@traced("play_next")
 async def play_next(ctx):
     server_id = ctx.guild.id
-    if server_id in queues and queues[server_id]:
-        url, _, _ = queues[server_id].pop(0)
-        await play_music(ctx, url)
-    elif autoplay_enabled.get(server_id, False):
+    if peek_queue(server_id):
+        url = peek_queue(server_id).pop_next().url
+        song_info = take_prefetched(server_id, url)
+        if song_info and ctx.voice_client:
+            await play_source(ctx, song_info, url)
+        else:
+            await play_music(ctx, url)
+    elif guild_state.autoplay_enabled(server_id):
         if sp:
             try:
-                playlist = sp.playlist("37i9dQZF1DXcBWIGoYBM5M", market="VN")
-                tracks = playlist["tracks"]["items"]
-                track = random.choice(tracks)["track"]
-                url = track["external_urls"]["spotify"]
-                await play_music(ctx, url)
+                ready = await autoplay_engine.next_track(server_id)
+                if ready and ctx.voice_client:
+                    await play_source(ctx, ready[1], ready[0])
+                elif ready:
+                    await play_music(ctx, ready[0])
             except Exception as e:
                 logger.exception(f"Lỗi lấy bài hát ngẫu nhiên: {e}")
         else:
@@ -462,7 +3272,7 @@ async def play_next(ctx):
             embed.set_footer(text="✨ Hinaa luôn sẵn sàng nè! ✨")
             await ctx.send(embed=embed)
     elif ctx.voice_client:
-        current_song.pop(server_id, None)
+        clear_current_song(server_id)
         embed = discord.Embed(description="🎶 Hàng đợi hết rồi! Thêm bài mới nha! 😊", color=discord.Color.blue())
         embed.set_footer(text="✨ Hinaa luôn sẵn sàng nè! ✨")
         await ctx.send(embed=embed)
@@ -470,17 +3280,122 @@ async def play_next(ctx):
 @bot.event
 async def on_ready():
     logger.info(f"Hinaa đã sẵn sàng với tên {bot.user}")
-    load_playlists()
+    try:
+        await playlist_store.open()
+    except Exception as e:
+        logger.exception(f"Lỗi khi mở kho playlist: {e}")
+    spotify_matches.load()
+    extraction_pool.start()
+    try:
+        await audio_cache.load()
+    except Exception as e:
+        logger.exception(f"Lỗi khi tải cache âm thanh: {e}")
+    try:
+        await loudness_cache.load()
+    except Exception as e:
+        logger.exception(f"Lỗi khi tải cache độ ồn: {e}")
+    if sp:
+        try:
+            await sp.refresh_token()
+        except Exception as e:
+            logger.warning(f"Không lấy được token Spotify: {e}")
+    if METRICS_PORT:
+        try:
+            await metrics.start(METRICS_HOST, METRICS_PORT + int(CLUSTER_ID or 0))
+        except OSError as e:
+            logger.error(f"Không mở được cổng metrics {METRICS_PORT}: {e}")
+    if not guild_state.task:
+        await resume_sessions()
+        guild_state.start()
+        guild_sessions.start()
+        loop_monitor.start(LOOP_MONITOR_DEBUG)
+        if CLUSTER_ID:
+            asyncio.create_task(report_cluster_status())
     await bot.change_presence(activity=discord.Activity(type=discord.ActivityType.listening, name="nhạc cùng mọi người! 🎶"))
 
+def cluster_status() -> dict:
+    # Đọc trạng thái bot trên event loop; chỉ phần ghi file chạy trên thread
+    return {
+        "cluster_id": CLUSTER_ID,
+        "pid": os.getpid(),
+        "shard_ids": list(bot.shard_ids or []) if isinstance(bot, commands.AutoShardedBot) else [],
+        "shard_count": bot.shard_count,
+        "guilds": len(bot.guilds),
+        "voice_clients": len(bot.voice_clients),
+        "playing": len(guild_state.now_playing_all()),
+        "latency_ms": round(bot.latency * 1000) if math.isfinite(bot.latency) else None,
+        "uptime": round(time.time() - bot.start_time),
+        "updated_at": time.time(),
+    }
+
+def write_cluster_status(status: dict):
+    os.makedirs(CLUSTER_STATUS_DIR, exist_ok=True)
+    write_file_atomic(os.path.join(CLUSTER_STATUS_DIR, f"{CLUSTER_ID}.json"), json.dumps(status))
+
+async def report_cluster_status():
+    # Báo trạng thái cho launcher (cluster.py) gộp lại
+    while True:
+        try:
+            await asyncio.to_thread(write_cluster_status, cluster_status())
+        except Exception as e:
+            logger.warning(f"Không ghi được trạng thái cluster: {e}")
+        await asyncio.sleep(CLUSTER_STATUS_INTERVAL)
+
+async def resume_sessions():
+    states = await guild_state.load_sessions([guild.id for guild in bot.guilds])
+    resumed = 0
+    for server_id, session in states.items():
+        guild = bot.get_guild(server_id)
+        if not guild:
+            continue
+        guild_state.restore(server_id, session)
+        song = session["now"]
+        if not song:
+            continue
+        voice_channel = guild.get_channel(song.get("voice_channel") or 0)
+        text_channel = guild.get_channel(song.get("text_channel") or 0)
+        if not voice_channel or not text_channel:
+            continue
+        try:
+            if not guild.voice_client:
+                await voice_channel.connect()
+            ctx = ResumeContext(guild, text_channel)
+            song_info = await resolve_track(song["url"])
+            if song_info:
+                offset = song["offset"] if song["offset"] < (song["duration"] or 0) - 5 else 0
+                await play_source(ctx, song_info, song["url"], offset=offset)
+            else:
+                await play_next(ctx)
+            resumed += 1
+        except Exception as e:
+            logger.exception(f"Lỗi khi khôi phục phiên của server {server_id}: {e}")
+    await guild_state.flush(compact=True)
+    logger.info(f"Đã khôi phục {resumed}/{len(states)} phiên phát nhạc")
+
+@bot.listen("on_command")
+async def count_command(ctx):
+    metric_commands.inc(command=ctx.command.qualified_name if ctx.command else "unknown")
+
+@bot.before_invoke
+async def mark_command(ctx):
+    # Hook chạy trong chính task của lệnh nên mọi task lệnh tạo ra sau đó cũng mang tên lệnh này
+    current_command.set(ctx.command.qualified_name if ctx.command else None)
+
+@bot.listen("on_command")
+async def touch_guild_session(ctx):
+    if ctx.guild:
+        guild_sessions.touch(ctx.guild.id)
+
+@bot.listen("on_command_error")
+async def count_command_error(ctx, error):
+    metric_command_errors.inc(command=ctx.command.qualified_name if ctx.command else "unknown")
+
 @bot.event
 async def on_guild_remove(guild):
     server_id = guild.id
-    queues.pop(server_id, None)
-    current_song.pop(server_id, None)
-    autoplay_enabled.pop(server_id, None)
-    votes_to_skip.pop(server_id, None)
-    playlists.pop(str(guild.id), None)
+    drop_guild_session(server_id)
+    guild_state.forget(server_id)
+    # Playlist thuộc về người dùng (theo user id) và dùng được ở mọi server, không xoá theo server
     for vc in bot.voice_clients:
         if vc.guild.id == server_id:
             await vc.disconnect(force=True)
@@ -528,8 +3443,7 @@ async def leave(ctx):
             await ctx.send(embed=embed)
             return
         server_id = ctx.guild.id
-        queues.pop(server_id, None)
-        current_song.pop(server_id, None)
+        drop_guild_session(server_id)
         await ctx.voice_client.disconnect(force=True)
         embed = discord.Embed(description="👋 Hinaa rời kênh rồi! Hẹn gặp lại nha! 😊", color=discord.Color.blue())
         embed.set_footer(text="✨ Hinaa luôn sẵn sàng nè! ✨")
@@ -553,13 +3467,13 @@ async def play(ctx, url: str):
 @bot.command()
 async def search(ctx, *, query):
     try:
-        song_info = await fetch_song_info_async(query, is_search=True)
-        if not song_info:
+        match = await search_track(query)
+        if not match:
             embed = discord.Embed(description="🚫 Không tìm thấy bài hát nào, thử từ khóa khác nhé! 😅", color=discord.Color.red())
             embed.set_footer(text="✨ Hinaa luôn sẵn sàng nè! ✨")
             await ctx.send(embed=embed)
             return
-        await play_music(ctx, song_info["url"])
+        await play_music(ctx, youtube_watch_url(match["id"]))
     except asyncio.TimeoutError:
         embed = discord.Embed(description="🚫 Yêu cầu tìm kiếm mất quá lâu, thử lại nhé! 😅", color=discord.Color.red())
         embed.set_footer(text="✨ Hinaa luôn sẵn sàng nè! ✨")
@@ -579,25 +3493,25 @@ async def queue(ctx, url: str):
             embed.set_footer(text="✨ Hinaa luôn sẵn sàng nè! ✨")
             await ctx.send(embed=embed)
             return
-        song_info = await fetch_song_info_async(url)
+        song_info = await fetch_song_info_async(url, need_stream=False)
         if not song_info:
             embed = discord.Embed(description="🚫 Bài hát này không khả dụng, thử bài khác nhé! 😅", color=discord.Color.red())
             embed.set_footer(text="✨ Hinaa luôn sẵn sàng nè! ✨")
             await ctx.send(embed=embed)
             return
-        if server_id not in queues:
-            queues[server_id] = []
-        if len(queues[server_id]) >= 50:
-            embed = discord.Embed(description="🚫 Hàng đợi đã đầy (tối đa 50 bài)! 😅", color=discord.Color.red())
+        queue = get_queue(server_id)
+        if queue.is_full():
+            embed = discord.Embed(description=f"🚫 Hàng đợi đã đầy (tối đa {queue.max_size} bài)! 😅", color=discord.Color.red())
             embed.set_footer(text="✨ Hinaa luôn sẵn sàng nè! ✨")
             await ctx.send(embed=embed)
             return
-        if any(url == q[0] for q in queues[server_id]):
+        if url in queue:
             embed = discord.Embed(description="🚫 Bài hát này đã có trong hàng đợi! 😅", color=discord.Color.red())
             embed.set_footer(text="✨ Hinaa luôn sẵn sàng nè! ✨")
             await ctx.send(embed=embed)
             return
-        queues[server_id].append((url, song_info["title"], song_info["artist"]))
+        queue.add(url, song_info["title"], song_info["artist"], song_info.get("duration") or 0)
+        wake_prefetch(server_id)
         embed = discord.Embed(description=f"🎶 Thêm **{song_info['title']}** vào hàng đợi! 😊", color=discord.Color.blue())
         embed.set_footer(text="✨ Hinaa luôn sẵn sàng nè! ✨")
         await ctx.send(embed=embed)
@@ -611,30 +3525,38 @@ async def queue(ctx, url: str):
 async def queue_list(ctx):
     try:
         server_id = ctx.guild.id
-        if server_id not in queues or not queues[server_id]:
+        if not peek_queue(server_id):
             embed = discord.Embed(description="🎵 𝗛à𝗻𝗴 Đợ𝗶 𝗧𝗿ố𝗻𝗴! 😅", color=discord.Color.red())
             embed.set_footer(text="✨ Hinaa luôn sẵn sàng nè! ✨")
             await ctx.send(embed=embed)
             return
-        pages = []
-        for i in range(0, len(queues[server_id]), 10):
-            queue_list = [
-                f"**{j+1}.** {title} - {artist}"
-                for j, (_, title, artist) in enumerate(queues[server_id][i:i+10])
-            ]
-            pages.append("\n".join(queue_list))
+        def queued() -> int:
+            # Hàng đợi có thể bị xoá khi bot rời kênh trong lúc đang lật trang
+            return len(peek_queue(server_id) or ())
+
+        def render_page(page: int) -> str:
+            # Chỉ dựng trang đang xem, hàng đợi có thể tới hàng nghìn bài
+            queue = peek_queue(server_id)
+            return "\n".join(
+                f"**{page * 10 + j + 1}.** {entry.title} - {entry.artist}"
+                + (f" ({int(entry.duration // 60)}:{int(entry.duration % 60):02d})" if entry.duration else "")
+                for j, entry in enumerate(queue.page(page * 10, 10) if queue else ())
+            )
+
+        page_count = max(1, (queued() + 9) // 10)
         current_page = 0
+        page_text = render_page(current_page)
         embed = discord.Embed(
             title="📜 𝗗𝗮𝗻𝗵 𝗦á𝗰𝗵 𝗛à𝗻𝗴 Đợ𝗶",
             description=(
-                f"🎶 **Đang phát: {current_song[server_id]['title']}**"
-                if server_id in current_song else ""
-            ) + (f"\n\n{pages[current_page]}" if pages[current_page] else ""),
+                f"🎶 **Đang phát: {guild_state.now_playing(server_id)['title']}**"
+                if guild_state.now_playing(server_id) else ""
+            ) + (f"\n\n{page_text}" if page_text else ""),
             color=discord.Color.blue()
         )
-        embed.set_footer(text=f"✨ Trang {current_page + 1}/{len(pages)} | Tổng cộng: {len(queues[server_id])} bài ✨")
+        embed.set_footer(text=f"✨ Trang {current_page + 1}/{page_count} | Tổng cộng: {queued()} bài ✨")
         message = await ctx.send(embed=embed)
-        if len(pages) > 1:
+        if page_count > 1:
             await message.add_reaction("⬅️")
             await message.add_reaction("➡️")
             def check(reaction, user):
@@ -642,17 +3564,19 @@ async def queue_list(ctx):
             while True:
                 try:
                     reaction, user = await bot.wait_for("reaction_add", timeout=60.0, check=check)
-                    if str(reaction.emoji) == "➡️" and current_page < len(pages) - 1:
+                    page_count = max(1, (queued() + 9) // 10)
+                    if str(reaction.emoji) == "➡️" and current_page < page_count - 1:
                         current_page += 1
                     elif str(reaction.emoji) == "⬅️" and current_page > 0:
                         current_page -= 1
                     else:
                         continue
+                    page_text = render_page(current_page)
                     embed.description = (
-                        f"🎶 **Đang phát: {current_song[server_id]['title']}**"
-                        if server_id in current_song else ""
-                    ) + (f"\n\n{pages[current_page]}" if pages[current_page] else "")
-                    embed.set_footer(text=f"✨ Trang {current_page + 1}/{len(pages)} | Tổng cộng: {len(queues[server_id])} bài ✨")
+                        f"🎶 **Đang phát: {guild_state.now_playing(server_id)['title']}**"
+                        if guild_state.now_playing(server_id) else ""
+                    ) + (f"\n\n{page_text}" if page_text else "")
+                    embed.set_footer(text=f"✨ Trang {current_page + 1}/{page_count} | Tổng cộng: {queued()} bài ✨")
                     await message.edit(embed=embed)
                     await message.remove_reaction(reaction.emoji, user)
                 except asyncio.TimeoutError:
@@ -664,6 +3588,27 @@ async def queue_list(ctx):
         embed.set_footer(text="✨ Hinaa luôn sẵn sàng nè! ✨")
         await ctx.send(embed=embed)
 
+@bot.command()
+async def remove(ctx, position: int):
+    try:
+        server_id = ctx.guild.id
+        queue = peek_queue(server_id)
+        entry = queue.remove_at(position - 1) if queue else None
+        if not entry:
+            embed = discord.Embed(description="🚫 Vị trí không hợp lệ, xem !queue_list nhé! 😅", color=discord.Color.red())
+            embed.set_footer(text="✨ Hinaa luôn sẵn sàng nè! ✨")
+            await ctx.send(embed=embed)
+            return
+        wake_prefetch(server_id)
+        embed = discord.Embed(description=f"🗑️ Đã xóa **{entry.title}** khỏi hàng đợi! 😊", color=discord.Color.blue())
+        embed.set_footer(text="✨ Hinaa luôn sẵn sàng nè! ✨")
+        await ctx.send(embed=embed)
+    except Exception as e:
+        logger.exception(f"Lỗi khi xóa khỏi hàng đợi: {e}")
+        embed = discord.Embed(description="🚫 Ôi, có gì đó sai rồi! Thử lại nhé 😅", color=discord.Color.red())
+        embed.set_footer(text="✨ Hinaa luôn sẵn sàng nè! ✨")
+        await ctx.send(embed=embed)
+
 @bot.command()
 async def skip(ctx):
     try:
@@ -673,19 +3618,19 @@ async def skip(ctx):
             await ctx.send(embed=embed)
             return
         server_id = ctx.guild.id
-        votes_to_skip[server_id].add(ctx.author.id)
+        votes = guild_state.add_vote(server_id, ctx.author.id)
         required = max(1, len(ctx.voice_client.channel.members) // 2)
-        if len(votes_to_skip[server_id]) >= required:
+        if votes >= required:
             if ctx.voice_client.is_playing() or ctx.voice_client.is_paused():
                 ctx.voice_client.stop()
                 embed = discord.Embed(description="🎶 Đủ vote, Hinaa skip bài này! 😊", color=discord.Color.blue())
-                votes_to_skip[server_id].clear()
+                guild_state.clear_votes(server_id)
             else:
                 embed = discord.Embed(description="🚫 Không có nhạc để skip! 😅", color=discord.Color.red())
             embed.set_footer(text="✨ Hinaa luôn sẵn sàng nè! ✨")
             await ctx.send(embed=embed)
         else:
-            embed = discord.Embed(description=f"🎶 Cần {required - len(votes_to_skip[server_id])} vote nữa để skip! 😊", color=discord.Color.blue())
+            embed = discord.Embed(description=f"🎶 Cần {required - votes} vote nữa để skip! 😊", color=discord.Color.blue())
             embed.set_footer(text="✨ Hinaa luôn sẵn sàng nè! ✨")
             await ctx.send(embed=embed)
     except Exception as e:
@@ -703,7 +3648,14 @@ async def volume(ctx, level: int):
             await ctx.send(embed=embed)
             return
         if 0 <= level <= 100:
-            ctx.voice_client.source.volume = level / 100
+            server_id = ctx.guild.id
+            guild_state.set_volume(server_id, level / 100)
+            source = ctx.voice_client.source
+            if isinstance(source, PCMProcessor):
+                source.volume = level / 100
+            elif source is not None and level != 100:
+                # Nguồn Opus passthrough không chỉnh được âm lượng, phát lại từ vị trí hiện tại ở dạng PCM
+                await restart_current_song(ctx)
             embed = discord.Embed(description=f"🔊 Âm lượng: **{level}%**! 😊", color=discord.Color.blue())
             embed.set_footer(text="✨ Hinaa luôn sẵn sàng nè! ✨")
             await ctx.send(embed=embed)
@@ -721,12 +3673,12 @@ async def volume(ctx, level: int):
 async def np(ctx):
     try:
         server_id = ctx.guild.id
-        if server_id not in current_song:
+        song = guild_state.now_playing(server_id)
+        if not song:
             embed = discord.Embed(description="🎵 𝗖𝗵ư𝗮 𝗖ó 𝗕à𝗶 𝗛á𝘁 𝗡à𝗼 Đ𝗮𝗻𝗴 𝗣𝗵á𝘁! 😅", color=discord.Color.red())
             embed.set_footer(text="✨ Hinaa luôn sẵn sàng nè! ✨")
             await ctx.send(embed=embed)
             return
-        song = current_song[server_id]
         elapsed = (datetime.datetime.now() - song["start_time"]).total_seconds()
         duration_str = f"{int(song['duration'] // 60)}:{int(song['duration'] % 60):02d}" if song['duration'] else "N/A"
         embed = discord.Embed(
@@ -751,23 +3703,65 @@ async def np(ctx):
         embed.set_footer(text="✨ Hinaa luôn sẵn sàng nè! ✨")
         await ctx.send(embed=embed)
 
-def save_playlists():
-    try:
-        with open("playlists.json", "w", encoding="utf-8") as f:
-            json.dump(playlists, f, ensure_ascii=False, indent=2)
-        logger.info("Đã lưu playlist vào playlists.json")
-    except Exception as e:
-        logger.exception(f"Lỗi khi lưu playlist: {e}")
+PLAYLIST_SONG_META_COLUMNS = (
+    ("title", "TEXT"),
+    ("artist", "TEXT"),
+    ("duration", "REAL"),
+    ("thumbnail", "TEXT"),
+    ("updated_at", "REAL"),
+)
 
-def load_playlists():
-    global playlists
-    try:
-        with open("playlists.json", "r", encoding="utf-8") as f:
-            data = json.load(f)
-            if not isinstance(data, dict):
-                logger.warning("File playlists.json không đúng định dạng, khởi tạo playlist rỗng")
-                playlists = {}
-                return
+class PlaylistStore:
+    # Playlist lưu trong SQLite (WAL). Mỗi thao tác là một giao dịch riêng,
+    # chạy tuần tự trên một thread để không chặn event loop.
+    def __init__(self, path: str, legacy_path: str):
+        self.path = path
+        self.legacy_path = legacy_path
+        self.db = None
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="playlist-store")
+
+    def _connect(self):
+        if self.db is None:
+            db = sqlite3.connect(self.path, check_same_thread=False)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            db.execute("PRAGMA foreign_keys=ON")
+            with db:
+                db.execute(
+                    "CREATE TABLE IF NOT EXISTS playlists ("
+                    "user_id TEXT NOT NULL, name TEXT NOT NULL, created_at REAL NOT NULL, "
+                    "PRIMARY KEY (user_id, name))"
+                )
+                db.execute(
+                    "CREATE TABLE IF NOT EXISTS playlist_songs ("
+                    "user_id TEXT NOT NULL, name TEXT NOT NULL, position INTEGER NOT NULL, url TEXT NOT NULL, "
+                    "PRIMARY KEY (user_id, name, url), "
+                    "FOREIGN KEY (user_id, name) REFERENCES playlists(user_id, name) ON DELETE CASCADE)"
+                )
+                db.execute("CREATE INDEX IF NOT EXISTS playlist_songs_order ON playlist_songs(user_id, name, position)")
+                columns = {row[1] for row in db.execute("PRAGMA table_info(playlist_songs)")}
+                for column, column_type in PLAYLIST_SONG_META_COLUMNS:
+                    if column not in columns:
+                        db.execute(f"ALTER TABLE playlist_songs ADD COLUMN {column} {column_type}")
+            self.db = db
+            self._migrate_json()
+        return self.db
+
+    def _migrate_json(self):
+        try:
+            with open(self.legacy_path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return
+        except json.JSONDecodeError:
+            logger.warning(f"File {self.legacy_path} bị hỏng, bỏ qua chuyển đổi")
+            return
+        if not isinstance(data, dict):
+            logger.warning(f"File {self.legacy_path} không đúng định dạng, bỏ qua chuyển đổi")
+            return
+        now = time.time()
+        migrated = 0
+        with self.db:
             for user_id, user_playlists in data.items():
                 if not isinstance(user_playlists, dict):
                     logger.warning(f"Dữ liệu playlist của user {user_id} không hợp lệ, bỏ qua")
@@ -776,37 +3770,162 @@ def load_playlists():
                     if not isinstance(songs, list):
                         logger.warning(f"Playlist {playlist_name} của user {user_id} không hợp lệ, bỏ qua")
                         continue
-            playlists.update({str(k): v for k, v in data.items()})
-            logger.info("Đã tải playlist từ playlists.json")
-    except FileNotFoundError:
-        logger.info("Không tìm thấy playlists.json, khởi tạo playlist rỗng")
-        playlists = {}
-    except json.JSONDecodeError:
-        logger.warning("File playlists.json bị hỏng, khởi tạo playlist rỗng")
-        playlists = {}
+                    self.db.execute(
+                        "INSERT OR IGNORE INTO playlists (user_id, name, created_at) VALUES (?, ?, ?)",
+                        (str(user_id), playlist_name, now),
+                    )
+                    self.db.executemany(
+                        "INSERT OR IGNORE INTO playlist_songs (user_id, name, position, url) VALUES (?, ?, ?, ?)",
+                        [
+                            (str(user_id), playlist_name, position, url)
+                            for position, url in enumerate(songs) if isinstance(url, str)
+                        ],
+                    )
+                    migrated += 1
+        os.replace(self.legacy_path, f"{self.legacy_path}.migrated")
+        logger.info(f"Đã chuyển {migrated} playlist từ {self.legacy_path} sang {self.path}")
+
+    async def _run(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, func, *args)
+
+    def _load_user(self, user_id: str) -> dict:
+        db = self._connect()
+        user_playlists = {
+            name: [] for (name,) in db.execute(
+                "SELECT name FROM playlists WHERE user_id = ? ORDER BY created_at, name", (user_id,)
+            )
+        }
+        for name, url, title, artist, duration, thumbnail, updated_at in db.execute(
+            "SELECT name, url, title, artist, duration, thumbnail, updated_at FROM playlist_songs "
+            "WHERE user_id = ? ORDER BY name, position", (user_id,)
+        ):
+            user_playlists[name].append({
+                "url": url,
+                "title": title,
+                "artist": artist,
+                "duration": duration or 0,
+                "thumbnail": thumbnail,
+                "updated_at": updated_at or 0,
+            })
+        return user_playlists
+
+    def _create(self, user_id: str, name: str) -> bool:
+        db = self._connect()
+        with db:
+            cursor = db.execute(
+                "INSERT OR IGNORE INTO playlists (user_id, name, created_at) VALUES (?, ?, ?)",
+                (user_id, name, time.time()),
+            )
+        return cursor.rowcount > 0
+
+    def _add_song(self, user_id: str, name: str, url: str, song_info: dict) -> bool:
+        db = self._connect()
+        with db:
+            cursor = db.execute(
+                "INSERT OR IGNORE INTO playlist_songs "
+                "(user_id, name, position, url, title, artist, duration, thumbnail, updated_at) "
+                "SELECT ?, ?, COALESCE(MAX(position) + 1, 0), ?, ?, ?, ?, ?, ? "
+                "FROM playlist_songs WHERE user_id = ? AND name = ?",
+                (
+                    user_id, name, url, song_info["title"], song_info["artist"], song_info["duration"],
+                    song_info["thumbnail"], time.time(), user_id, name,
+                ),
+            )
+        return cursor.rowcount > 0
+
+    def _update_song_meta(self, user_id: str, name: str, url: str, song_info: dict):
+        db = self._connect()
+        with db:
+            db.execute(
+                "UPDATE playlist_songs SET title = ?, artist = ?, duration = ?, thumbnail = ?, updated_at = ? "
+                "WHERE user_id = ? AND name = ? AND url = ?",
+                (
+                    song_info["title"], song_info["artist"], song_info["duration"], song_info["thumbnail"],
+                    time.time(), user_id, name, url,
+                ),
+            )
+
+    def _remove_song(self, user_id: str, name: str, url: str) -> bool:
+        db = self._connect()
+        with db:
+            cursor = db.execute(
+                "DELETE FROM playlist_songs WHERE user_id = ? AND name = ? AND url = ?", (user_id, name, url)
+            )
+        return cursor.rowcount > 0
+
+    def _delete(self, user_id: str, name: str) -> bool:
+        db = self._connect()
+        with db:
+            cursor = db.execute("DELETE FROM playlists WHERE user_id = ? AND name = ?", (user_id, name))
+        return cursor.rowcount > 0
+
+    async def open(self):
+        await self._run(self._connect)
+
+    async def load_user(self, user_id: str) -> dict:
+        return await self._run(self._load_user, user_id)
+
+    async def create(self, user_id: str, name: str) -> bool:
+        return await self._run(self._create, user_id, name)
+
+    async def add_song(self, user_id: str, name: str, url: str, song_info: dict) -> bool:
+        return await self._run(self._add_song, user_id, name, url, song_info)
+
+    async def update_song_meta(self, user_id: str, name: str, url: str, song_info: dict):
+        await self._run(self._update_song_meta, user_id, name, url, song_info)
+
+    async def remove_song(self, user_id: str, name: str, url: str) -> bool:
+        return await self._run(self._remove_song, user_id, name, url)
+
+    async def delete(self, user_id: str, name: str) -> bool:
+        return await self._run(self._delete, user_id, name)
+
+playlist_store = PlaylistStore(PLAYLIST_DB_FILE, PLAYLIST_JSON_FILE)
+playlist_refreshes = set()
+
+def is_playlist_entry_stale(entry: dict) -> bool:
+    return not entry["title"] or time.time() - entry["updated_at"] > PLAYLIST_METADATA_TTL
+
+async def refresh_playlist_metadata(user_id: str, name: str, entries: list):
+    # Cập nhật lại metadata cũ/thiếu của playlist ở nền, không chặn lệnh của người dùng
+    key = (user_id, name)
+    if key in playlist_refreshes:
+        return
+    playlist_refreshes.add(key)
+    try:
+        for entry in entries:
+            if not is_playlist_entry_stale(entry):
+                continue
+            song_info = await fetch_song_info_async(entry["url"], need_stream=False)
+            if song_info:
+                await playlist_store.update_song_meta(user_id, name, entry["url"], song_info)
     except Exception as e:
-        logger.exception(f"Lỗi khi tải playlist: {e}")
-        playlists = {}
+        logger.exception(f"Lỗi khi cập nhật metadata playlist {name} của user {user_id}: {e}")
+    finally:
+        playlist_refreshes.discard(key)
+
+def schedule_playlist_refresh(user_id: str, name: str, entries: list):
+    stale = [entry for entry in entries if is_playlist_entry_stale(entry)]
+    if stale:
+        asyncio.create_task(refresh_playlist_metadata(user_id, name, stale))
 
 @bot.command()
 async def playlist(ctx, action: str, name: str = None, url: str = None):
     user_id = str(ctx.author.id)
     try:
+        user_playlists = await playlist_store.load_user(user_id)
         if action == "create" and name:
-            if user_id not in playlists:
-                playlists[user_id] = {}
-            if name in playlists[user_id]:
+            if not await playlist_store.create(user_id, name):
                 embed = discord.Embed(description="🚫 Playlist này đã tồn tại! 😅", color=discord.Color.red())
                 embed.set_footer(text="✨ Hinaa luôn sẵn sàng nè! ✨")
                 await ctx.send(embed=embed)
                 return
-            playlists[user_id][name] = []
-            save_playlists()
             embed = discord.Embed(description=f"🎶 Tạo playlist **{name}** thành công! 😊", color=discord.Color.blue())
             embed.set_footer(text="✨ Hinaa luôn sẵn sàng nè! ✨")
             await ctx.send(embed=embed)
         elif action == "add" and name and url:
-            if user_id not in playlists or name not in playlists[user_id]:
+            if name not in user_playlists:
                 embed = discord.Embed(description="🚫 Playlist không tồn tại! 😅", color=discord.Color.red())
                 embed.set_footer(text="✨ Hinaa luôn sẵn sàng nè! ✨")
                 await ctx.send(embed=embed)
@@ -816,54 +3935,60 @@ async def playlist(ctx, action: str, name: str = None, url: str = None):
                 embed.set_footer(text="✨ Hinaa luôn sẵn sàng nè! ✨")
                 await ctx.send(embed=embed)
                 return
-            song_info = await fetch_song_info_async(url)
+            song_info = await fetch_song_info_async(url, need_stream=False)
             if not song_info:
                 embed = discord.Embed(description="🚫 Bài hát này không khả dụng, thử bài khác nhé! 😅", color=discord.Color.red())
                 embed.set_footer(text="✨ Hinaa luôn sẵn sàng nè! ✨")
                 await ctx.send(embed=embed)
                 return
-            if url in playlists[user_id][name]:
+            if not await playlist_store.add_song(user_id, name, url, song_info):
                 embed = discord.Embed(description="🚫 Bài hát này đã có trong playlist! 😅", color=discord.Color.red())
                 embed.set_footer(text="✨ Hinaa luôn sẵn sàng nè! ✨")
                 await ctx.send(embed=embed)
                 return
-            playlists[user_id][name].append(url)
-            save_playlists()
             embed = discord.Embed(description=f"🎶 Thêm **{song_info['title']}** vào **{name}**! 😊", color=discord.Color.blue())
             embed.set_footer(text="✨ Hinaa luôn sẵn sàng nè! ✨")
             await ctx.send(embed=embed)
         elif action == "remove" and name and url:
-            if user_id not in playlists or name not in playlists[user_id]:
+            if name not in user_playlists:
                 embed = discord.Embed(description="🚫 Playlist không tồn tại! 😅", color=discord.Color.red())
                 embed.set_footer(text="✨ Hinaa luôn sẵn sàng nè! ✨")
                 await ctx.send(embed=embed)
                 return
-            if url not in playlists[user_id][name]:
+            if not await playlist_store.remove_song(user_id, name, url):
                 embed = discord.Embed(description="🚫 Bài hát không có trong playlist! 😅", color=discord.Color.red())
                 embed.set_footer(text="✨ Hinaa luôn sẵn sàng nè! ✨")
                 await ctx.send(embed=embed)
                 return
-            playlists[user_id][name].remove(url)
-            save_playlists()
             embed = discord.Embed(description=f"🎶 Xóa bài khỏi **{name}**! 😊", color=discord.Color.blue())
             embed.set_footer(text="✨ Hinaa luôn sẵn sàng nè! ✨")
             await ctx.send(embed=embed)
         elif action == "play" and name:
-            if user_id not in playlists or name not in playlists[user_id] or not playlists[user_id][name]:
+            if not user_playlists.get(name):
                 embed = discord.Embed(description="🚫 Playlist trống hoặc không tồn tại! 😅", color=discord.Color.red())
                 embed.set_footer(text="✨ Hinaa luôn sẵn sàng nè! ✨")
                 await ctx.send(embed=embed)
                 return
             server_id = ctx.guild.id
-            if server_id not in queues:
-                queues[server_id] = []
+            queue = get_queue(server_id)
             valid_urls = 0
-            for url in playlists[user_id][name]:
-                if await is_valid_url(url):
-                    song_info = await fetch_song_info_async(url)
-                    if song_info and not any(url == q[0] for q in queues[server_id]):
-                        queues[server_id].append((url, song_info["title"], song_info["artist"]))
-                        valid_urls += 1
+            for entry in user_playlists[name]:
+                if queue.is_full():
+                    break
+                url = entry["url"]
+                if url in queue or not await is_valid_url(url):
+                    continue
+                if entry["title"]:
+                    song_info = entry
+                else:
+                    song_info = await fetch_song_info_async(url, need_stream=False)
+                    if song_info:
+                        entry.update({key: song_info[key] for key in ("title", "artist", "duration", "thumbnail")})
+                        entry["updated_at"] = time.time()
+                        await playlist_store.update_song_meta(user_id, name, url, song_info)
+                if song_info and queue.add(url, song_info["title"], song_info["artist"], song_info.get("duration") or 0):
+                    valid_urls += 1
+            schedule_playlist_refresh(user_id, name, user_playlists[name])
             if valid_urls == 0:
                 embed = discord.Embed(description="🚫 Không tìm thấy bài hát khả dụng trong playlist! 😅", color=discord.Color.red())
                 embed.set_footer(text="✨ Hinaa luôn sẵn sàng nè! ✨")
@@ -876,18 +4001,17 @@ async def playlist(ctx, action: str, name: str = None, url: str = None):
             embed.set_footer(text="✨ Hinaa luôn sẵn sàng nè! ✨")
             await ctx.send(embed=embed)
             if not ctx.voice_client or not (ctx.voice_client.is_playing() or ctx.voice_client.is_paused()):
-                if server_id in queues and queues[server_id]:
-                    next_url, _, _ = queues[server_id].pop(0)
-                    await play_music(ctx, next_url)
+                if peek_queue(server_id):
+                    await play_music(ctx, peek_queue(server_id).pop_next().url)
         elif action == "list":
-            if user_id not in playlists or not playlists[user_id]:
+            if not user_playlists:
                 embed = discord.Embed(description="🎵 Bạn chưa có playlist nào! 😅", color=discord.Color.red())
                 embed.set_footer(text="✨ Hinaa luôn sẵn sàng nè! ✨")
                 await ctx.send(embed=embed)
                 return
             playlist_list = "\n".join(
                 f"📻 **{pname}**: {len(songs)} bài"
-                for pname, songs in playlists[user_id].items()
+                for pname, songs in user_playlists.items()
             )
             embed = discord.Embed(
                 title="📜 𝗗𝗮𝗻𝗵 𝗦á𝗰𝗵 𝗣𝗹𝗮𝘆𝗹𝗶𝘀𝘁",
@@ -897,21 +4021,21 @@ async def playlist(ctx, action: str, name: str = None, url: str = None):
             embed.set_footer(text="✨ Dùng !playlist view <tên> để xem chi tiết! ✨")
             await ctx.send(embed=embed)
         elif action == "view" and name:
-            if user_id not in playlists or name not in playlists[user_id] or not playlists[user_id][name]:
+            if not user_playlists.get(name):
                 embed = discord.Embed(description="🚫 Playlist trống hoặc không tồn tại! 😅", color=discord.Color.red())
                 embed.set_footer(text="✨ Hinaa luôn sẵn sàng nè! ✨")
                 await ctx.send(embed=embed)
                 return
             songs = []
-            for i, url in enumerate(playlists[user_id][name][:5]):
-                song_info = await fetch_song_info_async(url)
-                if song_info:
-                    songs.append(f"**{i+1}.** {song_info['title']} - {song_info['artist']}")
+            for i, entry in enumerate(user_playlists[name][:5]):
+                if entry["title"]:
+                    songs.append(f"**{i+1}.** {entry['title']} - {entry['artist']}")
                 else:
-                    songs.append(f"**{i+1}.** {url} (Không lấy được thông tin)")
+                    songs.append(f"**{i+1}.** {entry['url']} (Đang cập nhật thông tin)")
+            schedule_playlist_refresh(user_id, name, user_playlists[name])
             description = "\n".join(songs) or "Playlist trống!"
-            if len(playlists[user_id][name]) > 5:
-                description += f"\n... và {len(playlists[user_id][name]) - 5} bài khác!"
+            if len(user_playlists[name]) > 5:
+                description += f"\n... và {len(user_playlists[name]) - 5} bài khác!"
             embed = discord.Embed(
                 title=f"📻 𝗣𝗹𝗮𝘆𝗹𝗶𝘀𝘁: {name}",
                 description=description,
@@ -920,15 +4044,11 @@ async def playlist(ctx, action: str, name: str = None, url: str = None):
             embed.set_footer(text="✨ Hinaa luôn sẵn sàng nè! ✨")
             await ctx.send(embed=embed)
         elif action == "delete" and name:
-            if user_id not in playlists or name not in playlists[user_id]:
+            if not await playlist_store.delete(user_id, name):
                 embed = discord.Embed(description="🚫 Playlist không tồn tại! 😅", color=discord.Color.red())
                 embed.set_footer(text="✨ Hinaa luôn sẵn sàng nè! ✨")
                 await ctx.send(embed=embed)
                 return
-            del playlists[user_id][name]
-            if not playlists[user_id]:
-                del playlists[user_id]
-            save_playlists()
             embed = discord.Embed(description=f"🎶 Xóa playlist **{name}** thành công! 😊", color=discord.Color.blue())
             embed.set_footer(text="✨ Hinaa luôn sẵn sàng nè! ✨")
             await ctx.send(embed=embed)
@@ -955,6 +4075,217 @@ async def playlist(ctx, action: str, name: str = None, url: str = None):
         embed.set_footer(text="✨ Hinaa luôn sẵn sàng nè! ✨")
         await ctx.send(embed=embed)
 
+@bot.command()
+@commands.has_permissions(administrator=True)
+async def stats(ctx):
+    try:
+        match_stats = spotify_matches.stats()
+        metadata_stats = await metadata_cache.stats()
+        pool_stats = extraction_pool.stats()
+        progress_stats = progress_scheduler.stats()
+        autoplay_stats = autoplay_engine.stats()
+        audio_stats = audio_cache.stats()
+        loudness_stats = loudness_cache.stats()
+        state_stats = guild_state.stats()
+        session_stats = guild_sessions.stats()
+        loop_stats = loop_monitor.stats()
+        session_memory = sorted(guild_sessions.memory().items(), key=lambda item: item[1], reverse=True)
+        buffer_stats = audio_buffer_stats()
+        processing_stats = pcm_stats()
+        embed = discord.Embed(title="📈 𝗧𝗵ố𝗻𝗴 𝗞ê 𝗛𝗶𝗻𝗮𝗮", color=discord.Color.blue())
+        embed.add_field(
+            name="🧭 Trạng thái phiên",
+            value=(
+                f"Backend: **{state_stats['backend']}**\n"
+                f"Hàng đợi: **{state_stats['queues']}** | Đang phát: **{state_stats['playing']}**"
+                + (f"\nChờ ghi: **{state_stats['dirty']}** server" if "dirty" in state_stats else "")
+            ),
+            inline=False
+        )
+        embed.add_field(
+            name="⏱️ Event loop",
+            value=(
+                f"Độ trễ p50/p95/p99: **{loop_stats['p50'] * 1000:.1f}/{loop_stats['p95'] * 1000:.1f}/{loop_stats['p99'] * 1000:.1f}ms**\n"
+                f"Tối đa: **{loop_stats['max'] * 1000:.0f}ms** | Bị chặn: **{loop_stats['stalls']}** lần"
+                + (" | Debug: **bật**" if loop_stats["debug"] else "")
+            ),
+            inline=False
+        )
+        embed.add_field(
+            name="🧠 Bộ nhớ theo server",
+            value=(
+                f"Phiên đang mở: **{session_stats['sessions']}** | "
+                f"Tổng: **{sum(size for _, size in session_memory) / 1024:.0f}KB**\n"
+                f"Tự rời kênh khi rảnh: **{session_stats['idle_disconnects']}**"
+                + "".join(
+                    f"\n`{server_id}`: **{size / 1024:.1f}KB**"
+                    for server_id, size in session_memory[:5]
+                )
+            ),
+            inline=False
+        )
+        embed.add_field(
+            name="🎧 Bộ đệm âm thanh",
+            value=(
+                f"Đang phát: **{buffer_stats['active']}** luồng\n"
+                f"Độ đầy TB: **{buffer_stats['fill']:.0%}** | Thấp nhất: **{buffer_stats['min_fill']:.0%}**\n"
+                f"Underrun: **{buffer_stats['underruns']}**\n"
+                f"Xử lý PCM ({processing_stats['backend']}): **{processing_stats['avg_us']:.0f} µs**/khung, "
+                f"**{processing_stats['frames']}** khung"
+            ),
+            inline=False
+        )
+        embed.add_field(
+            name="📊 Cập nhật tiến trình",
+            value=(
+                f"Đang theo dõi: **{progress_stats['active']}** server\n"
+                f"Tốc độ edit: **{progress_stats['edit_rate']:.2f}/s** | Bỏ qua: **{progress_stats['skipped']}**\n"
+                f"Bị giới hạn (429): **{progress_stats['rate_limited']}**"
+            ),
+            inline=False
+        )
+        embed.add_field(
+            name="⚙️ Worker yt-dlp",
+            value=(
+                f"Đang bận: **{pool_stats['busy']}/{pool_stats['size']}**\n"
+                f"Quá hạn: **{pool_stats['timeouts']}** | Khởi động lại: **{pool_stats['restarts']}**"
+            ),
+            inline=False
+        )
+        embed.add_field(
+            name="💾 Cache âm thanh",
+            value=(
+                f"Số bài: **{audio_stats['files']}** ({audio_stats['bytes'] / 1024 / 1024:.0f}MB)\n"
+                f"Hit/Miss: **{audio_stats['hits']}/{audio_stats['misses']}** ({audio_stats['hit_rate']:.0%})\n"
+                f"Đã tải: **{audio_stats['fills']}** | Đã loại bỏ: **{audio_stats['evictions']}**"
+            ),
+            inline=False
+        )
+        embed.add_field(
+            name="🔉 Chuẩn hóa độ ồn",
+            value=(
+                f"Đã đo: **{loudness_stats['tracks']}** bài | Đang chờ: **{loudness_stats['pending']}** | Lỗi chờ thử lại: **{loudness_stats['failed']}**\n"
+                f"Phiên này: **{loudness_stats['analyzed']}** | Lỗi: **{loudness_stats['failures']}** | Bỏ qua (đầy): **{loudness_stats['dropped']}**"
+            ),
+            inline=False
+        )
+        embed.add_field(
+            name="🗂️ Cache metadata",
+            value=(
+                f"RAM/Đĩa: **{metadata_stats['memory_size']}/{metadata_stats['disk_size']}** bài\n"
+                f"Hit RAM/Đĩa: **{metadata_stats['memory_hits']}/{metadata_stats['disk_hits']}**\n"
+                f"Miss: **{metadata_stats['misses']}** | Stream hết hạn: **{metadata_stats['stream_expired']}**\n"
+                f"Tỉ lệ hit: **{metadata_stats['hit_rate']:.0%}**"
+            ),
+            inline=False
+        )
+        embed.add_field(
+            name="🔄 Tự phát",
+            value=(
+                f"Ứng viên: **{autoplay_stats['candidates']}** | Đã ghép: **{autoplay_stats['matched']}**\n"
+                f"Bài chuẩn bị sẵn: **{autoplay_stats['ready']}**"
+            ),
+            inline=False
+        )
+        embed.add_field(
+            name="🎧 Cache Spotify → YouTube",
+            value=(
+                f"Số bài: **{match_stats['size']}**\n"
+                f"Hit/Miss: **{match_stats['hits']}/{match_stats['misses']}** ({match_stats['hit_rate']:.0%})\n"
+                f"Đã loại bỏ: **{match_stats['evictions']}**"
+            ),
+            inline=False
+        )
+        embed.set_footer(text="✨ Hinaa luôn sẵn sàng nè! ✨")
+        await ctx.send(embed=embed)
+    except Exception as e:
+        logger.exception(f"Lỗi khi hiển thị thống kê: {e}")
+        embed = discord.Embed(description="🚫 Ôi, có gì đó sai rồi! Thử lại nhé 😅", color=discord.Color.red())
+        embed.set_footer(text="✨ Hinaa luôn sẵn sàng nè! ✨")
+        await ctx.send(embed=embed)
+
+@bot.command()
+@commands.has_permissions(administrator=True)
+async def traces(ctx, action: str = None):
+    try:
+        if action == "export":
+            data = io.BytesIO(trace_buffer.export().encode("utf-8"))
+            await ctx.send(file=discord.File(data, filename="hinaa_traces.json"))
+            return
+        slowest = trace_buffer.slowest_traces(5)
+        if not slowest:
+            embed = discord.Embed(description="🎵 Chưa có lần phát nào được ghi lại! 😊", color=discord.Color.blue())
+            embed.set_footer(text="✨ Hinaa luôn sẵn sàng nè! ✨")
+            await ctx.send(embed=embed)
+            return
+        embed = discord.Embed(title="⏱️ 𝗖á𝗰 𝗟ầ𝗻 𝗣𝗵á𝘁 𝗖𝗵ậ𝗺 𝗡𝗵ấ𝘁", color=discord.Color.blue())
+        for trace in slowest:
+            stages = sorted(trace.breakdown().items(), key=lambda item: item[1], reverse=True)
+            embed.add_field(
+                name=f"{trace.total * 1000:.0f}ms · {trace.name} · {trace.outcome}",
+                value=(
+                    f"`{trace.query[:80]}`\n"
+                    + "\n".join(f"{name}: **{duration * 1000:.0f}ms**" for name, duration in stages[:6])
+                ),
+                inline=False
+            )
+        embed.set_footer(text=f"✨ Đã ghi {trace_buffer.count} lần phát | !traces export để tải JSON ✨")
+        await ctx.send(embed=embed)
+    except Exception as e:
+        logger.exception(f"Lỗi khi hiển thị trace: {e}")
+        embed = discord.Embed(description="🚫 Ôi, có gì đó sai rồi! Thử lại nhé 😅", color=discord.Color.red())
+        embed.set_footer(text="✨ Hinaa luôn sẵn sàng nè! ✨")
+        await ctx.send(embed=embed)
+
+@bot.command(name="loop")
+@commands.has_permissions(administrator=True)
+async def loop_health(ctx, action: str = None, mode: str = None):
+    try:
+        if action == "debug":
+            loop_monitor.set_debug(mode == "on")
+            status = "bật" if loop_monitor.debug else "tắt"
+            embed = discord.Embed(description=f"🔍 Chế độ debug event loop đã {status}! 😊", color=discord.Color.blue())
+            embed.set_footer(text="✨ Hinaa luôn sẵn sàng nè! ✨")
+            await ctx.send(embed=embed)
+            return
+        loop_stats = loop_monitor.stats()
+        embed = discord.Embed(title="⏱️ 𝗦ứ𝗰 𝗞𝗵ỏ𝗲 𝗘𝘃𝗲𝗻𝘁 𝗟𝗼𝗼𝗽", color=discord.Color.blue())
+        embed.add_field(
+            name="📊 Độ trễ lập lịch",
+            value=(
+                f"p50: **{loop_stats['p50'] * 1000:.1f}ms** | p95: **{loop_stats['p95'] * 1000:.1f}ms** | "
+                f"p99: **{loop_stats['p99'] * 1000:.1f}ms** | Tối đa: **{loop_stats['max'] * 1000:.0f}ms**\n"
+                f"Bị chặn quá {loop_monitor.threshold * 1000:.0f}ms: **{loop_stats['stalls']}** lần"
+            ),
+            inline=False
+        )
+        if loop_monitor.stalls:
+            stall = loop_monitor.stalls[-1]
+            duration = f"{stall['duration'] * 1000:.0f}ms" if stall["duration"] else "đang chặn"
+            when = datetime.datetime.fromtimestamp(stall["at"]).strftime("%H:%M:%S")
+            embed.add_field(
+                name=f"🧱 Lần chặn gần nhất ({when}, {duration})",
+                value=f"```{stall['stack'][-900:]}```",
+                inline=False
+            )
+        if loop_monitor.debug:
+            steps = loop_monitor.slowest_steps(8)
+            embed.add_field(
+                name="🐢 Coroutine chậm theo lệnh",
+                value="\n".join(
+                    f"`{command}` · {name}: **{entry['count']}** lần, tối đa **{entry['max'] * 1000:.0f}ms**"
+                    for (command, name), entry in steps
+                ) or "Chưa có bước nào vượt ngưỡng",
+                inline=False
+            )
+        embed.set_footer(text=f"✨ !loop debug {'off' if loop_monitor.debug else 'on'} để {'tắt' if loop_monitor.debug else 'bật'} đo theo lệnh ✨")
+        await ctx.send(embed=embed)
+    except Exception as e:
+        logger.exception(f"Lỗi khi hiển thị sức khỏe event loop: {e}")
+        embed = discord.Embed(description="🚫 Ôi, có gì đó sai rồi! Thử lại nhé 😅", color=discord.Color.red())
+        embed.set_footer(text="✨ Hinaa luôn sẵn sàng nè! ✨")
+        await ctx.send(embed=embed)
+
 @bot.command()
 async def help(ctx):
     embed = discord.Embed(title="🎵 𝗖á𝗰 𝗟ệ𝗻𝗵 𝗖ủ𝗮 𝗛𝗶𝗻𝗮𝗮", color=discord.Color.blue())
@@ -967,10 +4298,14 @@ async def help(ctx):
             "`!search <tên>`: Tìm và phát nhạc\n"
             "`!queue <url>`: Thêm bài vào hàng đợi\n"
             "`!queue_list`: Xem danh sách hàng đợi\n"
+            "`!remove <vị trí>`: Xóa bài khỏi hàng đợi\n"
             "`!skip`: Bỏ qua bài hiện tại\n"
             "`!volume <0-100>`: Điều chỉnh âm lượng\n"
             "`!np`: Xem bài đang phát\n"
-            "`!playlist <hành động>`: Quản lý playlist (create/add/remove/play/list/view/delete)"
+            "`!playlist <hành động>`: Quản lý playlist (create/add/remove/play/list/view/delete)\n"
+            "`!stats`: Xem thống kê hệ thống (admin)\n"
+            "`!traces [export]`: Xem các lần phát chậm nhất (admin)\n"
+            "`!loop [debug on|off]`: Xem độ trễ event loop và đoạn code chặn loop (admin)"
         ),
         inline=False
     )
@@ -980,6 +4315,9 @@ async def help(ctx):
 async def main():
     bot.start_time = time.time()
     logger.info("Hinaa đang khởi động...")
+    if CLUSTER_ID:
+        # Launcher dừng cluster bằng SIGTERM, đóng kết nối gateway gọn gàng
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, lambda: asyncio.create_task(bot.close()))
     async with bot:
         for attempt in range(3):
             try:
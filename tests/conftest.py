@@ -0,0 +1,20 @@
+import os
+import sys
+import tempfile
+
+# main.py đọc cấu hình và mở file log/cache ngay lúc import: trỏ mọi thứ vào thư mục tạm
+WORKDIR = tempfile.mkdtemp(prefix="hinaa-tests-")
+os.chdir(WORKDIR)
+os.environ.update({
+    "DISCORD_BOT_TOKEN": "test",
+    "SPOTIFY_CLIENT_ID": "test",
+    "SPOTIFY_CLIENT_SECRET": "test",
+    "STATE_BACKEND": "memory",
+    "SESSION_JOURNAL_FILE": os.path.join(WORKDIR, "session_journal.jsonl"),
+    "METADATA_CACHE_FILE": os.path.join(WORKDIR, "cache.db"),
+    "PLAYLIST_DB_FILE": os.path.join(WORKDIR, "playlists.db"),
+    "SPOTIFY_MATCH_CACHE_FILE": os.path.join(WORKDIR, "spotify_matches.json"),
+    "AUDIO_CACHE_DIR": os.path.join(WORKDIR, "audio_cache"),
+    "LOUDNESS_NORMALIZE": "0",
+})
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
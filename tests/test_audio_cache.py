@@ -0,0 +1,58 @@
+import asyncio
+import os
+import sys
+import time
+
+import main
+
+def audio_cache(tmp_path, max_bytes=10 ** 9):
+    return main.AudioCache(str(tmp_path / "audio"), str(tmp_path / "cache.db"), max_bytes, 1)
+
+def test_fill_kills_stalled_ffmpeg_and_releases_lock(tmp_path, monkeypatch):
+    cache = audio_cache(tmp_path)
+    os.makedirs(cache.directory)
+    spawned = []
+    real_exec = asyncio.create_subprocess_exec
+
+    async def fake_song_info(url):
+        return {"url": "https://rr1.googlevideo.com/videoplayback?id=x", "acodec": "opus"}
+
+    async def stalled_ffmpeg(*args, **kwargs):
+        # ffmpeg đã ghi một phần rồi treo khi reconnect
+        part_path = args[-1]
+        with open(part_path, "wb") as f:
+            f.write(b"OggS")
+        process = await real_exec(sys.executable, "-c", "import time; time.sleep(30)", **kwargs)
+        spawned.append(process)
+        return process
+
+    monkeypatch.setattr(main, "fetch_song_info_async", fake_song_info)
+    monkeypatch.setattr(main.asyncio, "create_subprocess_exec", stalled_ffmpeg)
+    monkeypatch.setattr(main, "AUDIO_CACHE_FILL_TIMEOUT", 0.5)
+
+    async def run():
+        cache.fill_lock = asyncio.Semaphore(1)
+        cache.filling.add("aaaaaaaaaaa")
+        started = time.monotonic()
+        await cache.fill("aaaaaaaaaaa")
+        assert time.monotonic() - started < 10
+        assert not cache.fill_lock.locked()
+
+    asyncio.run(run())
+    cache.executor.shutdown(wait=True)
+    assert spawned and spawned[0].returncode is not None
+    assert "aaaaaaaaaaa" not in cache.files and not cache.filling
+    assert os.listdir(cache.directory) == []
+
+def test_load_evicts_directory_over_limit(tmp_path):
+    cache = audio_cache(tmp_path, max_bytes=250)
+    os.makedirs(cache.directory)
+    for video_id in ("aaaaaaaaaaa", "bbbbbbbbbbb", "ccccccccccc"):
+        with open(cache.path_for(video_id), "wb") as f:
+            f.write(b"\0" * 100)
+
+    asyncio.run(cache.load())
+    cache.executor.shutdown(wait=True)
+    assert cache.total_bytes <= 250
+    assert len(cache.files) == 2 and cache.evictions == 1
+    assert sorted(os.listdir(cache.directory)) == sorted(f"{video_id}.ogg" for video_id in cache.files)
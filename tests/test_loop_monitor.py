@@ -0,0 +1,52 @@
+import asyncio
+import time
+
+import main
+
+async def blocking_helper():
+    time.sleep(0.05)
+    await asyncio.sleep(0)
+
+async def handler():
+    await blocking_helper()
+
+def test_slow_step_is_attributed_to_innermost_coroutine():
+    monitor = main.LoopMonitor(0.01, 0.02, 100)
+
+    async def run():
+        asyncio.get_running_loop().set_task_factory(monitor.task_factory)
+        await asyncio.create_task(handler())
+
+    asyncio.run(run())
+    names = [name for _, name in monitor.slow_steps]
+    assert names and all(name.startswith("blocking_helper:") for name in names)
+
+def test_stall_duration_is_filled_from_heartbeat():
+    monitor = main.LoopMonitor(0.01, 0.05, 100)
+
+    async def run():
+        monitor.start()
+        await asyncio.sleep(0.05)
+        time.sleep(0.3)
+        # Để watchdog kịp ghi, rồi loop chạy vài nhịp bình thường (lag nhỏ hơn ngưỡng)
+        await asyncio.sleep(0.1)
+        monitor.task.cancel()
+
+    asyncio.run(run())
+    assert monitor.stalls
+    assert monitor.stalls[-1]["duration"] is not None
+    assert monitor.stalls[-1]["duration"] >= 0.2
+
+def test_stall_below_threshold_is_not_left_open():
+    monitor = main.LoopMonitor(0.01, 0.05, 100)
+
+    async def run():
+        monitor.start()
+        await asyncio.sleep(0.03)
+        # Watchdog ghi nhận trễ hơn nhịp lấy mẫu kế tiếp, mẫu lag đó nhỏ hơn ngưỡng
+        monitor.stalls.append({"at": time.time(), "duration": None, "stack": ""})
+        await asyncio.sleep(0.05)
+        monitor.task.cancel()
+
+    asyncio.run(run())
+    assert monitor.stalls[-1]["duration"] is not None
@@ -0,0 +1,56 @@
+import asyncio
+import sys
+import time
+
+import pytest
+
+import main
+
+def loudness_cache(tmp_path):
+    return main.LoudnessCache(
+        str(tmp_path / "loudness.db"), main.LOUDNESS_TARGET_LUFS, main.LOUDNESS_TRUE_PEAK, 1, 10
+    )
+
+def test_measure_kills_ffmpeg_on_timeout(tmp_path, monkeypatch):
+    spawned = []
+    real_exec = asyncio.create_subprocess_exec
+
+    async def hanging_ffmpeg(*args, **kwargs):
+        # ffmpeg treo (stream không trả dữ liệu): process không tự thoát
+        process = await real_exec(sys.executable, "-c", "import time; time.sleep(30)", **kwargs)
+        spawned.append(process)
+        return process
+
+    monkeypatch.setattr(main.asyncio, "create_subprocess_exec", hanging_ffmpeg)
+    monkeypatch.setattr(main, "LOUDNESS_TIMEOUT", 0.5)
+    cache = loudness_cache(tmp_path)
+    started = time.monotonic()
+    with pytest.raises(RuntimeError):
+        asyncio.run(cache.measure("https://example.com/stream"))
+    assert time.monotonic() - started < 10
+    assert spawned and spawned[0].returncode is not None
+
+def test_failures_are_persisted_and_expire(tmp_path, monkeypatch):
+    monkeypatch.setattr(main, "LOUDNESS_NORMALIZE", True)
+    cache = loudness_cache(tmp_path)
+    asyncio.run(cache.mark_failed("broken", "ffmpeg lỗi"))
+    cache.executor.shutdown()
+
+    # Process khởi động lại vẫn nhớ bài lỗi và không xếp hàng đo lại
+    reloaded = loudness_cache(tmp_path)
+    asyncio.run(reloaded.load())
+    assert reloaded.recently_failed("broken")
+    reloaded.request({"id": "broken", "duration": 200})
+    assert reloaded.queue is None and "broken" not in reloaded.pending
+    assert reloaded.stats()["failed"] == 1
+
+    # Hết TTL thì được thử lại
+    reloaded.failed["broken"] -= main.LOUDNESS_RETRY_AFTER + 1
+    assert not reloaded.recently_failed("broken")
+    assert "broken" not in reloaded.failed
+
+def test_success_clears_failure(tmp_path):
+    cache = loudness_cache(tmp_path)
+    asyncio.run(cache.mark_failed("flaky", "timeout"))
+    cache._store("flaky", -20.0, -3.0, 4.0)
+    assert cache._lookup("flaky") == (4.0, None)
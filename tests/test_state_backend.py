@@ -0,0 +1,260 @@
+import asyncio
+import datetime
+import json
+import types
+
+import pytest
+
+import main
+
+class FakePipeline:
+    # Gom lệnh như redis.asyncio pipeline và chỉ chạy khi execute()
+    def __init__(self, redis):
+        self.redis = redis
+        self.commands = []
+
+    def __getattr__(self, name):
+        def queue(*args, **kwargs):
+            self.commands.append((name, args, kwargs))
+            return self
+        return queue
+
+    async def execute(self):
+        self.redis.pipelines += 1
+        if self.redis.fail_next:
+            self.redis.fail_next = False
+            raise ConnectionError("redis down")
+        return [getattr(self.redis, name)(*args, **kwargs) for name, args, kwargs in self.commands]
+
+class FakeRedis:
+    # Stand-in trong process cho phần Redis mà RedisStateBackend dùng (decode_responses=True)
+    def __init__(self):
+        self.hashes = {}
+        self.sets = {}
+        self.pipelines = 0
+        self.fail_next = False
+
+    def pipeline(self, transaction: bool = True):
+        return FakePipeline(self)
+
+    def hset(self, key, mapping):
+        self.hashes.setdefault(key, {}).update({field: str(value) for field, value in mapping.items()})
+        return len(mapping)
+
+    def hgetall(self, key):
+        return dict(self.hashes.get(key, {}))
+
+    def delete(self, key):
+        return int(self.hashes.pop(key, None) is not None)
+
+    def sadd(self, key, member):
+        self.sets.setdefault(key, set()).add(str(member))
+        return 1
+
+    def srem(self, key, member):
+        self.sets.get(key, set()).discard(str(member))
+        return 1
+
+@pytest.fixture
+def fake_redis(monkeypatch):
+    redis = FakeRedis()
+    monkeypatch.setattr(main, "aioredis", types.SimpleNamespace(from_url=lambda url, **kwargs: redis))
+    return redis
+
+@pytest.fixture
+def journal(tmp_path):
+    return main.SessionJournal(str(tmp_path / "journal.jsonl"), 1000)
+
+def redis_backend():
+    return main.RedisStateBackend("redis://fake", "test", 2)
+
+def memory_backend(journal):
+    return main.MemoryStateBackend(journal)
+
+def playing_song(offset: float = 42.0) -> dict:
+    return {
+        "title": "Now Song",
+        "artist": "Now Artist",
+        "url": "https://www.youtube.com/watch?v=nownownow01",
+        "duration": 200,
+        "start_time": datetime.datetime.now() - datetime.timedelta(seconds=offset),
+        "thumbnail": None,
+        "text_channel": 11,
+        "voice_channel": 12,
+        "source_info": {},
+    }
+
+def fill(backend, server_id):
+    queue = backend.queue(server_id)
+    queue.add("https://www.youtube.com/watch?v=aaaaaaaaaaa", "A", "Artist A", 100)
+    queue.extend([
+        ("https://www.youtube.com/watch?v=bbbbbbbbbbb", "B", "Artist B", 110),
+        ("https://www.youtube.com/watch?v=ccccccccccc", "C", "Artist C", 120),
+    ])
+    backend.set_now_playing(server_id, playing_song())
+    backend.set_autoplay(server_id, True)
+    backend.set_volume(server_id, 0.5)
+
+@pytest.fixture(params=["memory", "redis"])
+def backend(request, fake_redis, journal):
+    return redis_backend() if request.param == "redis" else memory_backend(journal)
+
+def test_state_accessors(backend):
+    assert backend.now_playing(1) is None
+    assert not backend.autoplay_enabled(1)
+    assert backend.volume(1) == 1.0
+    fill(backend, 1)
+    assert [entry.title for entry in backend.queue(1)] == ["A", "B", "C"]
+    assert backend.now_playing(1)["title"] == "Now Song"
+    assert backend.autoplay_enabled(1)
+    assert backend.volume(1) == 0.5
+    assert backend.add_vote(1, 100) == 1
+    assert backend.add_vote(1, 100) == 1
+    assert backend.add_vote(1, 200) == 2
+    backend.clear_votes(1)
+    assert backend.add_vote(1, 300) == 1
+    # Giá trị mặc định không được giữ lại
+    backend.set_autoplay(1, False)
+    backend.set_volume(1, 1.0)
+    assert 1 not in backend.autoplay and 1 not in backend.volumes
+    backend.clear_now_playing(1)
+    assert backend.now_playing(1) is None
+
+def test_peek_queue_does_not_allocate(backend):
+    assert backend.peek_queue(1) is None
+    assert 1 not in backend.queues
+    fill(backend, 1)
+    assert backend.peek_queue(1) is backend.queue(1)
+
+def test_drop_keeps_settings_forget_clears_all(backend):
+    fill(backend, 1)
+    backend.drop(1)
+    assert backend.now_playing(1) is None
+    assert 1 not in backend.queues
+    assert backend.autoplay_enabled(1) and backend.volume(1) == 0.5
+    backend.forget(1)
+    assert not backend.autoplay_enabled(1) and backend.volume(1) == 1.0
+    assert backend.session(1) is None
+
+def test_redis_write_behind_uses_one_pipeline_per_flush(fake_redis):
+    backend = redis_backend()
+    fill(backend, 1)
+    fill(backend, 2)
+    backend.add_vote(1, 100)
+    assert fake_redis.pipelines == 0, "thay đổi chỉ được ghi khi flush"
+    asyncio.run(backend.flush())
+    assert fake_redis.pipelines == 1
+    assert fake_redis.sets["test:guilds"] == {"1", "2"}
+    stored = fake_redis.hashes["test:guild:1"]
+    assert json.loads(stored["queue"])[0][:2] == ["https://www.youtube.com/watch?v=aaaaaaaaaaa", "A"]
+    assert json.loads(stored["now"])["title"] == "Now Song"
+    assert stored["autoplay"] == "1" and float(stored["volume"]) == 0.5
+    assert json.loads(stored["votes"]) == [100]
+    # Không có gì thay đổi thì không gửi pipeline
+    asyncio.run(backend.flush())
+    assert fake_redis.pipelines == 1
+
+def test_redis_flush_failure_keeps_dirty(fake_redis):
+    backend = redis_backend()
+    fill(backend, 1)
+    fake_redis.fail_next = True
+    with pytest.raises(ConnectionError):
+        asyncio.run(backend.flush())
+    assert 1 in backend.dirty
+    asyncio.run(backend.flush())
+    assert "test:guild:1" in fake_redis.hashes
+
+def test_redis_forget_deletes_key(fake_redis):
+    backend = redis_backend()
+    fill(backend, 1)
+    asyncio.run(backend.flush())
+    backend.forget(1)
+    asyncio.run(backend.flush())
+    assert "test:guild:1" not in fake_redis.hashes
+    assert "1" not in fake_redis.sets["test:guilds"]
+
+def test_redis_write_behind_loop_flushes_every_interval(fake_redis, monkeypatch):
+    monkeypatch.setattr(main, "SESSION_JOURNAL_FLUSH_INTERVAL", 0.01)
+    backend = redis_backend()
+
+    async def run():
+        backend.start()
+        fill(backend, 1)
+        await asyncio.sleep(0.05)
+        backend.task.cancel()
+    asyncio.run(run())
+    assert "test:guild:1" in fake_redis.hashes
+
+def test_redis_load_sessions_in_pipelined_batches(fake_redis):
+    writer = redis_backend()
+    for server_id in (1, 2, 3):
+        fill(writer, server_id)
+    asyncio.run(writer.flush())
+    before = fake_redis.pipelines
+    reader = redis_backend()
+    sessions = asyncio.run(reader.load_sessions([1, 2, 3, 4, 5]))
+    # batch_size=2: 5 server -> 3 pipeline
+    assert fake_redis.pipelines - before == 3
+    assert set(sessions) == {1, 2, 3}
+    assert [item[1] for item in sessions[1]["queue"]] == ["A", "B", "C"]
+    assert sessions[1]["now"]["offset"] >= 42
+    assert sessions[1]["autoplay"] is True and sessions[1]["volume"] == 0.5
+
+class FakeVoiceChannel:
+    def __init__(self, guild, channel_id):
+        self.guild = guild
+        self.id = channel_id
+
+    async def connect(self):
+        self.guild.voice_client = types.SimpleNamespace(channel=self)
+        return self.guild.voice_client
+
+class FakeGuild:
+    def __init__(self, guild_id):
+        self.id = guild_id
+        self.me = types.SimpleNamespace(id=0)
+        self.voice_client = None
+        self.channels = {11: types.SimpleNamespace(id=11), 12: FakeVoiceChannel(self, 12)}
+
+    def get_channel(self, channel_id):
+        return self.channels.get(channel_id)
+
+@pytest.mark.parametrize("kind", ["memory", "redis"])
+def test_restart_round_trip_through_resume_sessions(kind, fake_redis, journal, monkeypatch):
+    before = redis_backend() if kind == "redis" else memory_backend(journal)
+    fill(before, 7)
+    asyncio.run(before.flush(compact=True))
+
+    after = redis_backend() if kind == "redis" else memory_backend(main.SessionJournal(journal.path, 1000))
+    guild = FakeGuild(7)
+    played = []
+
+    async def fake_resolve(url):
+        return {"title": "Now Song", "artist": "Now Artist", "duration": 200, "thumbnail": None, "url": "stream"}
+
+    async def fake_play_source(ctx, song_info, url, offset=0, announce=True):
+        played.append((ctx.guild.id, url, offset))
+
+    monkeypatch.setattr(main, "guild_state", after)
+    monkeypatch.setattr(type(main.bot), "guilds", property(lambda self: [guild]), raising=False)
+    monkeypatch.setattr(main.bot, "get_guild", lambda guild_id: guild if guild_id == 7 else None, raising=False)
+    monkeypatch.setattr(main, "resolve_track", fake_resolve)
+    monkeypatch.setattr(main, "play_source", fake_play_source)
+    asyncio.run(main.resume_sessions())
+
+    assert [entry.title for entry in after.queue(7)] == ["A", "B", "C"]
+    assert after.autoplay_enabled(7) and after.volume(7) == 0.5
+    assert guild.voice_client is not None
+    assert played == [(7, "https://www.youtube.com/watch?v=nownownow01", pytest.approx(42, abs=1))]
+
+def test_memory_journal_replays_drop_and_forget(journal):
+    backend = memory_backend(journal)
+    fill(backend, 1)
+    fill(backend, 2)
+    backend.drop(1)
+    backend.forget(2)
+    asyncio.run(backend.flush())
+    sessions = asyncio.run(memory_backend(main.SessionJournal(journal.path, 1000)).load_sessions([1, 2]))
+    assert set(sessions) == {1}
+    assert sessions[1]["queue"] == [] and sessions[1]["now"] is None
+    assert sessions[1]["autoplay"] is True and sessions[1]["volume"] == 0.5
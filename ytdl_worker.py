@@ -0,0 +1,37 @@
+import yt_dlp
+
+# Code chạy trong process worker yt-dlp của ExtractionPool (main.py).
+# Tách khỏi main.py để worker (forkserver/spawn) không import lại toàn bộ bot: log, discord, spotipy, cache...
+# Chỉ được import yt_dlp ở đây.
+
+EXTRACTED_INFO_KEYS = (
+    "url", "id", "title", "uploader", "channel", "duration", "thumbnail",
+    "webpage_url", "acodec", "ext", "abr", "asr", "live_status", "view_count",
+)
+
+def compact_info(info: dict) -> dict:
+    compacted = {key: info[key] for key in EXTRACTED_INFO_KEYS if key in info}
+    if info.get("entries") is not None:
+        compacted["entries"] = [compact_info(entry) if entry else None for entry in info["entries"]]
+    return compacted
+
+def extraction_worker(conn, factory=None):
+    # Giữ sẵn YoutubeDL cho từng bộ tùy chọn; factory thay yt_dlp.YoutubeDL (benchmark dùng bản giả)
+    factory = factory or yt_dlp.YoutubeDL
+    instances = {}
+    while True:
+        try:
+            request = conn.recv()
+        except (EOFError, KeyboardInterrupt):
+            break
+        if request is None:
+            break
+        opts_key, ydl_opts, url = request
+        try:
+            ydl = instances.get(opts_key)
+            if ydl is None:
+                ydl = instances[opts_key] = factory(ydl_opts)
+            info = ydl.extract_info(url, download=False)
+            conn.send(("ok", compact_info(ydl.sanitize_info(info)) if info else None))
+        except Exception as e:
+            conn.send(("error", repr(e)))